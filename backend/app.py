@@ -1,23 +1,93 @@
-from flask import Flask, jsonify, send_from_directory, request
+from flask import Flask, jsonify, send_from_directory, request, Response, stream_with_context, g
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 import os
 import random
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime, timedelta
 import sqlite3
 import subprocess
+import json
+import re
+import math
+import struct
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
 import uuid
+import hashlib
+import socket
+import threading
+import time
+import concurrent.futures
+import traceback
+import shutil
+import tempfile
+import mmap
+import contextlib
+import bisect
+import atexit
+import functools
+import ctypes
+import select
+import stat
+import mimetypes
+from urllib.parse import quote
+from array import array
+try:
+    import fcntl
+except ImportError:  # Windows下没有fcntl，只做进程内互斥
+    fcntl = None
 from PIL import Image
 import io
 import base64
 
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(os.path.dirname(__file__), 'instance', 'videos.db')
+DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(__file__), 'instance', 'videos.db'))
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DATABASE_PATH
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# SQLite连接：等待写锁的秒数、页缓存大小（KB）、内存映射大小（字节）、每个进程的连接池大小
+app.config['SQLITE_BUSY_TIMEOUT'] = float(os.environ.get('SQLITE_BUSY_TIMEOUT', '30'))
+app.config['SQLITE_CACHE_SIZE_KB'] = int(os.environ.get('SQLITE_CACHE_SIZE_KB', str(64 * 1024)))
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+app.config['SQLITE_POOL_SIZE'] = int(os.environ.get('SQLITE_POOL_SIZE', '10'))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    # 后台任务、缩略图生成等线程与请求线程共用连接池
+    'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT'], 'check_same_thread': False},
+    'pool_size': app.config['SQLITE_POOL_SIZE'],
+    'max_overflow': app.config['SQLITE_POOL_SIZE'] * 2,
+    'pool_timeout': app.config['SQLITE_BUSY_TIMEOUT']
+}
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    """每个新连接启用WAL（读写互不阻塞）、NORMAL同步、忙等待、页缓存和内存映射"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT'] * 1000)}")
+    cursor.execute(f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_SIZE_KB']}")
+    cursor.execute(f"PRAGMA mmap_size={app.config['SQLITE_MMAP_SIZE']}")
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+def _dispose_engine_after_fork():
+    """gunicorn --preload时worker从主进程fork，丢弃继承来的连接，各进程使用自己的连接"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_engine_after_fork)
+
 
 
 # 数据库模型
@@ -32,27 +102,93 @@ class Video(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), unique=True, nullable=False)
     filepath = db.Column(db.String(512), nullable=False)
-    next_id = db.Column(db.Integer, db.ForeignKey('video.id'))
+    next_id = db.Column(db.Integer, db.ForeignKey('video.id'), index=True)  # 播放序列中的下一个视频
     thumbnail_path = db.Column(db.String(512))  # 缩略图文件路径
+    thumbnail_hash = db.Column(db.String(64), index=True)  # 缩略图内容哈希（内容寻址存储）
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Favorite(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # 唯一约束，防止重复收藏
-    __table_args__ = (db.UniqueConstraint('user_id', 'video_id', name='_user_video_uc'),)
+    # 唯一约束，防止重复收藏；按收藏时间游标分页的索引
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'video_id', name='_user_video_uc'),
+        db.Index('ix_favorite_user_created', 'user_id', 'created_at', 'id'),
+    )
 
 class Dislike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # 唯一约束，防止重复讨厌
-    __table_args__ = (db.UniqueConstraint('user_id', 'video_id', name='_user_video_dislike_uc'),)
+    # 唯一约束，防止重复讨厌；按讨厌时间游标分页的索引
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'video_id', name='_user_video_dislike_uc'),
+        db.Index('ix_dislike_user_created', 'user_id', 'created_at', 'id'),
+    )
+
+class ProbeCache(db.Model):
+    """视频探测结果缓存（横向视频也会记录），文件大小或修改时间变化后自动失效"""
+    id = db.Column(db.Integer, primary_key=True)
+    relpath = db.Column(db.String(512), unique=True, nullable=False)  # 相对媒体目录的路径
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    rotation = db.Column(db.Integer, default=0)  # 显示旋转角度（0/90/180/270）
+    duration = db.Column(db.Float)  # 时长（秒）
+    codec = db.Column(db.String(32))
+    is_portrait = db.Column(db.Boolean, nullable=False)
+    probed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ScanDirectory(db.Model):
+    """媒体目录指纹（mtime/inode），增量扫描时跳过未变化的目录"""
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(16), nullable=False)  # 记录指纹的扫描器
+    path = db.Column(db.String(512), nullable=False)  # 相对媒体目录的路径，根目录为'.'
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    inode = db.Column(db.BigInteger, nullable=False)
+    subdirs = db.Column(db.Text, nullable=False, default='[]')  # 子目录名列表（JSON）
+    scanned_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.UniqueConstraint('scope', 'path', name='_scope_path_uc'),)
+
+class Job(db.Model):
+    """后台任务（批量生成缩略图、媒体扫描），进度定期写入数据库，进程重启后从断点继续"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)  # thumbnails / scan
+    status = db.Column(db.String(16), nullable=False, default='running')  # running/completed/failed/cancelled
+    params = db.Column(db.Text)  # 任务参数（JSON）
+    total = db.Column(db.Integer, default=0)
+    processed = db.Column(db.Integer, default=0)
+    succeeded = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    cursor = db.Column(db.Integer, default=0)  # 断点：已处理到的最大视频ID
+    cancel_requested = db.Column(db.Boolean, default=False)
+    owner = db.Column(db.String(128))  # 正在执行任务的进程
+    heartbeat_at = db.Column(db.DateTime)
+    result = db.Column(db.Text)  # 任务结果（JSON）
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+class JobFailure(db.Model):
+    """后台任务中单个条目的失败记录"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id'), nullable=False, index=True)
+    item_id = db.Column(db.Integer)
+    item = db.Column(db.String(512))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AppMeta(db.Model):
+    """应用级计数器（如媒体库版本号），多个进程通过数据库共享"""
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
 
 # 配置媒体文件路径
 # 优先使用环境变量中的路径，否则使用默认路径
@@ -60,6 +196,49 @@ MEDIA_FOLDER = os.environ.get('MEDIA_FOLDER', os.path.join(os.path.dirname(__fil
 THUMBNAIL_FOLDER = os.environ.get('THUMBNAIL_FOLDER', os.path.join(os.path.dirname(__file__), '../thumbnails'))
 app.config['MEDIA_FOLDER'] = MEDIA_FOLDER
 app.config['THUMBNAIL_FOLDER'] = THUMBNAIL_FOLDER
+# 扫描时并行探测的线程数，以及每批提交数据库的文件数
+app.config['PROBE_WORKERS'] = int(os.environ.get('PROBE_WORKERS', os.cpu_count() or 4))
+app.config['SCAN_COMMIT_BATCH'] = int(os.environ.get('SCAN_COMMIT_BATCH', '500'))
+# 后台任务：并行处理的线程数、每处理多少条保存一次断点、心跳超时多久视为执行进程已退出
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', os.cpu_count() or 4))
+app.config['JOB_CHECKPOINT_SIZE'] = int(os.environ.get('JOB_CHECKPOINT_SIZE', '20'))
+app.config['JOB_STALE_SECONDS'] = int(os.environ.get('JOB_STALE_SECONDS', '60'))
+# 启动扫描：是否在启动后于后台增量扫描媒体库，以及多久内已有进程扫描过时不再重复扫描（秒）
+app.config['STARTUP_SCAN'] = os.environ.get('STARTUP_SCAN', 'true').lower() == 'true'
+app.config['STARTUP_SCAN_COOLDOWN'] = int(os.environ.get('STARTUP_SCAN_COOLDOWN', '300'))
+# 文件监听入库：auto（优先inotify，不可用时轮询）/inotify/poll/off，文件大小保持不变多少秒后入库，轮询间隔秒数
+app.config['MEDIA_WATCH'] = os.environ.get('MEDIA_WATCH', 'auto').lower()
+app.config['MEDIA_WATCH_SETTLE_SECONDS'] = float(os.environ.get('MEDIA_WATCH_SETTLE_SECONDS', '2'))
+app.config['MEDIA_WATCH_POLL_INTERVAL'] = float(os.environ.get('MEDIA_WATCH_POLL_INTERVAL', '10'))
+# 视频文件发送方式：flask为后端直接发送，x-accel交给Nginx（X-Accel-Redirect到内部location），x-sendfile交给Apache/lighttpd
+app.config['VIDEO_SERVING'] = os.environ.get('VIDEO_SERVING', 'flask').lower()
+app.config['VIDEO_ACCEL_PREFIX'] = os.environ.get('VIDEO_ACCEL_PREFIX', '/protected-media/')
+# HLS：是否开启按需转封装、分片缓存目录（默认在数据库目录下）和总大小上限（字节）、目标分片时长（秒）、
+# 请求等待分片生成的最长秒数、每个进程同时转封装的视频数、转封装失败后多久内不再重试
+app.config['HLS_ENABLED'] = os.environ.get('HLS_ENABLED', 'true').lower() == 'true'
+app.config['HLS_CACHE_FOLDER'] = os.environ.get('HLS_CACHE_FOLDER', os.path.join(os.path.dirname(DATABASE_PATH), 'hls_cache'))
+app.config['HLS_CACHE_SIZE'] = int(os.environ.get('HLS_CACHE_SIZE', str(2 * 1024 * 1024 * 1024)))
+app.config['HLS_SEGMENT_SECONDS'] = float(os.environ.get('HLS_SEGMENT_SECONDS', '4'))
+app.config['HLS_WAIT_SECONDS'] = float(os.environ.get('HLS_WAIT_SECONDS', '10'))
+app.config['HLS_CONCURRENCY'] = int(os.environ.get('HLS_CONCURRENCY', '2'))
+app.config['HLS_RETRY_SECONDS'] = int(os.environ.get('HLS_RETRY_SECONDS', '60'))
+# 缩略图：ffmpeg全局并发上限、请求等待生成的最长秒数、生成失败后多久内不再重试
+app.config['THUMBNAIL_CONCURRENCY'] = int(os.environ.get('THUMBNAIL_CONCURRENCY', '2'))
+app.config['THUMBNAIL_WAIT_SECONDS'] = float(os.environ.get('THUMBNAIL_WAIT_SECONDS', '0.5'))
+app.config['THUMBNAIL_RETRY_SECONDS'] = int(os.environ.get('THUMBNAIL_RETRY_SECONDS', '60'))
+# 缩略图变体：生成的宽度和格式（webp/avif/jpeg），一次解码同时输出所有变体
+app.config['THUMBNAIL_WIDTHS'] = [int(w) for w in os.environ.get('THUMBNAIL_WIDTHS', '160,320,640').split(',') if w.strip()]
+app.config['THUMBNAIL_VARIANT_FORMATS'] = [f.strip() for f in os.environ.get('THUMBNAIL_VARIANT_FORMATS', 'webp,jpeg').split(',') if f.strip()]
+# 缩略图存储后端：files为每个缩略图一个文件，pack为追加写入的打包段文件；以及单个段的大小上限、整理阈值（失效数据占比）
+app.config['THUMBNAIL_BACKEND'] = os.environ.get('THUMBNAIL_BACKEND', 'files')
+app.config['THUMBNAIL_PACK_SEGMENT_SIZE'] = int(os.environ.get('THUMBNAIL_PACK_SEGMENT_SIZE', str(256 * 1024 * 1024)))
+app.config['THUMBNAIL_PACK_COMPACT_RATIO'] = float(os.environ.get('THUMBNAIL_PACK_COMPACT_RATIO', '0.3'))
+# 收藏/讨厌延迟写入：是否开启、批量写入的间隔秒数、待写入操作达到多少条时立即写入
+app.config['INTERACTION_WRITE_BEHIND'] = os.environ.get('INTERACTION_WRITE_BEHIND', 'false').lower() == 'true'
+app.config['INTERACTION_FLUSH_INTERVAL'] = float(os.environ.get('INTERACTION_FLUSH_INTERVAL', '0.5'))
+app.config['INTERACTION_FLUSH_SIZE'] = int(os.environ.get('INTERACTION_FLUSH_SIZE', '200'))
+# 列表接口响应缓存的条目数上限（每个进程），0为不缓存
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', '512'))
 
 print(f"📁 媒体目录配置: {MEDIA_FOLDER}")
 print(f"📁 缩略图目录配置: {THUMBNAIL_FOLDER}")
@@ -70,15 +249,73 @@ print(f"📁 缩略图目录是否存在: {os.path.exists(THUMBNAIL_FOLDER)}")
 os.makedirs(MEDIA_FOLDER, exist_ok=True)
 os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
 
+def _migrate_thumbnail_hash(conn):
+    columns = {row[1] for row in conn.exec_driver_sql('PRAGMA table_info(video)')}
+    if 'thumbnail_hash' not in columns:
+        conn.exec_driver_sql('ALTER TABLE video ADD COLUMN thumbnail_hash VARCHAR(64)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_video_thumbnail_hash ON video (thumbnail_hash)')
+
+def _migrate_listing_indexes(conn):
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_video_next_id ON video (next_id)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_favorite_user_created ON favorite (user_id, created_at, id)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_dislike_user_created ON dislike (user_id, created_at, id)')
+
+def _migrate_relink_sequence(conn):
+    # 旧版本扫描后整体重写next_id（最后一个视频会残留旧值），重新计算一次，之后增量维护
+    conn.exec_driver_sql(SEQUENCE_RELINK_SQL)
+
+def _migrate_video_id_indexes(conn):
+    # 删除视频时按video_id清理收藏和讨厌记录
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_favorite_video_id ON favorite (video_id)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_dislike_video_id ON dislike (video_id)')
+
+# 数据库迁移：(版本号, 说明, 迁移函数)，只能在末尾追加。
+# 新建的数据库由db.create_all()按模型建出最新结构，直接记为最新版本
+MIGRATIONS = [
+    (1, 'video表添加thumbnail_hash列', _migrate_thumbnail_hash),
+    (2, '添加列表分页和播放序列索引', _migrate_listing_indexes),
+    (3, '重新计算播放序列', _migrate_relink_sequence),
+    (4, '添加收藏和讨厌记录的video_id索引', _migrate_video_id_indexes),
+]
+
+def migrate_database(fresh=False):
+    """依次执行尚未执行的迁移，版本号记录在PRAGMA user_version中
+    
+    通过文件锁保证多个worker同时启动时只有一个进程执行迁移；每个迁移完成后立即记录版本号，
+    迁移本身需要可以重复执行（中途退出后会从该迁移重新开始）。
+    """
+    latest = MIGRATIONS[-1][0]
+    with open(DATABASE_PATH + '.migrate.lock', 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with db.engine.connect() as conn:
+            current = conn.exec_driver_sql('PRAGMA user_version').scalar()
+            if fresh and current == 0:
+                # fresh由调用方在db.create_all()之前判断（当时还没有video表），此时的表都是按最新模型建出的
+                conn.exec_driver_sql(f'PRAGMA user_version = {latest}')
+                conn.commit()
+                return
+            for version, description, migrate in MIGRATIONS:
+                if version <= current:
+                    continue
+                print(f"升级数据库: {description}（版本 {version}）")
+                migrate(conn)
+                conn.exec_driver_sql(f'PRAGMA user_version = {version}')
+                conn.commit()
+            if current < latest:
+                # 更新查询规划器的统计信息，让新索引尽快生效
+                conn.exec_driver_sql('PRAGMA optimize')
+
 def init_db():
     with app.app_context():
-        # 检查数据库文件是否存在（使用SQLAlchemy配置的路径）
-        db_file = 'instance/videos.db'
+        # 按建表前是否已有video表判断是否为新数据库（不依赖当前工作目录和数据库文件是否存在），
+        # 已有数据的数据库必须经过迁移，不能直接记为最新版本
+        fresh = not db.inspect(db.engine).has_table('video')
+        db.create_all()
+        migrate_database(fresh=fresh)
         
-        if not os.path.exists(db_file):
-            # 如果数据库文件不存在，创建新的数据库
-            print(f"数据库文件 {db_file} 不存在，创建新的数据库")
-            db.create_all()
+        if fresh:
+            print(f"数据库 {DATABASE_PATH} 中没有数据表，已创建新的数据库")
             # 创建默认管理员账户
             admin_user = User.query.filter_by(username='admin').first()
             if not admin_user:
@@ -87,89 +324,916 @@ def init_db():
                 db.session.commit()
                 print("创建默认管理员账户: admin/admin")
         else:
-            # 数据库文件已存在，直接连接（确保表结构存在）
-            db.create_all()
-            print(f"数据库文件 {db_file} 已存在，直接连接")
-        
-        scan_media_folder()
+            print(f"数据库 {DATABASE_PATH} 已存在，直接连接")
 
-def is_portrait_video(filepath):
-    """使用ffprobe判断视频是否为纵向视频"""
+def ffprobe_video_metadata(filepath):
+    """使用ffprobe读取视频元数据（宽、高、旋转角度、时长、编码），失败返回None"""
     try:
-        import subprocess
-        import json
-        
-        # 使用ffprobe获取视频信息
         cmd = [
             'ffprobe',
             '-v', 'error',
             '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height',
+            '-show_entries', 'stream=width,height,codec_name,duration:stream_tags=rotate'
+                             ':stream_side_data=rotation:format=duration',
             '-of', 'json',
             filepath
         ]
         result = subprocess.run(cmd, capture_output=True, text=True)
         info = json.loads(result.stdout)
+        stream = info['streams'][0]
         
-        width = info['streams'][0]['width']
-        height = info['streams'][0]['height']
-        return height > width  # 高度大于宽度即为纵向视频
+        # 旋转角度可能在tags.rotate（旧版，顺时针）或side_data的显示矩阵中（新版，逆时针）
+        rotation = stream.get('tags', {}).get('rotate')
+        for side_data in stream.get('side_data_list', []):
+            if 'rotation' in side_data:
+                rotation = -float(side_data['rotation'])
         
+        duration = stream.get('duration') or info.get('format', {}).get('duration')
+        return {
+            'width': int(stream['width']),
+            'height': int(stream['height']),
+            'rotation': int(float(rotation or 0)) % 360,
+            'duration': float(duration) if duration else None,
+            'codec': stream.get('codec_name')
+        }
     except Exception as e:
         print(f"获取视频尺寸失败: {e}")
+        return None
+
+# ISO-BMFF（MP4/MOV）容器可直接解析文件头，无需启动ffprobe进程
+ISO_BMFF_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+# moov盒子超过该大小时放弃解析，交给ffprobe处理
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+# stsd中的编码标识与ffprobe codec_name的对应关系
+MP4_CODEC_NAMES = {
+    'avc1': 'h264', 'avc3': 'h264',
+    'hvc1': 'hevc', 'hev1': 'hevc',
+    'av01': 'av1', 'vp09': 'vp9', 'vp08': 'vp8',
+    'mp4v': 'mpeg4', 'jpeg': 'mjpeg', 'apcn': 'prores', 'apch': 'prores'
+}
+
+def _iter_boxes(data, start=0, end=None):
+    """遍历内存中的盒子，产出(类型, 内容起始偏移, 内容结束偏移)"""
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield box_type.decode('latin-1'), pos + header, pos + size
+        pos += size
+
+def _find_box(data, path, start=0, end=None):
+    """按路径（如['mdia', 'minf']）查找第一个子盒子，返回内容偏移范围"""
+    for box_type, box_start, box_end in _iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return box_start, box_end
+            return _find_box(data, path[1:], box_start, box_end)
+    return None
+
+def _read_moov(f):
+    """在文件顶层盒子间跳转（seek）定位moov，只读取moov本身"""
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(16)
+        if len(header) < 8:
+            return None
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                return None
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header_size:
+            return None
+        if box_type == b'moov':
+            if size > MAX_MOOV_SIZE:
+                return None
+            f.seek(pos + header_size)
+            return f.read(size - header_size)
+        pos += size
+    return None
+
+def read_mp4_metadata(filepath):
+    """直接解析MP4/MOV文件头（moov/trak/tkhd、mdhd、stsd）获取视频元数据，无法解析时返回None"""
+    try:
+        with open(filepath, 'rb') as f:
+            moov = _read_moov(f)
+        if not moov:
+            return None
+        
+        movie_duration = None
+        mvhd = _find_box(moov, ['mvhd'])
+        if mvhd:
+            version = moov[mvhd[0]]
+            if version == 1:
+                timescale, duration = struct.unpack_from('>IQ', moov, mvhd[0] + 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', moov, mvhd[0] + 12)
+            if timescale:
+                movie_duration = duration / timescale
+        
+        for box_type, trak_start, trak_end in _iter_boxes(moov):
+            if box_type != 'trak':
+                continue
+            hdlr = _find_box(moov, ['mdia', 'hdlr'], trak_start, trak_end)
+            if not hdlr or moov[hdlr[0] + 8:hdlr[0] + 12] != b'vide':
+                continue
+            
+            # tkhd：显示宽高（16.16定点数）和变换矩阵
+            tkhd = _find_box(moov, ['tkhd'], trak_start, trak_end)
+            if not tkhd:
+                return None
+            offset = tkhd[0] + (36 if moov[tkhd[0]] == 1 else 24)
+            offset += 16  # reserved、layer、alternate_group、volume
+            matrix = struct.unpack_from('>9i', moov, offset)
+            width, height = struct.unpack_from('>II', moov, offset + 36)
+            width, height = width >> 16, height >> 16
+            # 矩阵[a b u; c d v; x y w]中a、b决定旋转角度（与旧版ffprobe的rotate标签一致，顺时针）
+            rotation = int(round(math.degrees(math.atan2(matrix[1], matrix[0])))) % 360
+            
+            # stsd：第一个样本描述的编码标识和编码宽高
+            codec = None
+            stsd = _find_box(moov, ['mdia', 'minf', 'stbl', 'stsd'], trak_start, trak_end)
+            if stsd and stsd[1] - stsd[0] >= 44:
+                entry = stsd[0] + 8
+                fourcc = moov[entry + 4:entry + 8].decode('latin-1')
+                codec = MP4_CODEC_NAMES.get(fourcc, fourcc.strip())
+                coded_width, coded_height = struct.unpack_from('>HH', moov, entry + 32)
+                if not width or not height:
+                    width, height = coded_width, coded_height
+            if not width or not height:
+                return None
+            
+            duration = movie_duration
+            mdhd = _find_box(moov, ['mdia', 'mdhd'], trak_start, trak_end)
+            if mdhd:
+                if moov[mdhd[0]] == 1:
+                    timescale, track_duration = struct.unpack_from('>IQ', moov, mdhd[0] + 20)
+                else:
+                    timescale, track_duration = struct.unpack_from('>II', moov, mdhd[0] + 12)
+                if timescale and track_duration:
+                    duration = track_duration / timescale
+            
+            return {
+                'width': width,
+                'height': height,
+                'rotation': rotation,
+                'duration': duration,
+                'codec': codec
+            }
+        return None
+    except (OSError, struct.error, IndexError) as e:
+        print(f"解析MP4文件头失败: {filepath}: {e}")
+        return None
+
+def probe_video_metadata(filepath):
+    """读取视频元数据：MP4/MOV优先解析文件头，其它容器或解析失败时回退到ffprobe"""
+    if filepath.lower().endswith(ISO_BMFF_EXTENSIONS):
+        info = read_mp4_metadata(filepath)
+        if info is not None:
+            return info
+    return ffprobe_video_metadata(filepath)
+
+def _store_probe_info(cached, rel_path, stat_result, info):
+    """将探测结果写入ProbeCache（只在持有数据库会话的线程调用）"""
+    if cached is None:
+        cached = ProbeCache(relpath=rel_path)
+        db.session.add(cached)
+    cached.size = stat_result.st_size
+    cached.mtime_ns = stat_result.st_mtime_ns
+    cached.width = info['width']
+    cached.height = info['height']
+    cached.rotation = info['rotation']
+    cached.duration = info['duration']
+    cached.codec = info['codec']
+    # 旋转90/270度时显示宽高互换，高度大于宽度即为纵向视频
+    if cached.rotation in (90, 270):
+        cached.is_portrait = info['width'] > info['height']
+    else:
+        cached.is_portrait = info['height'] > info['width']
+    cached.probed_at = datetime.utcnow()
+    return cached
+
+def _probe_cache_hit(cached, stat_result):
+    return cached is not None and cached.size == stat_result.st_size and cached.mtime_ns == stat_result.st_mtime_ns
+
+_probe_failed = {}  # 相对路径 -> 探测失败时文件的(大小, 修改时间)，文件变化前不再重复探测
+
+def video_probe(video, commit=True):
+    """已入库视频的探测结果
+    
+    扫描只探测尚未入库的文件，在探测缓存出现之前入库的视频、探测失败后入库的文件没有缓存；
+    没有缓存或文件已变化时在这里按需探测（MP4/MOV只解析文件头）并保存。无法探测时返回已有的缓存或None。
+    commit为False时只加入会话，由调用方随自己的事务提交（如后台任务的断点）。
+    """
+    probe = ProbeCache.query.filter_by(relpath=video.filename).first()
+    video_path = safe_join(app.config['MEDIA_FOLDER'], video.filename)
+    try:
+        stat_result = os.stat(video_path) if video_path else None
+    except OSError:
+        stat_result = None
+    if stat_result is None or _probe_cache_hit(probe, stat_result):
+        return probe
+    version = (stat_result.st_size, stat_result.st_mtime_ns)
+    if _probe_failed.get(video.filename) == version:
+        return probe
+    
+    info = probe_video_metadata(video_path)
+    if info is None:
+        _probe_failed[video.filename] = version
+        return probe
+    probe = _store_probe_info(probe, video.filename, stat_result, info)
+    if commit:
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 其他请求同时探测并写入了同一个文件
+            db.session.rollback()
+            probe = ProbeCache.query.filter_by(relpath=video.filename).first()
+    return probe
+
+def probe_videos(candidates):
+    """并行探测阶段
+    
+    candidates为(完整路径, 相对路径, stat结果或None)的可迭代对象，按SCAN_COMMIT_BATCH分批处理：
+    每批先一次性查询探测缓存，未命中的文件分发到探测线程池执行ffprobe，
+    数据库读写始终在调用线程进行，每批结束后提交一次。
+    依次产出(完整路径, 相对路径, ProbeCache或None)，None表示无法探测。
+    """
+    batch_size = app.config['SCAN_COMMIT_BATCH']
+    with ThreadPoolExecutor(max_workers=app.config['PROBE_WORKERS']) as executor:
+        batch = []
+        for candidate in candidates:
+            batch.append(candidate)
+            if len(batch) >= batch_size:
+                yield from _probe_batch(executor, batch)
+                batch = []
+        if batch:
+            yield from _probe_batch(executor, batch)
+
+def _probe_batch(executor, batch):
+    rel_paths = [rel_path for _, rel_path, _ in batch]
+    cached_map = {p.relpath: p for p in ProbeCache.query.filter(ProbeCache.relpath.in_(rel_paths))}
+    
+    pending = []
+    for full_path, rel_path, stat_result in batch:
+        try:
+            if stat_result is None:
+                stat_result = os.stat(full_path)
+        except OSError as e:
+            print(f"读取视频文件信息失败: {e}")
+            yield full_path, rel_path, None
+            continue
+        cached = cached_map.get(rel_path)
+        if _probe_cache_hit(cached, stat_result):
+            yield full_path, rel_path, cached
+        else:
+            pending.append((full_path, rel_path, stat_result, cached,
+                            executor.submit(probe_video_metadata, full_path)))
+    
+    for full_path, rel_path, stat_result, cached, future in pending:
+        info = future.result()
+        if info is None:
+            yield full_path, rel_path, None
+        else:
+            yield full_path, rel_path, _store_probe_info(cached, rel_path, stat_result, info)
+    
+    db.session.commit()
+
+# 媒体库支持的视频扩展名
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+
+def _join_rel(rel_dir, name):
+    return name if rel_dir == '.' else os.path.join(rel_dir, name)
+
+def in_media_directory(column, rel_dir, recursive=False):
+    """生成"相对路径位于指定目录下"的查询条件，利用路径列上的唯一索引做范围查询"""
+    if rel_dir == '.':
+        return db.true() if recursive else ~column.contains(os.sep)
+    prefix = rel_dir + os.sep
+    # 以"dir/"开头的路径都落在["dir/", "dir0")区间内（'0'是'/'的下一个字符）
+    condition = db.and_(column > prefix, column < rel_dir + chr(ord(os.sep) + 1))
+    if not recursive:
+        condition = db.and_(condition, db.func.instr(db.func.substr(column, len(prefix) + 1), os.sep) == 0)
+    return condition
+
+def iter_media_directories(scope, extensions, incremental=True):
+    """逐个目录遍历媒体库（os.scandir，复用DirEntry缓存的类型和stat信息）
+    
+    产出(相对目录, DirEntry列表)，列表只包含扩展名匹配的文件；已删除的目录产出(相对目录, None)。
+    增量模式下mtime/inode未变化的目录不再列出内容，只根据记录的子目录继续向下检查。
+    目录指纹在遍历结束后才写入会话，随调用方最后一批数据一起提交，扫描中断时下次会重新扫描。
+    """
+    media_dir = app.config['MEDIA_FOLDER']
+    known = {d.path: d for d in ScanDirectory.query.filter_by(scope=scope)}
+    visited = set()
+    scanned = []
+    stack = ['.']
+    
+    while stack:
+        rel_dir = stack.pop()
+        full_dir = media_dir if rel_dir == '.' else os.path.join(media_dir, rel_dir)
+        try:
+            dir_stat = os.stat(full_dir)
+        except OSError:
+            continue
+        visited.add(rel_dir)
+        
+        state = known.get(rel_dir)
+        if incremental and state and state.mtime_ns == dir_stat.st_mtime_ns and state.inode == dir_stat.st_ino:
+            # 目录未变化：文件列表不变，只需检查子目录
+            stack.extend(_join_rel(rel_dir, name) for name in json.loads(state.subdirs))
+            continue
+        
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(full_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            # 与os.walk一致，不进入符号链接目录
+                            if not entry.is_symlink():
+                                subdirs.append(entry.name)
+                        elif entry.name.lower().endswith(extensions) and entry.is_file():
+                            files.append(entry)
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"❌ 扫描目录失败: {full_dir}: {e}")
+            if state:
+                stack.extend(_join_rel(rel_dir, name) for name in json.loads(state.subdirs))
+            continue
+        
+        scanned.append((rel_dir, dir_stat, sorted(subdirs)))
+        stack.extend(_join_rel(rel_dir, name) for name in sorted(subdirs, reverse=True))
+        yield rel_dir, files
+    
+    for rel_dir, state in known.items():
+        if rel_dir not in visited:
+            db.session.delete(state)
+            yield rel_dir, None
+    
+    # 遍历完成后再记录目录指纹
+    for rel_dir, dir_stat, subdirs in scanned:
+        state = known.get(rel_dir)
+        if state is None:
+            state = ScanDirectory(scope=scope, path=rel_dir)
+            db.session.add(state)
+        state.mtime_ns = dir_stat.st_mtime_ns
+        state.inode = dir_stat.st_ino
+        state.subdirs = json.dumps(subdirs, ensure_ascii=False)
+        state.scanned_at = datetime.utcnow()
+
+# 扫描结果中最多返回的新增/删除文件明细数
+SCAN_REPORT_LIMIT = 1000
+
+def _discover_stage(stats, incremental):
+    """发现阶段：逐个有变化的目录对比文件系统与数据库，清理失效记录，产出(相对路径, DirEntry)"""
+    for rel_dir, entries in iter_media_directories('library', VIDEO_EXTENSIONS, incremental):
+        if entries is None:
+            # 目录已被删除，清理该目录树下的所有记录
+            print(f"🗑️ 目录已删除: {rel_dir}")
+            for video in Video.query.filter(in_media_directory(Video.filename, rel_dir, recursive=True)).yield_per(1000):
+                _record_removed(stats, video)
+            ProbeCache.query.filter(in_media_directory(ProbeCache.relpath, rel_dir, recursive=True))\
+                .delete(synchronize_session=False)
+            continue
+        
+        stats['scanned_dirs'] += 1
+        stats['files_found'] += len(entries)
+        file_system_files = {_join_rel(rel_dir, entry.name): entry for entry in entries}
+        
+        # 删除数据库中不存在对应文件的记录（只查询当前目录下的记录）
+        existing_files = set()
+        for video in Video.query.filter(in_media_directory(Video.filename, rel_dir)).yield_per(1000):
+            if video.filename in file_system_files:
+                existing_files.add(video.filename)
+            else:
+                _record_removed(stats, video)
+        stats['unchanged'] += len(existing_files)
+        
+        # 清理已不存在文件的探测缓存
+        for probe in ProbeCache.query.filter(in_media_directory(ProbeCache.relpath, rel_dir)).yield_per(1000):
+            if probe.relpath not in file_system_files:
+                db.session.delete(probe)
+        
+        for rel_path, entry in file_system_files.items():
+            if rel_path not in existing_files:
+                yield rel_path, entry
+
+def _record_removed(stats, video):
+    print(f"🗑️ 删除数据库中不存在的文件记录: {video.filename}")
+    db.session.delete(video)
+    stats['removed'] += 1
+    if len(stats['removed_files']) < SCAN_REPORT_LIMIT:
+        stats['removed_files'].append(video.filename)
+
+def _stat_stage(discovered):
+    """stat阶段：复用DirEntry的stat结果，产出(完整路径, 相对路径, stat结果)"""
+    for rel_path, entry in discovered:
+        try:
+            yield entry.path, rel_path, entry.stat()
+        except OSError as e:
+            print(f"读取视频文件信息失败: {e}")
+
+def _persist_stage(stats, probed):
+    """入库阶段：纵向视频写入Video表，随探测批次分批提交"""
+    for full_path, rel_path, probe in probed:
         # 如果ffprobe不可用或视频无法读取，默认接受该视频
-        return True
+        if probe is None or probe.is_portrait:
+            db.session.add(Video(filename=rel_path, filepath=full_path))
+            print(f"💾 添加新增视频到数据库: {rel_path}")
+            stats['added'] += 1
+            if len(stats['added_files']) < SCAN_REPORT_LIMIT:
+                stats['added_files'].append(rel_path)
+        else:
+            stats['skipped'] += 1
 
-def scan_media_folder():
-    """递归扫描媒体文件夹及其子目录并更新数据库"""
-    existing_files = {v.filename: v for v in Video.query.all()}
-    current_files = set()
-    
-    # 递归扫描所有子目录
-    for root, dirs, files in os.walk(app.config['MEDIA_FOLDER']):
-        for filename in files:
-            if filename.endswith('.mp4'):
-                filepath = os.path.join(root, filename)
-                # 只处理相对路径，保持文件名唯一性
-                rel_path = os.path.relpath(filepath, app.config['MEDIA_FOLDER'])
-                if rel_path not in existing_files and is_portrait_video(filepath):
-                    video = Video(filename=rel_path, filepath=filepath)
-                    db.session.add(video)
-                    current_files.add(rel_path)
+def scan_media_folder(incremental=True):
+    """扫描媒体库并同步数据库（启动、/api/scan、/api/admin/refresh-files共用）
+    
+    以生成器流水线实现：发现 → stat → 探测 → 入库，各阶段逐条传递，
+    探测按批并行执行并分批提交，内存占用只与单个目录的文件数有关。
+    默认增量扫描，只处理mtime/inode有变化的目录。返回扫描统计信息。
+    """
+    stats = {
+        'incremental': incremental,
+        'scanned_dirs': 0,
+        'files_found': 0,
+        'added': 0,
+        'removed': 0,
+        'unchanged': 0,
+        'skipped': 0,
+        'added_files': [],
+        'removed_files': []
+    }
     
+    discovered = _discover_stage(stats, incremental)
+    _persist_stage(stats, probe_videos(_stat_stage(discovered)))
+    if stats['added'] or stats['removed']:
+        bump_library_version()
     db.session.commit()
-    update_next_ids()
+    return stats
 
-def update_next_ids():
-    """更新视频的next_id关系"""
-    videos = Video.query.order_by(Video.id).all()
-    for i in range(len(videos)-1):
-        videos[i].next_id = videos[i+1].id
+def ingest_media_paths(rel_paths):
+    """按路径同步数据库（文件监听使用），代价只与路径数有关
+    
+    存在的新文件经过与扫描相同的探测、入库阶段，已不存在的文件删除记录和探测缓存。返回统计信息。
+    """
+    stats = {
+        'added': 0,
+        'removed': 0,
+        'skipped': 0,
+        'added_files': [],
+        'removed_files': []
+    }
+    media_dir = app.config['MEDIA_FOLDER']
+    present = {}
+    missing = []
+    for rel_path in sorted(set(rel_paths)):
+        full_path = os.path.join(media_dir, rel_path)
+        try:
+            stat_result = os.stat(full_path)
+        except OSError:
+            missing.append(rel_path)
+            continue
+        if stat.S_ISREG(stat_result.st_mode):
+            present[rel_path] = (full_path, stat_result)
+    
+    for start in range(0, len(missing), SEQUENCE_CHUNK):
+        chunk = missing[start:start + SEQUENCE_CHUNK]
+        for video in Video.query.filter(Video.filename.in_(chunk)):
+            _record_removed(stats, video)
+        ProbeCache.query.filter(ProbeCache.relpath.in_(chunk)).delete(synchronize_session=False)
+    
+    existing = set()
+    paths = list(present)
+    for start in range(0, len(paths), SEQUENCE_CHUNK):
+        existing.update(filename for filename, in db.session.query(Video.filename)
+                        .filter(Video.filename.in_(paths[start:start + SEQUENCE_CHUNK])))
+    candidates = [(full_path, rel_path, stat_result)
+                  for rel_path, (full_path, stat_result) in present.items() if rel_path not in existing]
+    _persist_stage(stats, probe_videos(candidates))
+    
+    if stats['added'] or stats['removed']:
+        bump_library_version()
     db.session.commit()
+    return stats
 
+class InotifySource:
+    """通过inotify（ctypes调用libc）监听媒体库目录树，产出(类型, 相对路径)事件
+    
+    类型为file（视频文件新建/写完/移入/移出/删除）、dir（目录新建/移入/移出/删除）、
+    overflow（内核事件队列溢出，需要全量核对）。新目录会自动加入监听。
+    """
+    
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+    
+    def __init__(self, media_dir):
+        self.media_dir = media_dir
+        # 从已加载的进程符号中查找（glibc和Alpine的musl都适用，musl上find_library找不到libc）
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1失败')
+        self._dirs = {}  # wd -> 相对目录
+        self._watch_tree('.', strict=True)
+    
+    def _add_watch(self, rel_dir, strict=False):
+        full_dir = self.media_dir if rel_dir == '.' else os.path.join(self.media_dir, rel_dir)
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(full_dir), self.WATCH_MASK)
+        if wd < 0:
+            error = OSError(ctypes.get_errno(), f'无法监听目录: {full_dir}')
+            if strict:
+                raise error
+            print(f"⚠️ {error}")
+            return
+        self._dirs[wd] = rel_dir
+    
+    def _watch_tree(self, rel_dir, strict=False):
+        """监听目录及其所有子目录（与扫描一致，不进入符号链接目录）"""
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            self._add_watch(current, strict)
+            full_dir = self.media_dir if current == '.' else os.path.join(self.media_dir, current)
+            try:
+                with os.scandir(full_dir) as entries:
+                    stack.extend(_join_rel(current, entry.name) for entry in entries
+                                 if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+    
+    def _unwatch_tree(self, rel_dir):
+        prefix = rel_dir + os.sep
+        for wd, path in list(self._dirs.items()):
+            if path == rel_dir or path.startswith(prefix):
+                del self._dirs[wd]
+                self._libc.inotify_rm_watch(self._fd, wd)
+    
+    def read(self, timeout):
+        """等待最多timeout秒，返回这段时间内的事件列表"""
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self._fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            
+            if mask & self.IN_Q_OVERFLOW:
+                events.append(('overflow', None))
+                continue
+            if mask & self.IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            rel_dir = self._dirs.get(wd)
+            if rel_dir is None or not name:
+                continue
+            rel_path = _join_rel(rel_dir, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_MOVED_FROM | self.IN_DELETE):
+                    self._unwatch_tree(rel_path)
+                elif mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._watch_tree(rel_path)
+                events.append(('dir', rel_path))
+            elif name.lower().endswith(VIDEO_EXTENSIONS):
+                events.append(('file', rel_path))
+        return events
+    
+    def close(self):
+        os.close(self._fd)
 
+class PollingSource:
+    """轮询方式监听媒体库（网络挂载等不支持inotify的文件系统），事件格式与InotifySource相同
+    
+    内存中记录每个目录的mtime/inode和文件名，只重新列出有变化的目录；第一次轮询只建立基线。
+    """
+    
+    def __init__(self, media_dir, interval):
+        self.media_dir = media_dir
+        self.interval = interval
+        self._dirs = {}  # 相对目录 -> (mtime_ns, inode, 子目录集合, 视频文件名集合)
+        self._polled_at = 0
+        self._poll()
+    
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        now = time.monotonic()
+        if now - self._polled_at < self.interval:
+            return []
+        return self._poll()
+    
+    def _poll(self):
+        self._polled_at = time.monotonic()
+        baseline = not self._dirs
+        events = []
+        visited = set()
+        stack = ['.']
+        while stack:
+            rel_dir = stack.pop()
+            full_dir = self.media_dir if rel_dir == '.' else os.path.join(self.media_dir, rel_dir)
+            try:
+                dir_stat = os.stat(full_dir)
+            except OSError:
+                continue
+            visited.add(rel_dir)
+            known = self._dirs.get(rel_dir)
+            if known and known[0] == dir_stat.st_mtime_ns and known[1] == dir_stat.st_ino:
+                stack.extend(_join_rel(rel_dir, name) for name in known[2])
+                continue
+            
+            subdirs, files = set(), set()
+            try:
+                with os.scandir(full_dir) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.add(entry.name)
+                            elif entry.name.lower().endswith(VIDEO_EXTENSIONS):
+                                files.add(entry.name)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            if known:
+                events.extend(('file', _join_rel(rel_dir, name)) for name in files ^ known[3])
+            elif not baseline:
+                events.append(('dir', rel_dir))
+            self._dirs[rel_dir] = (dir_stat.st_mtime_ns, dir_stat.st_ino, subdirs, files)
+            stack.extend(_join_rel(rel_dir, name) for name in subdirs)
+        
+        for rel_dir in list(self._dirs):
+            if rel_dir not in visited:
+                del self._dirs[rel_dir]
+                events.append(('dir', rel_dir))
+        return events
+    
+    def close(self):
+        pass
+
+class MediaWatcher:
+    """文件监听入库服务
+    
+    新建、写入、移入的文件等到大小和mtime保持MEDIA_WATCH_SETTLE_SECONDS秒不变（写入完成）后入库；
+    删除、移出的文件立即删除记录。目录级事件展开为目录下的文件，事件队列溢出时执行一次增量扫描。
+    同一时间只有持有监听锁的一个进程运行，该进程退出后由其他进程接管。
+    """
+    
+    LOCK_RETRY_SECONDS = 30
+    
+    def __init__(self, mode, settle, poll_interval):
+        self.mode = mode
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self._settling = {}  # 相对路径 -> (大小, mtime_ns, 开始稳定的时间)
+        self._ready = set()
+        self._dirs = set()
+        self._rescan = False
+    
+    def start(self):
+        threading.Thread(target=self._run, name='media-watcher', daemon=True).start()
+    
+    def _run(self):
+        # 进程存活期间一直持有锁（文件对象不关闭）
+        lock_file = open(DATABASE_PATH + '.watch.lock', 'a')
+        while fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                time.sleep(self.LOCK_RETRY_SECONDS)
+        
+        source = self._open_source()
+        print(f"👀 文件监听已启动（{type(source).__name__}）: {app.config['MEDIA_FOLDER']}")
+        while True:
+            try:
+                for kind, rel_path in source.read(timeout=min(1.0, self.settle)):
+                    if kind == 'file':
+                        self._settling.setdefault(rel_path, (None, None, 0))
+                    elif kind == 'dir':
+                        self._dirs.add(rel_path)
+                    else:
+                        self._rescan = True
+                self._tick()
+            except Exception as e:
+                print(f"❌ 文件监听处理失败: {e}")
+                print(f"🔍 详细错误信息: {traceback.format_exc()}")
+                time.sleep(1)
+    
+    def _open_source(self):
+        media_dir = app.config['MEDIA_FOLDER']
+        if self.mode in ('auto', 'inotify'):
+            try:
+                return InotifySource(media_dir)
+            except (OSError, AttributeError) as e:
+                print(f"⚠️ inotify不可用，改用轮询: {e}")
+        return PollingSource(media_dir, self.poll_interval)
+    
+    def _tick(self):
+        if not (self._rescan or self._dirs or self._settling or self._ready):
+            return
+        with app.app_context():
+            if self._rescan:
+                self._rescan = False
+                stats = scan_media_folder()
+                print(f"🔄 文件监听事件溢出，增量扫描完成: 新增 {stats['added']}，删除 {stats['removed']}")
+            
+            # 目录级事件：仍存在的目录展开为其中的视频文件，已不存在的目录展开为数据库中该目录下的记录
+            while self._dirs:
+                rel_dir = self._dirs.pop()
+                full_dir = os.path.join(app.config['MEDIA_FOLDER'], rel_dir)
+                if os.path.isdir(full_dir):
+                    for root, _, files in os.walk(full_dir):
+                        for name in files:
+                            if name.lower().endswith(VIDEO_EXTENSIONS):
+                                rel_path = os.path.relpath(os.path.join(root, name), app.config['MEDIA_FOLDER'])
+                                self._settling.setdefault(rel_path, (None, None, 0))
+                else:
+                    self._ready.update(filename for filename, in db.session.query(Video.filename)
+                                       .filter(in_media_directory(Video.filename, rel_dir, recursive=True)))
+            
+            now = time.monotonic()
+            for rel_path, (size, mtime_ns, since) in list(self._settling.items()):
+                try:
+                    stat_result = os.stat(os.path.join(app.config['MEDIA_FOLDER'], rel_path))
+                except OSError:
+                    del self._settling[rel_path]
+                    self._ready.add(rel_path)
+                    continue
+                current = (stat_result.st_size, stat_result.st_mtime_ns)
+                if current != (size, mtime_ns):
+                    self._settling[rel_path] = current + (now,)
+                elif now - since >= self.settle:
+                    del self._settling[rel_path]
+                    self._ready.add(rel_path)
+            
+            if not self._ready:
+                return
+            batch, self._ready = self._ready, set()
+            try:
+                stats = ingest_media_paths(batch)
+            except Exception:
+                db.session.rollback()
+                # 下一轮重新处理（例如扫描进程同时写入了同一文件）
+                self._ready.update(batch)
+                raise
+            if stats['added'] or stats['removed']:
+                print(f"📥 文件监听入库: 新增 {stats['added']}，删除 {stats['removed']}")
+
+def start_media_watcher():
+    """启动文件监听入库服务（MEDIA_WATCH=off时不启动）"""
+    if app.config['MEDIA_WATCH'] == 'off':
+        return
+    MediaWatcher(app.config['MEDIA_WATCH'], app.config['MEDIA_WATCH_SETTLE_SECONDS'],
+                 app.config['MEDIA_WATCH_POLL_INTERVAL']).start()
+
+BUMP_COUNTER_SQL = db.text(
+    "INSERT INTO app_meta (key, value) VALUES (:key, 1) "
+    "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+)
+
+def read_counter(key):
+    """读取计数器（直接查询数据库，不使用会话中缓存的对象）"""
+    return db.session.execute(db.select(AppMeta.value).where(AppMeta.key == key)).scalar() or 0
+
+def read_counters(keys):
+    """一次查询读取多个计数器，按keys的顺序返回"""
+    values = dict(db.session.execute(db.select(AppMeta.key, AppMeta.value).where(AppMeta.key.in_(keys))).all())
+    return tuple(values.get(key, 0) for key in keys)
+
+def bump_counter(key):
+    """递增计数器（随调用方的事务一起提交）"""
+    db.session.execute(BUMP_COUNTER_SQL, {'key': key})
+
+def library_version():
+    """媒体库版本号：视频增删时递增，用于判断进程内缓存是否失效"""
+    return read_counter('library_version')
+
+def bump_library_version():
+    bump_counter('library_version')
+
+def bump_dislike_version(user_id):
+    """用户的讨厌列表有变化时递增，使该用户的排除集合缓存失效"""
+    bump_counter(f'dislike_version:{user_id}')
+
+def bump_favorite_version(user_id):
+    """用户的收藏列表有变化时递增，使该用户的列表响应缓存失效"""
+    bump_counter(f'favorite_version:{user_id}')
+
+def bump_thumbnail_version():
+    """缩略图URL出现在所有列表响应中，生成或更换缩略图时递增，使列表响应缓存失效"""
+    bump_counter('thumbnail_version')
+
+@event.listens_for(Video, 'after_update')
+def _thumbnail_version_touch(mapper, connection, video):
+    # 通过ORM修改缩略图时自动递增缩略图版本（在同一事务中）；Query.update()等批量更新不会触发，需调用bump_thumbnail_version()
+    attrs = db.inspect(video).attrs
+    if attrs.thumbnail_hash.history.has_changes() or attrs.thumbnail_path.history.has_changes():
+        connection.execute(BUMP_COUNTER_SQL, {'key': 'thumbnail_version'})
+
+# 播放序列：按ID升序，每个视频的next_id指向下一个视频（最后一个为空）。
+# 视频增删时记录改动的ID，提交前只重新计算受影响的视频（改动的视频本身及其前驱）
+SEQUENCE_RELINK_SQL = 'UPDATE video SET next_id = (SELECT MIN(n.id) FROM video AS n WHERE n.id > video.id)'
+SEQUENCE_CHUNK = 500
+
+@event.listens_for(Video, 'after_insert')
+@event.listens_for(Video, 'after_delete')
+def _sequence_touch(mapper, connection, video):
+    object_session(video).info.setdefault('sequence_touched', set()).add(video.id)
+
+@event.listens_for(Session, 'before_commit')
+def _sequence_before_commit(session):
+    if not session.info.get('sequence_touched') and \
+            not any(isinstance(obj, Video) for obj in list(session.new) + list(session.deleted)):
+        return
+    session.flush()
+    relink_sequence(session, session.info.pop('sequence_touched', set()))
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _sequence_rollback(session, previous_transaction):
+    session.info.pop('sequence_touched', None)
+
+def relink_sequence(session, touched_ids):
+    """重新计算受影响视频的next_id：每个视频一次主键定位，不扫描整张表"""
+    touched = sorted(touched_ids)
+    rows = set()
+    for start in range(0, len(touched), SEQUENCE_CHUNK):
+        chunk = touched[start:start + SEQUENCE_CHUNK]
+        rows.update(session.execute(db.select(Video.id).where(Video.id.in_(chunk))).scalars())
+    
+    # 前驱：连续新增的ID前驱就是前一个ID，只有每段的第一个需要查询
+    for video_id in touched:
+        if video_id - 1 in rows:
+            continue
+        prev_id = session.execute(db.select(db.func.max(Video.id)).where(Video.id < video_id)).scalar()
+        if prev_id is not None:
+            rows.add(prev_id)
+    
+    rows = sorted(rows)
+    statement = db.text(SEQUENCE_RELINK_SQL + ' WHERE id IN :ids').bindparams(db.bindparam('ids', expanding=True))
+    for start in range(0, len(rows), SEQUENCE_CHUNK):
+        session.execute(statement, {'ids': rows[start:start + SEQUENCE_CHUNK]})
+
+def sequence_prev(video_id):
+    """播放序列中的前一个视频：按next_id索引反查（视频已不存在时按ID范围查找）"""
+    prev_video = Video.query.filter_by(next_id=video_id).first()
+    if prev_video is None and db.session.get(Video, video_id) is None:
+        prev_video = Video.query.filter(Video.id < video_id).order_by(Video.id.desc()).first()
+    return prev_video
+
+def sequence_last():
+    """播放序列中的最后一个视频（循环播放时第一个视频的前一个）"""
+    return Video.query.order_by(Video.id.desc()).first()
 
 @app.route('/api/videos/<int:video_id>')
 def get_video_info(video_id):
     """获取视频信息(包含下一个视频ID)"""
     video = Video.query.get_or_404(video_id)
     
-    # 查找下一个视频（按ID顺序，更小的ID在前）
-    next_video = Video.query.filter(Video.id > video_id).order_by(Video.id.asc()).first()
-    next_id = next_video.id if next_video else None
-    
     return jsonify({
         'id': video.id,
         'filename': video.filename,
         'url': f'/api/videos/file/{video.filename}',
-        'next_id': next_id
+        'hls_url': hls_url(video),
+        'next_id': video.next_id
     })
 
 @app.route('/api/videos/prev/<int:video_id>')
 def get_prev_video(video_id):
     """获取前一个视频信息"""
     # 查找前一个视频（按ID顺序，更大的ID在前）
-    prev_video = Video.query.filter(Video.id < video_id).order_by(Video.id.desc()).first()
+    prev_video = sequence_prev(video_id)
     
     if prev_video:
         return jsonify({
@@ -180,7 +1244,7 @@ def get_prev_video(video_id):
         })
     else:
         # 如果没有前一个视频，返回最大的ID视频（循环播放）
-        last_video = Video.query.order_by(Video.id.desc()).first()
+        last_video = sequence_last()
         if last_video:
             return jsonify({
                 'id': last_video.id,
@@ -192,14 +1256,215 @@ def get_prev_video(video_id):
 
 @app.route('/api/videos/file/<path:filename>')
 def get_video_file(filename):
-    """获取视频文件（支持子目录）"""
-    video_path = os.path.join(app.config['MEDIA_FOLDER'], filename)
-    if os.path.exists(video_path):
-        # 从完整路径中提取目录和文件名
-        dirname = os.path.dirname(video_path)
-        basename = os.path.basename(video_path)
-        return send_from_directory(dirname, basename)
-    return jsonify({'error': 'Video not found'}), 404
+    """获取视频文件（支持子目录）
+    
+    后端只校验路径，VIDEO_SERVING为x-accel/x-sendfile时文件内容由前端代理发送，不占用后端worker。
+    """
+    # 防止路径越出媒体目录
+    video_path = safe_join(app.config['MEDIA_FOLDER'], filename)
+    if not video_path or not os.path.isfile(video_path):
+        return jsonify({'error': 'Video not found'}), 404
+    
+    serving = app.config['VIDEO_SERVING']
+    if serving in ('x-accel', 'x-sendfile'):
+        response = Response(mimetype=mimetypes.guess_type(video_path)[0] or 'application/octet-stream')
+        if serving == 'x-accel':
+            rel_path = os.path.relpath(video_path, app.config['MEDIA_FOLDER']).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = app.config['VIDEO_ACCEL_PREFIX'] + quote(rel_path)
+        else:
+            # mod_xsendfile和lighttpd都会对路径做URL解码（响应头只能是latin-1字符）
+            response.headers['X-Sendfile'] = quote(os.path.abspath(video_path))
+        return response
+    
+    # 从完整路径中提取目录和文件名
+    dirname = os.path.dirname(video_path)
+    basename = os.path.basename(video_path)
+    return send_from_directory(dirname, basename)
+
+# HLS：首次请求时把视频转封装（-c copy，不转码）为短分片，播放列表随分片生成逐步增长，
+# 第一个分片生成后即可开始播放。分片按视频缓存在磁盘上，总大小超过上限时按最近访问时间淘汰整个视频的分片。
+# 只封装H.264：Safari不播放MPEG-TS分片中的HEVC，HEVC视频直接使用文件地址播放
+HLS_CODECS = ('h264',)
+HLS_SEGMENT_NAME = re.compile(r'^seg\d{5}\.ts$')
+_hls_executor = ThreadPoolExecutor(max_workers=app.config['HLS_CONCURRENCY'], thread_name_prefix='hls')
+_hls_lock = threading.Lock()
+_hls_inflight = {}  # 分片目录 -> 正在转封装的Future
+_hls_failed = {}  # 分片目录 -> 最近一次转封装失败的时间
+
+def hls_url(video):
+    """视频的HLS播放列表URL；未开启HLS或编码无法探测、不是H.264时为None"""
+    if not app.config['HLS_ENABLED']:
+        return None
+    probe = video_probe(video)
+    if not probe or probe.codec not in HLS_CODECS:
+        return None
+    return f'/api/videos/{video.id}/hls/index.m3u8'
+
+def hls_cache_dir(video, stat_result):
+    """视频的分片目录，文件大小或修改时间变化后使用新目录（旧目录由LRU淘汰）"""
+    key = hashlib.sha1(f'{video.filename}:{stat_result.st_size}:{stat_result.st_mtime_ns}'.encode()).hexdigest()[:16]
+    return os.path.join(app.config['HLS_CACHE_FOLDER'], f'{video.id}-{key}')
+
+def _package_hls_task(video_path, cache_dir):
+    """转封装为HLS分片，完成后写入.complete标记；文件锁保证多个进程中同一视频只转封装一次"""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_dir + '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            marker = os.path.join(cache_dir, '.complete')
+            if os.path.exists(marker):
+                return True
+            cmd = [
+                'ffmpeg', '-v', 'error', '-y',
+                '-i', video_path,
+                '-map', '0:v:0', '-map', '0:a:0?',
+                '-c', 'copy',
+                '-f', 'hls',
+                '-hls_time', str(app.config['HLS_SEGMENT_SECONDS']),
+                '-hls_playlist_type', 'event',
+                # 分片写完后才重命名为正式文件名，播放列表只包含已完成的分片
+                '-hls_flags', 'temp_file+independent_segments',
+                '-hls_segment_filename', os.path.join(cache_dir, 'seg%05d.ts'),
+                os.path.join(cache_dir, 'index.m3u8')
+            ]
+            subprocess.run(cmd, check=True, capture_output=True)
+            open(marker, 'w').close()
+        _hls_failed.pop(cache_dir, None)
+        evict_hls_cache()
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"HLS转封装失败: {video_path}: {e.stderr.decode(errors='replace').strip()}")
+        _hls_failed[cache_dir] = time.time()
+    except OSError as e:
+        print(f"HLS转封装失败: {video_path}: {e}")
+        _hls_failed[cache_dir] = time.time()
+    finally:
+        with _hls_lock:
+            _hls_inflight.pop(cache_dir, None)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    with contextlib.suppress(OSError):
+        os.remove(cache_dir + '.lock')
+    return False
+
+def request_hls_package(video_path, cache_dir):
+    """开始转封装，同一视频已在转封装时返回同一个Future；HLS_RETRY_SECONDS内失败过时返回结果为False的Future，不再启动ffmpeg"""
+    with _hls_lock:
+        future = _hls_inflight.get(cache_dir)
+        failed_at = _hls_failed.get(cache_dir)
+        if future is None and failed_at and time.time() - failed_at < app.config['HLS_RETRY_SECONDS']:
+            future = Future()
+            future.set_result(False)
+        elif future is None:
+            future = _hls_executor.submit(_package_hls_task, video_path, cache_dir)
+            _hls_inflight[cache_dir] = future
+    return future
+
+def evict_hls_cache():
+    """分片缓存总大小超过HLS_CACHE_SIZE时，按最近访问时间删除已完成转封装的视频分片目录"""
+    folder = app.config['HLS_CACHE_FOLDER']
+    total = 0
+    completed = []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    with os.scandir(entry.path) as files:
+                        size = sum(f.stat().st_size for f in files if f.is_file())
+                    accessed = os.stat(os.path.join(entry.path, '.complete')).st_mtime
+                except OSError:
+                    # 正在转封装的目录不淘汰
+                    continue
+                total += size
+                completed.append((accessed, size, entry.path))
+    except FileNotFoundError:
+        return
+    for accessed, size, path in sorted(completed):
+        if total <= app.config['HLS_CACHE_SIZE']:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        with contextlib.suppress(OSError):
+            os.remove(path + '.lock')
+        total -= size
+
+def _wait_for_hls_file(path, future, timeout):
+    """等待转封装生成指定文件，转封装结束或超时仍不存在时返回False"""
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if future.done():
+            return os.path.exists(path)
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def _hls_source(video_id):
+    """HLS请求对应的(视频, 文件路径, stat结果)，不能提供HLS时返回(None, 错误响应)"""
+    if not app.config['HLS_ENABLED']:
+        return None, (jsonify({'error': 'HLS未开启'}), 404)
+    video = db.session.get(Video, video_id)
+    video_path = safe_join(app.config['MEDIA_FOLDER'], video.filename) if video else None
+    if not video_path or not os.path.isfile(video_path):
+        return None, (jsonify({'error': 'Video not found'}), 404)
+    if hls_url(video) is None:
+        return None, (jsonify({'error': '该视频编码不支持HLS，请使用url播放'}), 415)
+    return (video, video_path, os.stat(video_path)), None
+
+@app.route('/api/videos/<int:video_id>/hls/index.m3u8')
+def get_hls_playlist(video_id):
+    """HLS播放列表：首次请求时开始转封装，第一个分片生成后立即返回（EVENT类型，转封装完成后带ENDLIST）"""
+    source, error = _hls_source(video_id)
+    if error:
+        return error
+    video, video_path, stat_result = source
+    cache_dir = hls_cache_dir(video, stat_result)
+    marker = os.path.join(cache_dir, '.complete')
+    
+    if os.path.exists(marker):
+        # 记录访问时间，供LRU淘汰使用
+        with contextlib.suppress(OSError):
+            os.utime(marker)
+    else:
+        future = request_hls_package(video_path, cache_dir)
+        if not _wait_for_hls_file(os.path.join(cache_dir, 'index.m3u8'), future, app.config['HLS_WAIT_SECONDS']):
+            if future.done():
+                return jsonify({'error': 'HLS转封装失败'}), 500
+            return jsonify({'status': 'pending', 'message': 'HLS分片生成中'}), 202, {'Retry-After': '1'}
+    
+    return send_from_directory(cache_dir, 'index.m3u8', mimetype='application/vnd.apple.mpegurl')
+
+@app.route('/api/videos/<int:video_id>/hls/<segment>')
+def get_hls_segment(video_id, segment):
+    """HLS分片：尚未生成时等待转封装，缓存已被淘汰时重新转封装"""
+    if not HLS_SEGMENT_NAME.match(segment):
+        return jsonify({'error': 'Segment not found'}), 404
+    source, error = _hls_source(video_id)
+    if error:
+        return error
+    video, video_path, stat_result = source
+    cache_dir = hls_cache_dir(video, stat_result)
+    
+    if not os.path.exists(os.path.join(cache_dir, segment)):
+        if os.path.exists(os.path.join(cache_dir, '.complete')):
+            return jsonify({'error': 'Segment not found'}), 404
+        future = request_hls_package(video_path, cache_dir)
+        if not _wait_for_hls_file(os.path.join(cache_dir, segment), future, app.config['HLS_WAIT_SECONDS']):
+            return jsonify({'error': 'Segment not found'}), 404
+    
+    return send_from_directory(cache_dir, segment, mimetype='video/mp2t')
+
+def hls_segment_file(video_id, segment):
+    """已生成的HLS分片路径，分片尚未生成或不能提供HLS时返回None（异步媒体服务直接发送已生成的分片，其余交给get_hls_segment）"""
+    if not HLS_SEGMENT_NAME.match(segment):
+        return None
+    source, error = _hls_source(video_id)
+    if error:
+        return None
+    video, video_path, stat_result = source
+    segment_path = os.path.join(hls_cache_dir(video, stat_result), segment)
+    return segment_path if os.path.isfile(segment_path) else None
 
 @app.route('/thumbnails/<filename>')
 def serve_thumbnail(filename):
@@ -208,31 +1473,136 @@ def serve_thumbnail(filename):
 
 @app.route('/api/thumbnails/<filename>')
 def serve_thumbnail_api(filename):
-    """通过API路径提供缩略图静态文件访问"""
-    return send_from_directory(app.config['THUMBNAIL_FOLDER'], filename)
+    """通过API路径提供缩略图静态文件访问（支持?w=和Accept选择尺寸/格式变体）
+    
+    <哈希>.jpg形式的文件名指向内容寻址存储，内容永不变化，按immutable长期缓存。
+    """
+    resolved = resolve_thumbnail_filename(filename)
+    if resolved is None:
+        return jsonify({'error': 'Thumbnail not found'}), 404
+    return send_thumbnail(*resolved)
+
+def resolve_thumbnail_filename(filename):
+    """/api/thumbnails/<filename>对应的(缩略图路径, 是否不可变)，路径越出缩略图目录时返回None"""
+    match = THUMBNAIL_HASH_FILENAME.match(filename)
+    if match:
+        return thumbnail_store_path(match.group(1)), True
+    thumbnail_path = safe_join(app.config['THUMBNAIL_FOLDER'], filename)
+    if thumbnail_path is None:
+        return None
+    return thumbnail_path, False
 
 @app.route('/api/scan', methods=['POST'])
 def scan_videos():
-    """手动触发扫描媒体文件夹"""
-    scan_media_folder()
-    return jsonify({'status': 'success'})
+    """手动触发扫描媒体文件夹（默认增量扫描，full=true时全量扫描）"""
+    incremental = request.args.get('full', 'false').lower() != 'true'
+    stats = scan_media_folder(incremental)
+    return jsonify({
+        'status': 'success',
+        'videos_added': stats['added'],
+        'records_removed': stats['removed']
+    })
+
+
+
+# 所有缩略图ffmpeg调用（按需生成、后台任务）共享的并发上限：进程内用信号量排队，
+# 进程之间通过数据库目录下的槽位文件锁（videos.db.ffmpeg<序号>.lock），多个worker合计不超过上限
+_ffmpeg_slots = threading.BoundedSemaphore(app.config['THUMBNAIL_CONCURRENCY'])
 
+@contextlib.contextmanager
+def ffmpeg_slot():
+    """占用一个ffmpeg槽位，所有进程的槽位都被占用时等待"""
+    with _ffmpeg_slots:
+        if not fcntl:
+            yield
+            return
+        while True:
+            for index in range(app.config['THUMBNAIL_CONCURRENCY']):
+                lock_file = open(f'{DATABASE_PATH}.ffmpeg{index}.lock', 'a')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    continue
+                # 关闭文件即释放锁，进程退出时也会自动释放
+                with lock_file:
+                    yield
+                return
+            time.sleep(0.05)
 
+# 缩略图格式：文件扩展名、MIME类型和ffmpeg编码参数
+THUMBNAIL_FORMATS = {
+    'avif': {'ext': 'avif', 'mimetype': 'image/avif',
+             'codec': ['-c:v', 'libaom-av1', '-still-picture', '1', '-crf', '35', '-cpu-used', '6']},
+    'webp': {'ext': 'webp', 'mimetype': 'image/webp', 'codec': ['-c:v', 'libwebp', '-quality', '75']},
+    'jpeg': {'ext': 'jpg', 'mimetype': 'image/jpeg', 'codec': ['-c:v', 'mjpeg', '-q:v', '2']}
+}
+# 默认缩略图（320px JPEG）即Video.thumbnail_path指向的文件
+THUMBNAIL_DEFAULT_WIDTH = 320
+
+def thumbnail_variant_path(thumbnail_path, width, fmt):
+    """缩略图变体的文件路径，如 12_a.mp4.jpg -> 12_a.mp4.160.webp"""
+    if width == THUMBNAIL_DEFAULT_WIDTH and fmt == 'jpeg':
+        return thumbnail_path
+    return f"{os.path.splitext(thumbnail_path)[0]}.{width}.{THUMBNAIL_FORMATS[fmt]['ext']}"
+
+def thumbnail_files(thumbnail_path, loose_only=False):
+    """缩略图及其所有变体中实际存在的文件（loose_only为True时不包括打包存储中的文件）"""
+    if not thumbnail_path:
+        return []
+    paths = [thumbnail_path]
+    for fmt in THUMBNAIL_FORMATS:
+        for width in app.config['THUMBNAIL_WIDTHS']:
+            path = thumbnail_variant_path(thumbnail_path, width, fmt)
+            if path not in paths:
+                paths.append(path)
+    exists = os.path.exists if loose_only else thumbnail_exists
+    return [path for path in paths if exists(path)]
+
+def thumbnail_time_position(video, commit=True):
+    """缩略图截取时间点：默认第1秒，不足2秒的短视频取中间帧（时长来自探测结果）"""
+    probe = video_probe(video, commit)
+    if probe and probe.duration and probe.duration < 2:
+        return f'{probe.duration / 2:.3f}'
+    return '00:00:01'
 
 def generate_thumbnail(video_path, output_path, time_position='00:00:01'):
-    """使用ffmpeg生成视频缩略图"""
+    """使用ffmpeg生成视频缩略图及其尺寸/格式变体
+    
+    -ss放在-i之前按关键帧快速定位，只解码一帧，经split滤镜缩放到各个宽度后分别编码输出；
+    变体生成失败（如ffmpeg不支持某种编码）时回退为只生成默认缩略图。
+    """
+    outputs = [(THUMBNAIL_DEFAULT_WIDTH, 'jpeg')]
+    for fmt in app.config['THUMBNAIL_VARIANT_FORMATS']:
+        for width in app.config['THUMBNAIL_WIDTHS']:
+            if fmt in THUMBNAIL_FORMATS and (width, fmt) not in outputs:
+                outputs.append((width, fmt))
+    
+    filters = [f"[0:v]split={len(outputs)}" + ''.join(f'[s{i}]' for i in range(len(outputs)))]
+    filters += [f"[s{i}]scale=w='min({width},iw)':h=-2[o{i}]" for i, (width, _) in enumerate(outputs)]
+    cmd = ['ffmpeg', '-y', '-ss', time_position, '-i', video_path, '-filter_complex', ';'.join(filters)]
+    for i, (width, fmt) in enumerate(outputs):
+        cmd += ['-map', f'[o{i}]', '-frames:v', '1'] + THUMBNAIL_FORMATS[fmt]['codec']
+        cmd.append(thumbnail_variant_path(output_path, width, fmt))
+    
     try:
-        cmd = [
-            'ffmpeg',
-            '-i', video_path,
-            '-ss', time_position,
-            '-vframes', '1',
-            '-vf', 'scale=320:-1',
-            '-q:v', '2',
-            output_path,
-            '-y'  # 覆盖已存在的文件
-        ]
-        subprocess.run(cmd, check=True, capture_output=True)
+        with ffmpeg_slot():
+            try:
+                subprocess.run(cmd, check=True, capture_output=True)
+            except subprocess.CalledProcessError as e:
+                if len(outputs) == 1:
+                    raise
+                print(f"生成缩略图变体失败，只生成默认缩略图: {e}")
+                cmd = [
+                    'ffmpeg', '-y',
+                    '-ss', time_position,
+                    '-i', video_path,
+                    '-frames:v', '1',
+                    '-vf', f'scale={THUMBNAIL_DEFAULT_WIDTH}:-2',
+                    '-q:v', '2',
+                    output_path
+                ]
+                subprocess.run(cmd, check=True, capture_output=True)
         return True
     except subprocess.CalledProcessError as e:
         print(f"生成缩略图失败: {e}")
@@ -241,38 +1611,511 @@ def generate_thumbnail(video_path, output_path, time_position='00:00:01'):
         print(f"生成缩略图异常: {e}")
         return False
 
+def select_thumbnail_variant(thumbnail_path, requested_width, accept_mimetypes):
+    """按请求的宽度和Accept选择存在的缩略图变体，返回(路径, 格式)，都不存在时为默认缩略图"""
+    widths = sorted(app.config['THUMBNAIL_WIDTHS'])
+    width = THUMBNAIL_DEFAULT_WIDTH
+    if requested_width and widths:
+        # 取不小于请求宽度的最小变体，请求过大时取最大变体
+        width = next((w for w in widths if w >= requested_width), widths[-1])
+    
+    candidates = []
+    for fmt in ('avif', 'webp'):
+        if fmt in app.config['THUMBNAIL_VARIANT_FORMATS'] and THUMBNAIL_FORMATS[fmt]['mimetype'] in accept_mimetypes:
+            candidates.append((width, fmt))
+    candidates += [(width, 'jpeg'), (THUMBNAIL_DEFAULT_WIDTH, 'jpeg')]
+    
+    for width, fmt in candidates:
+        path = thumbnail_variant_path(thumbnail_path, width, fmt)
+        if thumbnail_exists(path):
+            break
+    return path, fmt
+
+def send_thumbnail(thumbnail_path, immutable=False):
+    """发送缩略图：按?w=选择宽度、按Accept选择格式（avif/webp/jpeg），变体不存在时回退到默认缩略图
+    
+    immutable为True时（内容寻址的文件）以文件名作为强ETag并允许客户端永久缓存。
+    """
+    path, fmt = select_thumbnail_variant(thumbnail_path, request.args.get('w', type=int), request.accept_mimetypes)
+    packed = thumbnail_pack.get(os.path.basename(path)) if thumbnail_pack is not None else None
+    if packed is not None:
+        # 打包存储：WSGI要求响应体为bytes，从mmap复制一份（缩略图只有几十KB）；文件名包含内容哈希，同样作为强ETag
+        response = Response([bytes(packed)], mimetype=THUMBNAIL_FORMATS[fmt]['mimetype'], direct_passthrough=True)
+        response.content_length = len(packed)
+        response.set_etag(os.path.basename(path))
+        if immutable:
+            response.cache_control.max_age = THUMBNAIL_IMMUTABLE_MAX_AGE
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        response.make_conditional(request)
+    elif not immutable:
+        response = send_from_directory(
+            os.path.dirname(path),
+            os.path.basename(path),
+            mimetype=THUMBNAIL_FORMATS[fmt]['mimetype']
+        )
+    else:
+        # 文件名包含内容哈希，可直接作为强ETag
+        response = send_from_directory(
+            os.path.dirname(path),
+            os.path.basename(path),
+            mimetype=THUMBNAIL_FORMATS[fmt]['mimetype'],
+            etag=os.path.basename(path),
+            max_age=THUMBNAIL_IMMUTABLE_MAX_AGE
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
+
+# 内容寻址存储：文件按内容哈希命名，按哈希前4位分两级目录存放，相同内容只存一份
+THUMBNAIL_HASH_FILENAME = re.compile(r'^([0-9a-f]{32})\.jpg$')
+THUMBNAIL_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+class ThumbnailPack:
+    """缩略图打包存储：缩略图追加写入少量大的段文件，按偏移索引读取
+    
+    每个段由segment-<n>.blob（数据）和segment-<n>.idx（索引记录：文件名、偏移、长度，删除时追加墓碑记录）组成，
+    MANIFEST列出当前有效的段。读取时直接对mmap切片，不复制数据也不需要逐个打开小文件。
+    写入和整理通过文件锁在进程间互斥，其他进程发现MANIFEST或索引文件变化后重新加载。
+    
+    _lock只保护内存中的索引和映射，持有期间不做文件读写；文件读写（写入、整理、读取其他进程的改动）
+    由_io_lock串行。读取方从不等待_io_lock，写入或整理进行中时继续使用当前的索引和映射。
+    """
+    RECORD = struct.Struct('>BHQI')  # 类型(1写入/0删除)、文件名长度、偏移、长度，后接文件名
+    REFRESH_INTERVAL = 1.0
+    
+    def __init__(self, folder, segment_size):
+        self.folder = folder
+        self.segment_size = segment_size
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        with self._io_lock:
+            self._reload()
+    
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+    
+    def _blob_path(self, segment):
+        return self._path(f'segment-{segment:06d}.blob')
+    
+    def _idx_path(self, segment):
+        return self._path(f'segment-{segment:06d}.idx')
+    
+    def _manifest_stamp(self):
+        try:
+            st = os.stat(self._path('MANIFEST'))
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_ino)
+    
+    def _write_manifest(self, manifest):
+        tmp_path = self._path('MANIFEST.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._path('MANIFEST'))
+        stamp = self._manifest_stamp()
+        with self._lock:
+            self._manifest = manifest
+            self._manifest_mtime = stamp
+    
+    def _reload(self):
+        """重新加载MANIFEST和全部索引（持有_io_lock时调用），在锁外读取文件后整体替换内存状态"""
+        stamp = self._manifest_stamp()
+        try:
+            with open(self._path('MANIFEST')) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {'segments': [], 'next': 1}
+        index = {}       # 文件名 -> (段号, 偏移, 长度)
+        idx_loaded = {}  # 段号 -> 已读取的索引字节数
+        for segment in manifest['segments']:
+            records, idx_loaded[segment] = self._read_records(segment, 0)
+            self._apply_records(index, segment, records)
+        with self._lock:
+            self._manifest = manifest
+            self._manifest_mtime = stamp
+            self._index = index
+            self._idx_loaded = idx_loaded
+            # 旧的映射不主动关闭，仍在发送中的响应释放引用后自动回收
+            self._maps = {}
+            self._checked_at = time.monotonic()
+    
+    def _read_records(self, segment, start):
+        """从start开始读取索引记录，返回(记录列表, 新的读取位置)；不完整的尾部记录留到下次读取"""
+        try:
+            with open(self._idx_path(segment), 'rb') as f:
+                f.seek(start)
+                data = f.read()
+        except FileNotFoundError:
+            return [], start
+        records = []
+        pos = 0
+        while pos + self.RECORD.size <= len(data):
+            kind, key_length, offset, length = self.RECORD.unpack_from(data, pos)
+            end = pos + self.RECORD.size + key_length
+            if end > len(data):
+                break
+            records.append((kind, data[pos + self.RECORD.size:end].decode(), offset, length))
+            pos = end
+        return records, start + pos
+    
+    @staticmethod
+    def _apply_records(index, segment, records):
+        for kind, key, offset, length in records:
+            if kind:
+                index[key] = (segment, offset, length)
+            elif index.get(key, (None,))[0] == segment:
+                del index[key]
+    
+    def _refresh(self):
+        """读取其他进程的改动（持有_io_lock时调用）：MANIFEST变化（新段、整理）时全部重新加载，否则只追加读取新的索引记录"""
+        if self._manifest_stamp() != self._manifest_mtime:
+            self._reload()
+            return
+        for segment in self._manifest['segments']:
+            records, loaded = self._read_records(segment, self._idx_loaded.get(segment, 0))
+            with self._lock:
+                self._apply_records(self._index, segment, records)
+                self._idx_loaded[segment] = loaded
+        self._checked_at = time.monotonic()
+    
+    def _maybe_refresh(self, force=False):
+        """读取方定期检查其他进程的改动；写入、整理或其他线程的检查正在进行时跳过，先使用当前状态"""
+        if not force and time.monotonic() - self._checked_at < self.REFRESH_INTERVAL:
+            return
+        if not self._io_lock.acquire(blocking=False):
+            return
+        try:
+            self._refresh()
+        finally:
+            self._io_lock.release()
+    
+    @contextlib.contextmanager
+    def _write_lock(self):
+        with self._io_lock, open(self._path('LOCK'), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+            yield
+    
+    def _append_record(self, segment, kind, key, offset, length):
+        encoded = key.encode()
+        with open(self._idx_path(segment), 'ab') as f:
+            f.write(self.RECORD.pack(kind, len(encoded), offset, length) + encoded)
+        self._idx_loaded[segment] = self._idx_loaded.get(segment, 0) + self.RECORD.size + len(encoded)
+    
+    def _writable_segment(self, size):
+        """当前追加写入的段，写入后超过段大小上限时新建一个段"""
+        segments = self._manifest['segments']
+        if segments:
+            segment = segments[-1]
+            try:
+                current = os.path.getsize(self._blob_path(segment))
+            except FileNotFoundError:
+                current = 0
+            if current == 0 or current + size <= self.segment_size:
+                return segment
+        segment = self._manifest['next']
+        self._write_manifest({'segments': segments + [segment], 'next': segment + 1})
+        return segment
+    
+    def contains(self, key):
+        self._maybe_refresh()
+        with self._lock:
+            return key in self._index
+    
+    def get(self, key):
+        """返回文件内容的memoryview（直接引用mmap，不复制数据），不存在时返回None"""
+        self._maybe_refresh()
+        for attempt in range(2):
+            with self._lock:
+                entry = self._index.get(key)
+                if entry is None:
+                    return None
+                segment, offset, length = entry
+                mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < offset + length:
+                try:
+                    with open(self._blob_path(segment), 'rb') as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except FileNotFoundError:
+                    # 段刚被其他进程整理掉，重新加载索引后再试一次
+                    self._maybe_refresh(force=True)
+                    continue
+                with self._lock:
+                    self._maps[segment] = mapped
+            return memoryview(mapped)[offset:offset + length]
+        return None
+    
+    def put_many(self, items):
+        """追加写入多个文件 [(文件名, 内容)]；文件名包含内容哈希，已存在的直接跳过"""
+        with self._write_lock():
+            for key, data in items:
+                if key in self._index:
+                    continue
+                segment = self._writable_segment(len(data))
+                with open(self._blob_path(segment), 'ab') as f:
+                    offset = f.tell()
+                    f.write(data)
+                self._append_record(segment, 1, key, offset, len(data))
+                with self._lock:
+                    self._index[key] = (segment, offset, len(data))
+    
+    def delete(self, keys):
+        """删除文件：追加墓碑记录，空间在整理时回收"""
+        with self._write_lock():
+            for key in keys:
+                entry = self._index.get(key)
+                if entry:
+                    self._append_record(entry[0], 0, key, entry[1], entry[2])
+                    with self._lock:
+                        self._index.pop(key, None)
+    
+    def compact(self, ratio):
+        """整理失效数据占比达到ratio的段：仍有效的文件复制到新段后删除旧段，返回回收的字节数"""
+        with self._write_lock():
+            live = {}
+            for segment, offset, length in self._index.values():
+                live[segment] = live.get(segment, 0) + length
+            victims = set()
+            reclaimed = 0
+            for segment in self._manifest['segments']:
+                try:
+                    size = os.path.getsize(self._blob_path(segment))
+                except FileNotFoundError:
+                    size = 0
+                if size and (size - live.get(segment, 0)) / size >= ratio:
+                    victims.add(segment)
+                    reclaimed += size - live.get(segment, 0)
+            if not victims:
+                return 0
+            
+            segments = [segment for segment in self._manifest['segments'] if segment not in victims]
+            target = self._manifest['next']
+            entries = sorted((entry, key) for key, entry in self._index.items() if entry[0] in victims)
+            if entries:
+                with open(self._blob_path(target), 'wb') as blob, open(self._idx_path(target), 'wb') as idx:
+                    for (segment, offset, length), key in entries:
+                        with open(self._blob_path(segment), 'rb') as f:
+                            f.seek(offset)
+                            data = f.read(length)
+                        encoded = key.encode()
+                        idx.write(self.RECORD.pack(1, len(encoded), blob.tell(), length) + encoded)
+                        blob.write(data)
+                    blob.flush()
+                    os.fsync(blob.fileno())
+                    idx.flush()
+                    os.fsync(idx.fileno())
+                segments.append(target)
+            
+            # 先切换MANIFEST再删除旧段，读取方在MANIFEST变化后改用新段（已映射的旧段在删除后仍可读取）
+            self._write_manifest({'segments': segments, 'next': target + 1})
+            for segment in victims:
+                for path in (self._blob_path(segment), self._idx_path(segment)):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._reload()
+            return reclaimed
+
+thumbnail_pack = ThumbnailPack(os.path.join(THUMBNAIL_FOLDER, 'pack'), app.config['THUMBNAIL_PACK_SEGMENT_SIZE']) \
+    if app.config['THUMBNAIL_BACKEND'] == 'pack' else None
+
+def thumbnail_exists(path):
+    """缩略图文件是否存在（打包存储中的文件按文件名查找）"""
+    if not path:
+        return False
+    if thumbnail_pack is not None and thumbnail_pack.contains(os.path.basename(path)):
+        return True
+    return os.path.exists(path)
+
+def remove_thumbnail_files(paths):
+    """删除缩略图文件（包括打包存储中的），返回实际删除的路径"""
+    removed = []
+    packed = []
+    for path in paths:
+        if thumbnail_pack is not None and thumbnail_pack.contains(os.path.basename(path)):
+            packed.append(os.path.basename(path))
+        elif os.path.exists(path):
+            os.remove(path)
+        else:
+            continue
+        removed.append(path)
+    if packed:
+        thumbnail_pack.delete(packed)
+    return removed
+
+def compact_thumbnail_pack():
+    """删除缩略图后整理打包存储中失效数据过多的段（整理失败不影响删除结果）"""
+    if thumbnail_pack is None:
+        return
+    try:
+        reclaimed = thumbnail_pack.compact(app.config['THUMBNAIL_PACK_COMPACT_RATIO'])
+        if reclaimed:
+            print(f"🗜️ 缩略图打包存储整理完成，回收 {reclaimed} 字节")
+    except Exception as e:
+        print(f"⚠️ 缩略图打包存储整理失败: {str(e)}")
+
+def thumbnail_store_path(thumbnail_hash):
+    """内容寻址存储中默认缩略图的路径，如 store/ab/cd/abcd....jpg"""
+    return os.path.join(app.config['THUMBNAIL_FOLDER'], 'store',
+                        thumbnail_hash[:2], thumbnail_hash[2:4], f'{thumbnail_hash}.jpg')
+
+def store_thumbnail(staging_path):
+    """将生成的缩略图及其变体按默认缩略图的内容哈希移入分片存储（或写入打包存储），返回(哈希, 存储路径)"""
+    with open(staging_path, 'rb') as f:
+        thumbnail_hash = hashlib.sha256(f.read()).hexdigest()[:32]
+    store_path = thumbnail_store_path(thumbnail_hash)
+    staging_stem = os.path.splitext(staging_path)[0]
+    store_stem = os.path.splitext(store_path)[0]
+    
+    if thumbnail_pack is not None:
+        # 打包存储以存储路径的文件名为键，写入后删除临时文件
+        items = []
+        staged = thumbnail_files(staging_path, loose_only=True)
+        for path in staged:
+            with open(path, 'rb') as f:
+                items.append((os.path.basename(store_stem + path[len(staging_stem):]), f.read()))
+        thumbnail_pack.put_many(items)
+        for path in staged:
+            os.remove(path)
+        return thumbnail_hash, store_path
+    
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    for path in thumbnail_files(staging_path, loose_only=True):
+        os.replace(path, store_stem + path[len(staging_stem):])
+    return thumbnail_hash, store_path
+
+def adopt_thumbnail(video):
+    """把旧版平铺存放的缩略图迁入内容寻址存储，启用打包存储时把分片目录中的文件也写入打包存储
+    
+    返回是否有改动（由调用方提交）。
+    """
+    if video.thumbnail_hash and thumbnail_pack is None:
+        return False
+    if not video.thumbnail_path or not os.path.exists(video.thumbnail_path):
+        return False
+    video.thumbnail_hash, video.thumbnail_path = store_thumbnail(video.thumbnail_path)
+    return True
+
+def thumbnail_url(video):
+    """缩略图URL：已入库的缩略图返回带内容哈希的不可变URL"""
+    if video.thumbnail_hash:
+        return f'/api/thumbnails/{video.thumbnail_hash}.jpg'
+    if video.thumbnail_path:
+        return f'/api/thumbnails/{os.path.basename(video.thumbnail_path)}'
+    return None
+
+def releasable_thumbnail_files(video, exclude_ids=()):
+    """删除视频时可以一并删除的缩略图文件（内容相同的缩略图仍被其他视频使用时保留）"""
+    if video.thumbnail_hash:
+        others = Video.query.filter(Video.thumbnail_hash == video.thumbnail_hash, Video.id != video.id)
+        if exclude_ids:
+            others = others.filter(~Video.id.in_(list(exclude_ids)))
+        if others.first():
+            return []
+    return thumbnail_files(video.thumbnail_path)
+
+def _thumbnail_file_path(video):
+    thumbnail_filename = f"{video.id}_{os.path.basename(video.filename)}.jpg"
+    return os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
+
+@contextlib.contextmanager
+def thumbnail_staging(thumbnail_path):
+    """生成或上传缩略图时使用的临时路径（缩略图目录下独立的临时目录，文件名与thumbnail_path相同）
+    
+    同一视频的按需生成、批量任务和上传可能同时进行，各自写入自己的目录，
+    不会互相覆盖或读到写了一半的文件；退出时删除临时目录和其中剩余的文件。
+    """
+    staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=app.config['THUMBNAIL_FOLDER'])
+    try:
+        yield os.path.join(staging_dir, os.path.basename(thumbnail_path))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+# 按需生成缩略图：同一视频的并发请求共享一次生成（single-flight），生成在独立线程池中执行
+_thumbnail_executor = ThreadPoolExecutor(max_workers=app.config['THUMBNAIL_CONCURRENCY'],
+                                         thread_name_prefix='thumbnail')
+_thumbnail_lock = threading.Lock()
+_thumbnail_inflight = {}  # 视频ID -> 正在生成的Future
+_thumbnail_failed = {}  # 视频ID -> 最近一次生成失败的时间
+THUMBNAIL_PLACEHOLDER_SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="320" height="568" viewBox="0 0 320 568">'
+    '<rect width="320" height="568" fill="#222"/></svg>'
+)
+
+def _render_thumbnail_task(video_id, video_path, thumbnail_path, time_position):
+    """生成缩略图并移入内容寻址存储，返回存储路径，失败返回None（失败时间记录在_thumbnail_failed中）"""
+    try:
+        with thumbnail_staging(thumbnail_path) as staging_path:
+            if not generate_thumbnail(video_path, staging_path, time_position):
+                _thumbnail_failed[video_id] = time.time()
+                return None
+            thumbnail_hash, store_path = store_thumbnail(staging_path)
+        with app.app_context():
+            Video.query.filter_by(id=video_id).update({'thumbnail_path': store_path, 'thumbnail_hash': thumbnail_hash})
+            # 批量UPDATE不触发after_update事件，需要自己递增缩略图版本，让列表响应缓存失效
+            bump_thumbnail_version()
+            db.session.commit()
+        _thumbnail_failed.pop(video_id, None)
+        return store_path
+    except Exception as e:
+        # 存储或写入数据库失败同样按生成失败处理，避免客户端重试反复启动ffmpeg
+        print(f"保存缩略图失败: {video_path}: {e}")
+        _thumbnail_failed[video_id] = time.time()
+        return None
+    finally:
+        with _thumbnail_lock:
+            _thumbnail_inflight.pop(video_id, None)
+
+def request_thumbnail(video_id, video_path, thumbnail_path, time_position='00:00:01'):
+    """提交缩略图生成，同一视频已在生成时返回同一个Future"""
+    with _thumbnail_lock:
+        future = _thumbnail_inflight.get(video_id)
+        if future is None:
+            future = _thumbnail_executor.submit(_render_thumbnail_task, video_id, video_path,
+                                                thumbnail_path, time_position)
+            _thumbnail_inflight[video_id] = future
+    return future
+
+def _thumbnail_pending_response():
+    """缩略图生成中：返回202和Retry-After，图片请求返回占位图，其它请求返回JSON"""
+    headers = {'Retry-After': '1', 'Cache-Control': 'no-store'}
+    if request.accept_mimetypes.best_match(['application/json', 'image/svg+xml']) == 'image/svg+xml':
+        return Response(THUMBNAIL_PLACEHOLDER_SVG, 202, headers=headers, mimetype='image/svg+xml')
+    return jsonify({'status': 'pending', 'message': '缩略图生成中'}), 202, headers
+
 @app.route('/api/thumbnail/<int:video_id>')
 def get_thumbnail(video_id):
-    """获取视频缩略图，如果不存在则生成"""
+    """获取视频缩略图，如果不存在则在后台生成，短时间内未完成时返回202"""
     video = Video.query.get_or_404(video_id)
     
-    # 如果已有缩略图路径，直接返回
-    if video.thumbnail_path and os.path.exists(video.thumbnail_path):
-        return send_from_directory(
-            os.path.dirname(video.thumbnail_path),
-            os.path.basename(video.thumbnail_path),
-            mimetype='image/jpeg'
-        )
+    # 如果已有缩略图路径，直接返回（旧版缩略图顺便迁入内容寻址存储）
+    if thumbnail_exists(video.thumbnail_path):
+        if adopt_thumbnail(video):
+            db.session.commit()
+        return send_thumbnail(video.thumbnail_path)
     
-    # 生成缩略图
     video_path = os.path.join(app.config['MEDIA_FOLDER'], video.filename)
     if not os.path.exists(video_path):
         return jsonify({'error': 'Video file not found'}), 404
     
-    # 创建缩略图文件名
-    thumbnail_filename = f"{video.id}_{os.path.basename(video.filename)}.jpg"
-    thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
+    # 最近生成失败过的视频暂不重试，避免客户端重试反复启动ffmpeg
+    failed_at = _thumbnail_failed.get(video.id)
+    if failed_at and time.time() - failed_at < app.config['THUMBNAIL_RETRY_SECONDS']:
+        return jsonify({'error': 'Failed to generate thumbnail'}), 500
     
-    # 生成缩略图
-    if generate_thumbnail(video_path, thumbnail_path):
-        # 更新数据库
-        video.thumbnail_path = thumbnail_path
-        db.session.commit()
-        return send_from_directory(
-            app.config['THUMBNAIL_FOLDER'],
-            thumbnail_filename,
-            mimetype='image/jpeg'
-        )
+    # 生成缩略图（并发请求共享同一次生成）
+    thumbnail_path = _thumbnail_file_path(video)
+    future = request_thumbnail(video.id, video_path, thumbnail_path, thumbnail_time_position(video))
+    try:
+        store_path = future.result(timeout=app.config['THUMBNAIL_WAIT_SECONDS'])
+    except concurrent.futures.TimeoutError:
+        return _thumbnail_pending_response()
+    
+    if store_path:
+        return send_thumbnail(store_path)
     else:
         return jsonify({'error': 'Failed to generate thumbnail'}), 500
 
@@ -298,20 +2141,438 @@ def upload_thumbnail(video_id):
         thumbnail_filename = f"{video.id}_{os.path.basename(video.filename)}.jpg"
         thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
         
-        with open(thumbnail_path, 'wb') as f:
-            f.write(image_data)
+        # 旧缩略图没有其他视频使用时，替换后删除
+        old_hash = video.thumbnail_hash
+        old_files = releasable_thumbnail_files(video)
+        
+        # 删除之前遗留的变体，避免混入旧的缩略图
+        for path in thumbnail_files(thumbnail_path, loose_only=True):
+            os.remove(path)
+        
+        # 写入独立的临时路径后移入内容寻址存储
+        with thumbnail_staging(thumbnail_path) as staging_path:
+            with open(staging_path, 'wb') as f:
+                f.write(image_data)
+            thumbnail_hash, store_path = store_thumbnail(staging_path)
         
         # 更新数据库
-        video.thumbnail_path = thumbnail_path
+        video.thumbnail_path = store_path
+        video.thumbnail_hash = thumbnail_hash
         db.session.commit()
         
-        return jsonify({'status': 'success', 'thumbnail_path': thumbnail_path})
+        if thumbnail_hash != old_hash:
+            remove_thumbnail_files(old_files)
+            compact_thumbnail_pack()
+        
+        return jsonify({'status': 'success', 'thumbnail_path': store_path, 'thumbnail_url': thumbnail_url(video)})
         
     except Exception as e:
         return jsonify({'error': f'Failed to process thumbnail: {str(e)}'}), 500
 
+class SeededPermutation:
+    """由种子决定的[0, size)上的伪随机排列，可以直接计算任意位置的值
+    
+    在覆盖size的2的偶数次幂范围上做4轮Feistel变换（轮函数为以种子为密钥的BLAKE2b），
+    结果超出size时继续变换（cycle walking），因此第k页的代价与第1页相同，不需要生成整个排列。
+    """
+    ROUNDS = 4
+    
+    def __init__(self, size, seed):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.mask = (1 << self.half_bits) - 1
+        self.key = hashlib.blake2b(str(seed).encode(), digest_size=16).digest()
+    
+    def _round(self, round_index, value):
+        digest = hashlib.blake2b(bytes([round_index]) + value.to_bytes(8, 'big'), key=self.key, digest_size=8).digest()
+        return int.from_bytes(digest, 'big') & self.mask
+    
+    def __getitem__(self, index):
+        value = index
+        while True:
+            left, right = value >> self.half_bits, value & self.mask
+            for round_index in range(self.ROUNDS):
+                left, right = right, left ^ self._round(round_index, right)
+            value = (left << self.half_bits) | right
+            if value < self.size:
+                return value
+
+# 按ID排序的全部视频ID（随媒体库版本号失效），随机列表通过排名取ID
+_video_id_index = {'version': None, 'ids': array('q')}
+_video_id_index_lock = threading.Lock()
+
+def video_id_index():
+    """按ID升序排列的全部视频ID"""
+    version = library_version()
+    with _video_id_index_lock:
+        if _video_id_index['version'] != version:
+            rows = db.session.execute(db.select(Video.id).order_by(Video.id))
+            _video_id_index['ids'] = array('q', (row[0] for row in rows))
+            _video_id_index['version'] = version
+        return _video_id_index['ids']
+
+# 用户讨厌视频的排除集合（按媒体库版本和用户的讨厌版本失效），只保留最近使用的用户
+DISLIKE_EXCLUSION_CACHE_SIZE = 1024
+_dislike_exclusions = OrderedDict()
+_dislike_exclusions_lock = threading.Lock()
+
+def dislike_exclusion(user_id):
+    """用户讨厌的视频在ID数组中的排除偏移：shifts[j]为排在第j个讨厌视频前面的未讨厌视频数（升序）
+    
+    随机列表据此把排除后的排名映射回ID数组下标，视频总数也可以直接由数组长度相减得到，
+    每次请求的代价与讨厌列表的长度无关。
+    """
+    ids = video_id_index()
+    if not user_id:
+        return ids, array('q')
+    version = (library_version(), read_counter(f'dislike_version:{user_id}'))
+    with _dislike_exclusions_lock:
+        cached = _dislike_exclusions.get(user_id)
+        if cached and cached[0] == version and cached[1] is ids:
+            _dislike_exclusions.move_to_end(user_id)
+            return ids, cached[2]
+    
+    disliked_ids = {row[0] for row in db.session.execute(
+        db.select(Dislike.video_id).where(Dislike.user_id == user_id))}
+    positions = sorted({i for i in (bisect.bisect_left(ids, vid) for vid in disliked_ids)
+                        if i < len(ids) and ids[i] in disliked_ids})
+    shifts = array('q', (position - j for j, position in enumerate(positions)))
+    with _dislike_exclusions_lock:
+        _dislike_exclusions[user_id] = (version, ids, shifts)
+        _dislike_exclusions.move_to_end(user_id)
+        while len(_dislike_exclusions) > DISLIKE_EXCLUSION_CACHE_SIZE:
+            _dislike_exclusions.popitem(last=False)
+    return ids, shifts
+
+def video_total(user_id=None):
+    """排除用户讨厌的视频后的视频总数（基于缓存的ID数组，不需要COUNT(*)）"""
+    ids, shifts = dislike_exclusion(user_id)
+    return len(ids) - len(shifts)
+
+def random_feed_page(seed, page, per_page, user_id=None):
+    """种子随机列表的第page页视频ID（排除用户讨厌的视频后再排列，每页数量稳定）"""
+    ids, shifts = dislike_exclusion(user_id)
+    total = len(ids) - len(shifts)
+    
+    page_ids = []
+    if total:
+        permutation = SeededPermutation(total, seed)
+        start = max(page - 1, 0) * per_page
+        for rank in range(start, min(start + per_page, total)):
+            value = permutation[rank]
+            page_ids.append(ids[value + bisect.bisect_right(shifts, value)])
+    return page_ids, total
+
+def encode_cursor(*values):
+    """把上一页最后一条记录的排序键编码为不透明的分页游标"""
+    raw = json.dumps(values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, size):
+    """解析分页游标，返回size个排序键，格式不正确时抛出ValueError"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError('无效的分页游标')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('无效的分页游标')
+    return values
+
+# 批量查询用户状态时单次最多的视频数（两个IN列表共用SQLite的参数数量上限）
+INTERACTION_BATCH_LIMIT = 400
+
+def interaction_states(user_id, video_ids):
+    """批量查询用户对视频的收藏/讨厌状态，一次查询走两张表的(user_id, video_id)唯一索引"""
+    states = {vid: {'is_favorited': False, 'is_disliked': False} for vid in video_ids}
+    if not user_id or not states:
+        return states
+    ids = list(states)
+    query = db.union_all(
+        db.select(Favorite.video_id, db.literal('is_favorited').label('state'))
+            .where(Favorite.user_id == user_id, Favorite.video_id.in_(ids)),
+        db.select(Dislike.video_id, db.literal('is_disliked').label('state'))
+            .where(Dislike.user_id == user_id, Dislike.video_id.in_(ids))
+    )
+    for video_id, state in db.session.execute(query):
+        states[video_id][state] = True
+    if interaction_buffer is not None:
+        # 叠加尚未写入数据库的操作
+        for video_id, state in states.items():
+            for model, key in ((Favorite, 'is_favorited'), (Dislike, 'is_disliked')):
+                pending = interaction_buffer.overlay(model.__tablename__, user_id, video_id)
+                if pending is not None:
+                    state[key] = pending
+    return states
+
+class InteractionBuffer:
+    """收藏/讨厌的延迟写入缓冲
+    
+    同一(用户, 视频)的多次操作在内存中合并为最终状态，按时间间隔或数量阈值在一个事务里批量写入。
+    写入完成前，查询接口通过overlay()读到用户刚做的操作；进程退出时写入剩余的操作。
+    """
+    
+    def __init__(self, interval, size):
+        self.interval = interval
+        self.size = size
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 同一时间只有一个批次在写入
+        self._pending = {}   # user_id -> {(表名, video_id): (是否存在, 操作时间)}
+        self._flushing = {}  # 正在写入的批次，提交前仍参与overlay
+        self._count = 0
+        self._generation = 0  # 每个批次写入结束时递增
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+    
+    def set_if_changed(self, kind, user_id, video_id, present, read_stored):
+        """当前状态不是present时记录操作（present为True表示收藏/讨厌，False表示取消）并返回True，否则返回False
+        
+        当前状态优先取尚未写入的操作，没有时为read_stored()读到的数据库状态。判断和记录在同一把锁内完成，
+        读取数据库期间有批次写入完成时重新读取，因此并发的相同操作只有一个返回True（与直接写入时一致）。
+        """
+        while True:
+            with self._lock:
+                state = self._overlay_locked(kind, user_id, video_id)
+                if state is not None:
+                    if state == present:
+                        return False
+                    self._set_locked(kind, user_id, video_id, present)
+                    return True
+                generation = self._generation
+            stored = read_stored()
+            with self._lock:
+                if self._generation != generation or self._overlay_locked(kind, user_id, video_id) is not None:
+                    continue
+                if stored == present:
+                    return False
+                self._set_locked(kind, user_id, video_id, present)
+                return True
+    
+    def _set_locked(self, kind, user_id, video_id, present):
+        entries = self._pending.setdefault(user_id, {})
+        if (kind, video_id) not in entries:
+            self._count += 1
+        entries[(kind, video_id)] = (present, datetime.utcnow())
+        # 写入线程在第一次使用时启动（gunicorn等fork出的子进程里同样适用）
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        if self._count >= self.size:
+            self._wakeup.set()
+    
+    def overlay(self, kind, user_id, video_id):
+        """尚未写入数据库的状态，没有待写入的操作时返回None"""
+        with self._lock:
+            return self._overlay_locked(kind, user_id, video_id)
+    
+    def _overlay_locked(self, kind, user_id, video_id):
+        for batch in (self._pending, self._flushing):
+            entry = batch.get(user_id, {}).get((kind, video_id))
+            if entry:
+                return entry[0]
+        return None
+    
+    def flush(self, user_id=None):
+        """写入待写入的操作（指定user_id时只写入该用户的），返回时已提交"""
+        with self._lock:
+            if user_id is not None and user_id not in self._pending and user_id not in self._flushing:
+                return
+        with self._flush_lock:
+            with self._lock:
+                if user_id is None:
+                    batch, self._pending = self._pending, {}
+                else:
+                    batch = {user_id: self._pending.pop(user_id)} if user_id in self._pending else {}
+                self._count -= sum(len(entries) for entries in batch.values())
+                self._flushing = batch
+            if not batch:
+                return
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"⚠️ 收藏/讨厌批量写入失败，稍后重试: {e}")
+                with self._lock:
+                    # 放回队列，期间又有新操作的以新操作为准
+                    for uid, entries in batch.items():
+                        pending = self._pending.setdefault(uid, {})
+                        for key, entry in entries.items():
+                            if key not in pending:
+                                pending[key] = entry
+                                self._count += 1
+            finally:
+                with self._lock:
+                    self._flushing = {}
+                    self._generation += 1
+    
+    def close(self):
+        """停止写入线程并写入剩余的操作"""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+        self.flush()
+    
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+    
+    def _write(self, batch):
+        # 独立的应用上下文和会话，不影响调用方请求中的会话
+        with app.app_context():
+            try:
+                for user_id, entries in batch.items():
+                    for (kind, video_id), (present, created_at) in entries.items():
+                        model = INTERACTION_MODELS[kind]
+                        if present:
+                            db.session.execute(sqlite_insert(model)
+                                .values(user_id=user_id, video_id=video_id, created_at=created_at)
+                                .on_conflict_do_nothing())
+                        else:
+                            db.session.execute(db.delete(model)
+                                .where(model.user_id == user_id, model.video_id == video_id))
+                    if any(kind == Favorite.__tablename__ for kind, _ in entries):
+                        bump_favorite_version(user_id)
+                    if any(kind == Dislike.__tablename__ for kind, _ in entries):
+                        bump_dislike_version(user_id)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+INTERACTION_MODELS = {model.__tablename__: model for model in (Favorite, Dislike)}
+interaction_buffer = InteractionBuffer(
+    app.config['INTERACTION_FLUSH_INTERVAL'], app.config['INTERACTION_FLUSH_SIZE']
+) if app.config['INTERACTION_WRITE_BEHIND'] else None
+if interaction_buffer is not None:
+    atexit.register(interaction_buffer.close)
+
+def _stored_interaction(model, user_id, video_id):
+    return db.session.query(model.id).filter_by(user_id=user_id, video_id=video_id).first() is not None
+
+def has_interaction(model, user_id, video_id):
+    """用户是否收藏/讨厌了视频（包括尚未写入数据库的操作）"""
+    if interaction_buffer is not None:
+        state = interaction_buffer.overlay(model.__tablename__, user_id, video_id)
+        if state is not None:
+            return state
+    return _stored_interaction(model, user_id, video_id)
+
+def buffer_interaction(model, user_id, video_id, present):
+    """把操作放入延迟写入缓冲；状态本来就是如此（已经收藏过、记录不存在）时返回False"""
+    return interaction_buffer.set_if_changed(model.__tablename__, user_id, video_id, present,
+                                             lambda: _stored_interaction(model, user_id, video_id))
+
+def flush_interactions(user_id=None):
+    """列表类查询前写入待写入的操作（user_id为空时写入所有用户的），保证读到刚做的操作"""
+    if interaction_buffer is not None:
+        interaction_buffer.flush(user_id)
+
+def serialize_video(video):
+    """视频列表项（视频列表、收藏列表、讨厌列表共用）"""
+    return {
+        'id': video.id,
+        'filename': video.filename,
+        'thumbnail_url': thumbnail_url(video)
+    }
+
+def serialize_videos(videos, user_id=None, include_state=False):
+    """视频列表项；include_state为True时附带用户的收藏/讨厌状态（一次批量查询）"""
+    items = [serialize_video(v) for v in videos]
+    if include_state and user_id:
+        states = interaction_states(user_id, [item['id'] for item in items])
+        for item in items:
+            item.update(states[item['id']])
+    return items
+
+def keyset_page(query, per_page):
+    """取一页记录，多取一条用于判断是否还有下一页"""
+    rows = query.limit(per_page + 1).all()
+    return rows[:per_page], len(rows) > per_page
+
+def interaction_video_page(model, user_id, page, per_page, after=None):
+    """收藏/讨厌列表的一页视频：与视频表连接查询，每条记录一行，按时间倒序
+    
+    传入after时从游标继续，否则按页码。返回(视频列表, 是否还有下一页, 下一页游标)，
+    游标格式不正确时抛出ValueError。
+    """
+    query = db.session.query(Video, model.created_at, model.id)\
+        .join(model, model.video_id == Video.id)\
+        .filter(model.user_id == user_id)\
+        .order_by(model.created_at.desc(), model.id.desc())
+    if after:
+        created_at, record_id = decode_cursor(after, 2)
+        try:
+            query = query.filter(db.tuple_(model.created_at, model.id) <
+                                 (datetime.fromisoformat(created_at), int(record_id)))
+        except TypeError:
+            raise ValueError('无效的分页游标')
+    else:
+        query = query.offset((max(page, 1) - 1) * per_page)
+    rows, has_next = keyset_page(query, per_page)
+    next_cursor = encode_cursor(rows[-1][1].isoformat(), rows[-1][2]) if has_next else None
+    return [row[0] for row in rows], has_next, next_cursor
+
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+def cached_response(view):
+    """列表接口的响应缓存
+    
+    键为(接口, 查询参数, 媒体库版本, 缩略图版本, 用户的收藏/讨厌版本)。版本号与数据在同一事务中递增，
+    缓存不需要过期时间，也不会返回旧数据。响应带ETag，内容未变时对If-None-Match返回304。
+    视图设置g.skip_response_cache时（如未指定种子的随机列表）不缓存；流式响应和错误响应不缓存。
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if app.config['RESPONSE_CACHE_SIZE'] <= 0:
+            return view(*args, **kwargs)
+        
+        user_id = request.args.get('user_id', type=int)
+        keys = ['library_version', 'thumbnail_version']
+        if user_id:
+            flush_interactions(user_id)
+            keys += [f'favorite_version:{user_id}', f'dislike_version:{user_id}']
+        cache_key = (request.endpoint, tuple(sorted(kwargs.items())),
+                     tuple(sorted(request.args.items(multi=True))), read_counters(keys))
+        
+        with _response_cache_lock:
+            entry = _response_cache.get(cache_key)
+            if entry is not None:
+                _response_cache.move_to_end(cache_key)
+        
+        if entry is None:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed or g.get('skip_response_cache'):
+                return response
+            body = response.get_data()
+            entry = (hashlib.blake2b(body, digest_size=16).hexdigest(), body)
+            with _response_cache_lock:
+                _response_cache[cache_key] = entry
+                while len(_response_cache) > app.config['RESPONSE_CACHE_SIZE']:
+                    _response_cache.popitem(last=False)
+        
+        etag, body = entry
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        # 每次使用前向服务器验证（304不返回内容）
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    return wrapper
+
+def stream_json_array(videos):
+    """逐条序列化视频并以JSON数组流式输出，内存占用与列表长度无关"""
+    yield '['
+    for index, video in enumerate(videos):
+        yield (',' if index else '') + app.json.dumps(serialize_video(video))
+    yield ']'
+
 # 修改视频列表API，返回缩略图URL
 @app.route('/api/videos')
+@cached_response
 def list_videos():
     """获取视频列表（支持分页和随机排序，排除讨厌视频）"""
     page = request.args.get('page', 1, type=int)
@@ -319,38 +2580,19 @@ def list_videos():
     random_mode = request.args.get('random', 'false').lower() == 'true'
     seed = request.args.get('seed', type=int)
     user_id = request.args.get('user_id', type=int)
+    include_state = request.args.get('include_state', 'false').lower() == 'true'
+    if user_id:
+        flush_interactions(user_id)
     
     if random_mode:
-        # 使用种子确保随机列表的一致性
-        if seed:
-            random.seed(seed)
-        else:
-            random.seed()  # 使用系统时间作为种子
-        
-        # 获取所有视频ID，排除用户讨厌的视频
-        if user_id:
-            # 获取用户讨厌的视频ID列表
-            disliked_videos = Dislike.query.filter_by(user_id=user_id).with_entities(Dislike.video_id).all()
-            disliked_ids = [d.video_id for d in disliked_videos]
-            # 排除讨厌的视频
-            all_videos = Video.query.filter(~Video.id.in_(disliked_ids)).with_entities(Video.id).all()
-        else:
-            all_videos = Video.query.with_entities(Video.id).all()
-        
-        all_video_ids = [v.id for v in all_videos]
-        
-        # 随机打乱视频ID顺序
-        random.shuffle(all_video_ids)
-        
-        # 计算分页
-        total_videos = len(all_video_ids)
-        total_pages = (total_videos + per_page - 1) // per_page
-        has_next = page < total_pages
+        # 使用种子确保随机列表的一致性，未指定时随机生成并在响应中返回，供后续翻页使用
+        if not seed:
+            seed = random.SystemRandom().randint(1, 2**31 - 1)
+            g.skip_response_cache = True
         
-        # 获取当前页的视频ID
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        current_page_ids = all_video_ids[start_idx:end_idx]
+        # 直接计算当前页在随机排列中的视频ID（排除用户讨厌的视频）
+        current_page_ids, total_videos = random_feed_page(seed, page, per_page, user_id)
+        has_next = page * per_page < total_videos
         
         # 获取当前页的视频详情
         current_videos = Video.query.filter(Video.id.in_(current_page_ids)).all()
@@ -360,39 +2602,35 @@ def list_videos():
         ordered_videos = [video_map[vid] for vid in current_page_ids if vid in video_map]
         
         return jsonify({
-            'items': [{
-                'id': v.id,
-                'filename': v.filename,
-                'thumbnail_url': f'/api/thumbnails/{os.path.basename(v.thumbnail_path)}' if v.thumbnail_path else None
-            } for v in ordered_videos],
+            'items': serialize_videos(ordered_videos, user_id, include_state),
             'has_next': has_next,
-            'total': total_videos
+            'total': total_videos,
+            'seed': seed
         })
     else:
         # 默认按ID顺序排序（最新在前），排除用户讨厌的视频
+        query = Video.query.order_by(Video.id.desc())
         if user_id:
-            # 获取用户讨厌的视频ID列表
-            disliked_videos = Dislike.query.filter_by(user_id=user_id).with_entities(Dislike.video_id).all()
-            disliked_ids = [d.video_id for d in disliked_videos]
-            # 排除讨厌的视频
-            query = Video.query.filter(~Video.id.in_(disliked_ids)).order_by(Video.id.desc())
-        else:
-            query = Video.query.order_by(Video.id.desc())
+            # 反连接：逐条用(user_id, video_id)唯一索引判断，不需要把讨厌列表作为参数传入
+            query = query.filter(~db.exists().where(Dislike.user_id == user_id, Dislike.video_id == Video.id))
         
-        pagination = query.paginate(
-            page=page, 
-            per_page=per_page,
-            error_out=False
-        )
+        # 传入after时从游标继续（深翻页与第一页代价相同），否则按页码
+        after = request.args.get('after')
+        if after:
+            try:
+                after_id, = decode_cursor(after, 1)
+                query = query.filter(Video.id < int(after_id))
+            except (ValueError, TypeError):
+                return jsonify({'error': '无效的分页游标'}), 400
+        else:
+            query = query.offset((max(page, 1) - 1) * per_page)
+        videos, has_next = keyset_page(query, per_page)
         
         return jsonify({
-            'items': [{
-                'id': v.id,
-                'filename': v.filename,
-                'thumbnail_url': f'/api/thumbnails/{os.path.basename(v.thumbnail_path)}' if v.thumbnail_path else None
-            } for v in pagination.items],
-            'has_next': pagination.has_next,
-            'total': pagination.total
+            'items': serialize_videos(videos, user_id, include_state),
+            'has_next': has_next,
+            'next_cursor': encode_cursor(videos[-1].id) if has_next else None,
+            'total': video_total(user_id)
         })
 
 # 用户认证和收藏相关API
@@ -416,41 +2654,37 @@ def login():
     return jsonify({'error': '用户名或密码错误'}), 401
 
 @app.route('/api/favorites', methods=['GET'])
+@cached_response
 def get_favorites():
-    """获取用户的收藏列表（支持分页）"""
+    """获取用户的收藏列表（支持页码分页和游标分页）"""
     user_id = request.args.get('user_id', type=int)
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 50, type=int)
+    after = request.args.get('after')
+    # 游标翻页时默认不再统计总数
+    with_total = request.args.get('with_total', 'false' if after else 'true').lower() == 'true'
     
     if not user_id:
         return jsonify({'error': '用户ID不能为空'}), 400
+    flush_interactions(user_id)
     
     # 获取收藏总数
-    total_favorites = Favorite.query.filter_by(user_id=user_id).count()
-    
-    # 分页查询收藏记录
-    favorites = Favorite.query.filter_by(user_id=user_id)\
-        .order_by(Favorite.created_at.desc())\
-        .offset((page - 1) * per_page)\
-        .limit(per_page)\
-        .all()
-    
-    favorite_videos = []
-    for fav in favorites:
-        video = Video.query.get(fav.video_id)
-        if video:
-            favorite_videos.append({
-                'id': video.id,
-                'filename': video.filename,
-                'thumbnail_url': f'/api/thumbnails/{os.path.basename(video.thumbnail_path)}' if video.thumbnail_path else None
-            })
+    total_favorites = Favorite.query.filter_by(user_id=user_id).count() if with_total else None
+    
+    # 分页查询收藏的视频（按收藏时间倒序，同一时间按ID倒序）
+    try:
+        videos, has_next, next_cursor = interaction_video_page(Favorite, user_id, page, per_page, after)
+    except ValueError:
+        return jsonify({'error': '无效的分页游标'}), 400
     
     return jsonify({
-        'items': favorite_videos,
+        'items': serialize_videos(videos),
         'total': total_favorites,
         'page': page,
         'per_page': per_page,
-        'total_pages': (total_favorites + per_page - 1) // per_page
+        'total_pages': (total_favorites + per_page - 1) // per_page if with_total else None,
+        'has_next': has_next,
+        'next_cursor': next_cursor
     })
 
 @app.route('/api/favorites', methods=['POST'])
@@ -461,8 +2695,14 @@ def add_favorite():
         return jsonify({'error': '用户ID和视频ID不能为空'}), 400
     
     try:
+        if interaction_buffer is not None:
+            # 延迟写入：合并后批量提交
+            if not buffer_interaction(Favorite, int(data['user_id']), int(data['video_id']), True):
+                return jsonify({'error': '收藏失败，可能已经收藏过'}), 400
+            return jsonify({'status': 'success'})
         favorite = Favorite(user_id=data['user_id'], video_id=data['video_id'])
         db.session.add(favorite)
+        bump_favorite_version(data['user_id'])
         db.session.commit()
         return jsonify({'status': 'success'})
     except Exception as e:
@@ -478,9 +2718,15 @@ def remove_favorite():
     if not user_id or not video_id:
         return jsonify({'error': '用户ID和视频ID不能为空'}), 400
     
+    if interaction_buffer is not None:
+        if not buffer_interaction(Favorite, user_id, video_id, False):
+            return jsonify({'error': '收藏记录不存在'}), 404
+        return jsonify({'status': 'success'})
+    
     favorite = Favorite.query.filter_by(user_id=user_id, video_id=video_id).first()
     if favorite:
         db.session.delete(favorite)
+        bump_favorite_version(user_id)
         db.session.commit()
         return jsonify({'status': 'success'})
     return jsonify({'error': '收藏记录不存在'}), 404
@@ -491,36 +2737,36 @@ def get_favorites_navigation(video_id):
     user_id = request.args.get('user_id', type=int)
     if not user_id:
         return jsonify({'error': '用户ID不能为空'}), 400
+    flush_interactions(user_id)
     
-    # 获取用户的所有收藏视频ID（按收藏时间倒序）
-    favorites = Favorite.query.filter_by(user_id=user_id)\
-        .order_by(Favorite.created_at.desc())\
-        .all()
-    
-    favorite_video_ids = [fav.video_id for fav in favorites]
-    
-    # 查找当前视频在收藏列表中的位置
-    try:
-        current_index = favorite_video_ids.index(video_id)
-    except ValueError:
+    # 当前视频的收藏记录（唯一索引）
+    current = Favorite.query.filter_by(user_id=user_id, video_id=video_id).first()
+    if not current:
         return jsonify({'error': '视频不在收藏列表中'}), 404
     
-    # 获取下一个和前一个视频ID
-    next_video_id = None
-    prev_video_id = None
+    # 收藏列表按收藏时间倒序：前一个是更晚收藏的相邻记录，下一个是更早收藏的相邻记录，
+    # 都是(user_id, created_at, id)索引上的一次定位
+    user_favorites = Favorite.query.filter_by(user_id=user_id)
+    key = db.tuple_(Favorite.created_at, Favorite.id)
+    current_key = (current.created_at, current.id)
+    prev_favorite = user_favorites.filter(key > current_key)\
+        .order_by(Favorite.created_at.asc(), Favorite.id.asc()).first()
+    next_favorite = user_favorites.filter(key < current_key)\
+        .order_by(Favorite.created_at.desc(), Favorite.id.desc()).first()
     
-    if current_index > 0:
-        prev_video_id = favorite_video_ids[current_index - 1]
+    prev_video_id = prev_favorite.video_id if prev_favorite else None
+    next_video_id = next_favorite.video_id if next_favorite else None
     
-    if current_index < len(favorite_video_ids) - 1:
-        next_video_id = favorite_video_ids[current_index + 1]
+    # 位置和总数由索引计数得到（只扫描索引，不加载记录）
+    current_index = user_favorites.filter(key > current_key).count()
+    total_favorites = user_favorites.count()
     
     return jsonify({
         'current_video_id': video_id,
         'next_video_id': next_video_id,
         'prev_video_id': prev_video_id,
         'current_index': current_index,
-        'total_favorites': len(favorite_video_ids)
+        'total_favorites': total_favorites
     })
 
 @app.route('/api/favorites/check', methods=['GET'])
@@ -532,29 +2778,48 @@ def check_favorite():
     if not user_id or not video_id:
         return jsonify({'error': '用户ID和视频ID不能为空'}), 400
     
-    favorite = Favorite.query.filter_by(user_id=user_id, video_id=video_id).first()
-    return jsonify({'is_favorited': favorite is not None})
+    return jsonify({'is_favorited': has_interaction(Favorite, user_id, video_id)})
 
 # 讨厌功能API
 @app.route('/api/dislikes', methods=['GET'])
+@cached_response
 def get_dislikes():
-    """获取用户的讨厌列表"""
+    """获取用户的讨厌列表（传入per_page或after时分页返回，否则返回完整数组）"""
     user_id = request.args.get('user_id', type=int)
     if not user_id:
         return jsonify({'error': '用户ID不能为空'}), 400
+    flush_interactions(user_id)
     
-    dislikes = Dislike.query.filter_by(user_id=user_id).all()
-    dislike_videos = []
-    for dislike in dislikes:
-        video = Video.query.get(dislike.video_id)
-        if video:
-            dislike_videos.append({
-                'id': video.id,
-                'filename': video.filename,
-                'thumbnail_url': f'/api/thumbnails/{os.path.basename(video.thumbnail_path)}' if video.thumbnail_path else None
-            })
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', type=int)
+    after = request.args.get('after')
+    
+    if not per_page and not after:
+        # 完整列表：连接查询逐批读取并流式输出
+        videos = db.session.query(Video)\
+            .join(Dislike, Dislike.video_id == Video.id)\
+            .filter(Dislike.user_id == user_id)\
+            .order_by(Dislike.id)\
+            .yield_per(500)
+        return Response(stream_with_context(stream_json_array(videos)), mimetype='application/json')
     
-    return jsonify(dislike_videos)
+    per_page = per_page or 50
+    with_total = request.args.get('with_total', 'false' if after else 'true').lower() == 'true'
+    total_dislikes = Dislike.query.filter_by(user_id=user_id).count() if with_total else None
+    try:
+        videos, has_next, next_cursor = interaction_video_page(Dislike, user_id, page, per_page, after)
+    except ValueError:
+        return jsonify({'error': '无效的分页游标'}), 400
+    
+    return jsonify({
+        'items': serialize_videos(videos),
+        'total': total_dislikes,
+        'page': page,
+        'per_page': per_page,
+        'total_pages': (total_dislikes + per_page - 1) // per_page if with_total else None,
+        'has_next': has_next,
+        'next_cursor': next_cursor
+    })
 
 @app.route('/api/dislikes', methods=['POST'])
 def add_dislike():
@@ -564,8 +2829,14 @@ def add_dislike():
         return jsonify({'error': '用户ID和视频ID不能为空'}), 400
     
     try:
+        if interaction_buffer is not None:
+            # 延迟写入：合并后批量提交（写入时递增讨厌列表版本）
+            if not buffer_interaction(Dislike, int(data['user_id']), int(data['video_id']), True):
+                return jsonify({'error': '讨厌失败，可能已经讨厌过'}), 400
+            return jsonify({'status': 'success'})
         dislike = Dislike(user_id=data['user_id'], video_id=data['video_id'])
         db.session.add(dislike)
+        bump_dislike_version(data['user_id'])
         db.session.commit()
         return jsonify({'status': 'success'})
     except Exception as e:
@@ -581,9 +2852,15 @@ def remove_dislike():
     if not user_id or not video_id:
         return jsonify({'error': '用户ID和视频ID不能为空'}), 400
     
+    if interaction_buffer is not None:
+        if not buffer_interaction(Dislike, user_id, video_id, False):
+            return jsonify({'error': '讨厌记录不存在'}), 404
+        return jsonify({'status': 'success'})
+    
     dislike = Dislike.query.filter_by(user_id=user_id, video_id=video_id).first()
     if dislike:
         db.session.delete(dislike)
+        bump_dislike_version(user_id)
         db.session.commit()
         return jsonify({'status': 'success'})
     return jsonify({'error': '讨厌记录不存在'}), 404
@@ -597,8 +2874,26 @@ def check_dislike():
     if not user_id or not video_id:
         return jsonify({'error': '用户ID和视频ID不能为空'}), 400
     
-    dislike = Dislike.query.filter_by(user_id=user_id, video_id=video_id).first()
-    return jsonify({'is_disliked': dislike is not None})
+    return jsonify({'is_disliked': has_interaction(Dislike, user_id, video_id)})
+
+@app.route('/api/interactions', methods=['GET'])
+def get_interactions():
+    """批量查询用户对多个视频的收藏/讨厌状态（代替逐个视频调用check接口）"""
+    user_id = request.args.get('user_id', type=int)
+    video_ids = []
+    try:
+        for value in request.args.getlist('video_ids') + request.args.getlist('video_id'):
+            video_ids += [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        return jsonify({'error': '视频ID格式不正确'}), 400
+    
+    if not user_id or not video_ids:
+        return jsonify({'error': '用户ID和视频ID不能为空'}), 400
+    if len(video_ids) > INTERACTION_BATCH_LIMIT:
+        return jsonify({'error': f'一次最多查询{INTERACTION_BATCH_LIMIT}个视频'}), 400
+    
+    states = interaction_states(user_id, video_ids)
+    return jsonify({'items': {str(video_id): state for video_id, state in states.items()}})
 
 # 管理员API - 删除讨厌内容（包括文件和数据库记录）
 @app.route('/api/admin/delete-dislike-content', methods=['DELETE'])
@@ -618,6 +2913,9 @@ def admin_delete_dislike_content():
         return jsonify({'error': '视频ID不能为空'}), 400
     
     try:
+        # 先写入延迟写入缓冲中的讨厌操作
+        flush_interactions()
+        
         # 获取视频信息
         video = Video.query.get(video_id)
         if not video:
@@ -625,13 +2923,14 @@ def admin_delete_dislike_content():
         
         # 记录文件路径用于删除
         video_file_path = video.filepath
-        thumbnail_path = video.thumbnail_path
+        thumbnail_paths = releasable_thumbnail_files(video)
         
         # 删除所有相关的讨厌记录
         Dislike.query.filter_by(video_id=video_id).delete()
         
         # 删除视频记录
         db.session.delete(video)
+        bump_library_version()
         db.session.commit()
         
         # 删除物理文件
@@ -640,9 +2939,8 @@ def admin_delete_dislike_content():
             os.remove(video_file_path)
             deleted_files.append(video_file_path)
         
-        if thumbnail_path and os.path.exists(thumbnail_path):
-            os.remove(thumbnail_path)
-            deleted_files.append(thumbnail_path)
+        deleted_files += remove_thumbnail_files(thumbnail_paths)
+        compact_thumbnail_pack()
         
         return jsonify({
             'status': 'success',
@@ -669,6 +2967,9 @@ def admin_delete_all_dislike_content():
         return jsonify({'error': '权限不足'}), 403
     
     try:
+        # 先写入延迟写入缓冲中的讨厌操作
+        flush_interactions()
+        
         # 获取所有讨厌的视频ID
         disliked_video_ids = [d.video_id for d in Dislike.query.all()]
         
@@ -685,24 +2986,25 @@ def admin_delete_all_dislike_content():
         Dislike.query.delete()
         
         # 删除视频记录和相关文件
+        deleting_ids = {video.id for video in disliked_videos}
         for video in disliked_videos:
             video_file_path = video.filepath
-            thumbnail_path = video.thumbnail_path
+            thumbnail_paths = releasable_thumbnail_files(video, deleting_ids)
             
             # 删除物理文件
             if os.path.exists(video_file_path):
                 os.remove(video_file_path)
                 deleted_files.append(video_file_path)
             
-            if thumbnail_path and os.path.exists(thumbnail_path):
-                os.remove(thumbnail_path)
-                deleted_files.append(thumbnail_path)
+            deleted_files += remove_thumbnail_files(thumbnail_paths)
             
             # 删除视频记录
             db.session.delete(video)
             deleted_video_ids.append(video.id)
         
+        bump_library_version()
         db.session.commit()
+        compact_thumbnail_pack()
         
         return jsonify({
             'status': 'success',
@@ -743,10 +3045,263 @@ def change_password():
         db.session.rollback()
         return jsonify({'error': f'密码修改失败: {str(e)}'}), 500
 
+# 后台任务引擎
+# 每个任务由一个执行线程驱动，条目在有界线程池中并行处理，定期提交断点；
+# 执行进程通过心跳声明占用，心跳超时的任务会被其他进程（或重启后的进程）接管并从断点继续
+JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+JOB_ACTIVE_STATUSES = ('running',)
+
+def job_to_dict(job, with_failures=False):
+    data = {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'total': job.total,
+        'processed': job.processed,
+        'succeeded': job.succeeded,
+        'failed': job.failed,
+        'progress': round(job.processed * 100 / job.total, 1) if job.total else (100.0 if job.status == 'completed' else 0.0),
+        'cancel_requested': job.cancel_requested,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+    if with_failures:
+        failures = JobFailure.query.filter_by(job_id=job.id).order_by(JobFailure.id.desc()).limit(100).all()
+        data['failures'] = [{'item_id': f.item_id, 'item': f.item, 'error': f.error} for f in failures]
+    return data
+
+def start_job(kind, params=None, total=0, unless_since=None):
+    """创建后台任务并在当前进程中开始执行；同类任务已在执行时直接返回该任务
+    
+    判断和创建在同一条INSERT语句中完成，多个进程同时调用时只有一个能创建。
+    传入unless_since时，在此时间之后创建过的同类任务（包括已结束的）也视为已存在。
+    """
+    existing = Job.status.in_(JOB_ACTIVE_STATUSES)
+    if unless_since is not None:
+        existing = db.or_(existing, Job.created_at >= unless_since)
+    existing = db.exists().where(Job.kind == kind, existing)
+    
+    now = datetime.utcnow()
+    columns = {
+        'kind': kind,
+        'params': json.dumps(params or {}),
+        'total': total,
+        'status': 'running',
+        'owner': JOB_OWNER,
+        'heartbeat_at': now,
+        'created_at': now
+    }
+    claim = db.insert(Job).from_select(
+        list(columns),
+        db.select(*[db.literal(value, Job.__table__.c[name].type) for name, value in columns.items()])
+            .where(~existing)
+    )
+    # 先结束之前的读事务，INSERT在取得写锁后才判断，看到的是其他进程已提交的最新任务
+    db.session.commit()
+    claimed = db.session.execute(claim).rowcount
+    db.session.commit()
+    
+    job = Job.query.filter(Job.kind == kind).order_by(Job.id.desc()).first()
+    if claimed:
+        _launch_job(job.id)
+    return job
+
+def schedule_startup_scan():
+    """启动时在后台增量扫描媒体库，不阻塞进程开始处理请求
+    
+    多个worker或副本同时启动时只有一个进程执行扫描（以任务记录作为租约，心跳超时后由其他进程接管），
+    STARTUP_SCAN_COOLDOWN秒内已扫描过时不再扫描。
+    """
+    cooldown = datetime.utcnow() - timedelta(seconds=app.config['STARTUP_SCAN_COOLDOWN'])
+    job = start_job('scan', {'incremental': True}, unless_since=cooldown)
+    if job.owner == JOB_OWNER and job.status == 'running':
+        print(f"🎯 启动扫描任务 #{job.id} 已在后台运行")
+
+def _job_owner_alive(owner):
+    """任务的执行进程是否可能仍在运行：同一主机上的进程直接按PID检查，其它主机只能依靠心跳"""
+    host, _, rest = (owner or '').partition(':')
+    pid = rest.partition(':')[0]
+    if os.name != 'posix' or host != socket.gethostname() or not pid.isdigit():
+        return True
+    if int(pid) == os.getpid():
+        # PID被本进程复用，说明原进程已退出
+        return owner == JOB_OWNER
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def resume_jobs():
+    """接管执行进程已退出（同一主机上的进程已不存在，或心跳超时）的未完成任务，从断点继续执行"""
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+    for job in Job.query.filter(Job.status.in_(JOB_ACTIVE_STATUSES), Job.owner != JOB_OWNER).all():
+        if job.heartbeat_at and job.heartbeat_at >= cutoff and _job_owner_alive(job.owner):
+            continue
+        # 条件更新保证多个进程中只有一个能接管
+        claimed = Job.query.filter(Job.id == job.id, Job.owner == job.owner)\
+            .update({'owner': JOB_OWNER, 'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            print(f"🔄 恢复后台任务 #{job.id}（{job.kind}），断点: {job.cursor}")
+            _launch_job(job.id)
+
+def _supervise_jobs():
+    while True:
+        time.sleep(app.config['JOB_STALE_SECONDS'] / 2)
+        with app.app_context():
+            try:
+                resume_jobs()
+            except Exception as e:
+                db.session.rollback()
+                print(f"检查后台任务失败: {e}")
+
+def start_job_supervisor():
+    """定期接管执行进程已退出的任务，不依赖管理员查询任务列表或进程重启"""
+    threading.Thread(target=_supervise_jobs, name='job-supervisor', daemon=True).start()
+
+def _launch_job(job_id):
+    threading.Thread(target=_run_job, args=(job_id,), name=f'job-{job_id}', daemon=True).start()
+
+def _job_heartbeat(job_id, done):
+    while not done.wait(app.config['JOB_STALE_SECONDS'] / 4):
+        with app.app_context():
+            try:
+                Job.query.filter_by(id=job_id, owner=JOB_OWNER).update({'heartbeat_at': datetime.utcnow()})
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"更新任务心跳失败: {e}")
+
+def _run_job(job_id):
+    done = threading.Event()
+    threading.Thread(target=_job_heartbeat, args=(job_id, done), daemon=True).start()
+    with app.app_context():
+        job = Job.query.get(job_id)
+        try:
+            JOB_RUNNERS[job.kind](job)
+            if job.status == 'running':
+                job.status = 'completed'
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ 后台任务 #{job_id} 失败: {e}")
+            print(f"🔍 详细错误信息: {traceback.format_exc()}")
+            job = Job.query.get(job_id)
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            done.set()
+        job.finished_at = datetime.utcnow()
+        if not _job_still_owned(job_id):
+            db.session.rollback()
+            print(f"⚠️ 后台任务 #{job_id} 已由其他进程接管，本进程停止执行")
+            return
+        db.session.commit()
+        print(f"🏁 后台任务 #{job_id}（{job.kind}）结束: {job.status}")
+
+def _job_still_owned(job_id):
+    """在当前写事务中确认任务仍由本进程执行并更新心跳
+    
+    SQLite同一时间只有一个写事务，确认之后到提交之前任务不会被其他进程接管。
+    """
+    return Job.query.filter_by(id=job_id, owner=JOB_OWNER)\
+        .update({'heartbeat_at': datetime.utcnow()}, synchronize_session=False) > 0
+
+def _job_checkpoint(job):
+    """提交断点并检查是否被取消或被其他进程接管，返回False表示任务应停止"""
+    if not _job_still_owned(job.id):
+        # 丢弃本段结果，由接管的进程从上一个断点重新处理
+        db.session.rollback()
+        return False
+    db.session.commit()
+    # 提交后对象过期，重新读取时可以看到其他进程写入的取消请求
+    if job.cancel_requested:
+        job.status = 'cancelled'
+        db.session.commit()
+        return False
+    return True
+
+def _generate_video_thumbnail(video_id, video_path, thumbnail_path, time_position):
+    """在线程池中执行：生成单个视频的缩略图并移入内容寻址存储，返回(视频ID, 错误信息, (哈希, 存储路径))
+    
+    单个视频的任何异常（如磁盘已满）都作为该视频的错误信息返回，记为失败项，不影响整个任务。
+    """
+    if not os.path.exists(video_path):
+        return video_id, '视频文件不存在', None
+    try:
+        with thumbnail_staging(thumbnail_path) as staging_path:
+            if not generate_thumbnail(video_path, staging_path, time_position):
+                return video_id, '缩略图生成失败', None
+            return video_id, None, store_thumbnail(staging_path)
+    except Exception as e:
+        return video_id, f'保存缩略图失败: {e}', None
+
+def _run_thumbnail_job(job):
+    """批量生成缩略图：按视频ID顺序分段处理，每段结束提交断点"""
+    chunk_size = max(app.config['JOB_CHECKPOINT_SIZE'], app.config['JOB_WORKERS'])
+    with ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS']) as executor:
+        while True:
+            videos = Video.query.filter(Video.id > job.cursor).order_by(Video.id).limit(chunk_size).all()
+            if not videos:
+                break
+            
+            futures = []
+            video_map = {}
+            for video in videos:
+                if thumbnail_exists(video.thumbnail_path):
+                    # 旧版缩略图迁入内容寻址存储
+                    adopt_thumbnail(video)
+                    continue
+                video_path = os.path.join(app.config['MEDIA_FOLDER'], video.filename)
+                video_map[video.id] = (video, _thumbnail_file_path(video))
+                futures.append(executor.submit(_generate_video_thumbnail, video.id, video_path,
+                                               video_map[video.id][1], thumbnail_time_position(video, commit=False)))
+            
+            for future in futures:
+                video_id, error, stored = future.result()
+                video, thumbnail_path = video_map[video_id]
+                if error:
+                    print(f"❌ {error}: {video.filename}")
+                    job.failed += 1
+                    db.session.add(JobFailure(job_id=job.id, item_id=video.id, item=video.filename, error=error))
+                else:
+                    video.thumbnail_hash, video.thumbnail_path = stored
+                    job.succeeded += 1
+            
+            job.processed += len(videos)
+            job.cursor = videos[-1].id
+            if not _job_checkpoint(job):
+                return
+    
+    job.result = json.dumps({
+        'generated_count': job.succeeded,
+        'failed_count': job.failed,
+        'existing_thumbnails': job.processed - job.succeeded - job.failed
+    })
+
+def _run_scan_job(job):
+    """后台扫描媒体库（扫描本身可重入，中断后重新执行会跳过已入库和已探测的文件）"""
+    params = json.loads(job.params or '{}')
+    stats = scan_media_folder(params.get('incremental', True))
+    job.total = job.processed = stats['files_found']
+    job.succeeded = stats['added']
+    job.result = json.dumps(stats, ensure_ascii=False)
+
+JOB_RUNNERS = {
+    'thumbnails': _run_thumbnail_job,
+    'scan': _run_scan_job
+}
+# 在断点检查取消请求的任务类型（扫描任务不分段，不能中途取消）
+JOB_CANCELLABLE_KINDS = ('thumbnails',)
+
 # 管理员API - 批量生成缩略图
 @app.route('/api/admin/generate-thumbnails', methods=['POST'])
 def admin_generate_thumbnails():
-    """为所有没有缩略图的视频生成缩略图"""
+    """在后台为所有没有缩略图的视频生成缩略图，返回任务信息（通过/api/admin/jobs/<id>查询进度）"""
     # 检查用户权限
     user_id = request.headers.get('Authorization', '').replace('Bearer ', '')
     if not user_id:
@@ -757,67 +3312,17 @@ def admin_generate_thumbnails():
         return jsonify({'error': '权限不足'}), 403
     
     try:
-        # 获取所有视频
-        all_videos = Video.query.all()
-        total_videos = len(all_videos)
-        
-        # 统计已有缩略图的视频
-        existing_thumbnails = 0
-        videos_without_thumbnails = []
-        
-        for video in all_videos:
-            if video.thumbnail_path and os.path.exists(video.thumbnail_path):
-                existing_thumbnails += 1
-            else:
-                videos_without_thumbnails.append(video)
-        
-        generated_count = 0
-        failed_videos = []
-        
-        print(f"🎯 开始生成缩略图统计:")
-        print(f"   - 总视频数: {total_videos}")
-        print(f"   - 已有缩略图: {existing_thumbnails}")
-        print(f"   - 需要生成: {len(videos_without_thumbnails)}")
-        
-        for i, video in enumerate(videos_without_thumbnails):
-            print(f"🔄 处理第 {i+1}/{len(videos_without_thumbnails)} 个视频: {video.filename}")
-            
-            video_path = os.path.join(app.config['MEDIA_FOLDER'], video.filename)
-            if not os.path.exists(video_path):
-                print(f"❌ 视频文件不存在: {video_path}")
-                failed_videos.append({'video_id': video.id, 'filename': video.filename, 'error': '视频文件不存在'})
-                continue
-            
-            # 创建缩略图文件名
-            thumbnail_filename = f"{video.id}_{os.path.basename(video.filename)}.jpg"
-            thumbnail_path = os.path.join(app.config['THUMBNAIL_FOLDER'], thumbnail_filename)
-            
-            # 生成缩略图
-            if generate_thumbnail(video_path, thumbnail_path):
-                # 更新数据库
-                video.thumbnail_path = thumbnail_path
-                generated_count += 1
-                print(f"✅ 成功生成缩略图: {thumbnail_filename}")
-            else:
-                failed_videos.append({'video_id': video.id, 'filename': video.filename, 'error': '缩略图生成失败'})
-                print(f"❌ 缩略图生成失败: {video.filename}")
-        
-        db.session.commit()
-        
+        job = start_job('thumbnails', total=Video.query.count())
+        print(f"🎯 缩略图生成任务 #{job.id} 已在后台运行")
         return jsonify({
-            'status': 'success',
-            'message': f'缩略图生成完成，总视频: {total_videos}，已有缩略图: {existing_thumbnails}，新增: {generated_count}，失败: {len(failed_videos)}',
-            'total_videos': total_videos,
-            'existing_thumbnails': existing_thumbnails,
-            'generated_count': generated_count,
-            'failed_count': len(failed_videos),
-            'failed_videos': failed_videos
-        })
+            'status': 'accepted',
+            'message': f'缩略图生成任务已在后台运行（任务ID: {job.id}），已处理 {job.processed}/{job.total}',
+            'job': job_to_dict(job)
+        }), 202
         
     except Exception as e:
         db.session.rollback()
         print(f"❌ 批量生成缩略图失败: {str(e)}")
-        import traceback
         print(f"🔍 详细错误信息: {traceback.format_exc()}")
         return jsonify({'error': f'批量生成缩略图失败: {str(e)}'}), 500
 
@@ -836,117 +3341,56 @@ def admin_refresh_files():
     try:
         # 获取媒体目录路径
         media_dir = app.config['MEDIA_FOLDER']
-        print(f"🎯 开始智能扫描媒体目录: {media_dir}")
+        # 默认增量扫描，full=true时忽略目录指纹重新扫描所有目录
+        incremental = request.args.get('full', 'false').lower() != 'true'
+        
+        # background=true时作为后台任务执行，立即返回任务信息
+        if request.args.get('background', 'false').lower() == 'true':
+            job = start_job('scan', {'incremental': incremental})
+            return jsonify({
+                'status': 'accepted',
+                'message': f'文件列表刷新任务已在后台运行（任务ID: {job.id}）',
+                'job': job_to_dict(job)
+            }), 202
+        
+        print(f"🎯 开始智能扫描媒体目录: {media_dir}（{'增量' if incremental else '全量'}）")
         print(f"📁 媒体目录是否存在: {os.path.exists(media_dir)}")
         
         if os.path.exists(media_dir):
             print(f"📂 媒体目录权限: {oct(os.stat(media_dir).st_mode)}")
         
-        # 获取当前数据库中的所有视频记录
-        existing_videos = Video.query.all()
-        existing_filepaths = {v.filepath: v for v in existing_videos}
-        existing_filenames = {v.filename: v for v in existing_videos}
-        
-        print(f"🗃️ 当前数据库中的视频记录数: {len(existing_videos)}")
+        # 智能更新数据库（与启动扫描、/api/scan使用同一扫描引擎）
+        stats = scan_media_folder(incremental)
         
-        # 扫描文件系统中的视频文件
-        video_files = []
-        scanned_dirs = []
-        file_system_files = set()
-        
-        # 递归扫描所有子目录
-        for root, dirs, files in os.walk(media_dir):
-            scanned_dirs.append(root)
-            print(f"🔍 扫描目录: {root}")
-            print(f"   - 子目录: {dirs}")
-            print(f"   - 文件数: {len(files)}")
-            
-            for file in files:
-                if file.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm')):
-                    file_path = os.path.join(root, file)
-                    relative_path = os.path.relpath(file_path, media_dir)
-                    
-                    print(f"   ✅ 找到视频文件: {file}")
-                    print(f"     完整路径: {file_path}")
-                    print(f"     相对路径: {relative_path}")
-                    print(f"     文件是否存在: {os.path.exists(file_path)}")
-                    
-                    video_files.append({
-                        'filename': file,
-                        'filepath': relative_path,
-                        'full_path': file_path
-                    })
-                    file_system_files.add(relative_path)
-        
-        print(f"📊 扫描完成统计:")
-        print(f"   - 扫描目录总数: {len(scanned_dirs)}")
-        print(f"   - 找到视频文件数: {len(video_files)}")
-        
-        # 智能更新数据库
-        added_count = 0
-        removed_count = 0
-        unchanged_count = 0
-        
-        # 修复路径匹配：将数据库中的完整路径转换为相对路径进行比较
-        existing_relative_paths = {}
-        for filepath, video in existing_filepaths.items():
-            try:
-                relative_path = os.path.relpath(filepath, media_dir)
-                existing_relative_paths[relative_path] = video
-            except ValueError:
-                # 如果路径转换失败，可能是跨磁盘路径，直接使用文件名
-                existing_relative_paths[video.filename] = video
-        
-        # 1. 删除数据库中不存在对应文件的记录
-        for relative_path, video in existing_relative_paths.items():
-            if relative_path not in file_system_files:
-                print(f"🗑️ 删除数据库中不存在的文件记录: {relative_path}")
-                db.session.delete(video)
-                removed_count += 1
-        
-        # 2. 添加新增的文件到数据库
-        for video_data in video_files:
-            if video_data['filepath'] not in existing_relative_paths:
-                # 检查是否为纵向视频
-                if is_portrait_video(video_data['full_path']):
-                    video = Video(
-                        filename=video_data['filepath'],
-                        filepath=video_data['full_path']
-                    )
-                    db.session.add(video)
-                    print(f"💾 添加新增视频到数据库: {video_data['filepath']}")
-                    added_count += 1
-                else:
-                    print(f"⏭️ 跳过横向视频: {video_data['filepath']}")
-            else:
-                unchanged_count += 1
-        
-        db.session.commit()
+        final_total = Video.query.count()
         print("✅ 智能更新数据库完成")
         print(f"📈 更新统计:")
-        print(f"   - 新增视频: {added_count}")
-        print(f"   - 删除记录: {removed_count}")
-        print(f"   - 保持不变: {unchanged_count}")
-        print(f"   - 最终总数: {Video.query.count()}")
+        print(f"   - 扫描目录: {stats['scanned_dirs']}")
+        print(f"   - 新增视频: {stats['added']}")
+        print(f"   - 跳过横向视频: {stats['skipped']}")
+        print(f"   - 删除记录: {stats['removed']}")
+        print(f"   - 保持不变: {stats['unchanged']}")
+        print(f"   - 最终总数: {final_total}")
         
         return jsonify({
             'message': f'智能更新文件列表完成',
             'statistics': {
-                'total_files_found': len(video_files),
-                'videos_added': added_count,
-                'records_removed': removed_count,
-                'videos_unchanged': unchanged_count,
-                'final_total': Video.query.count()
+                'total_files_found': stats['files_found'],
+                'videos_added': stats['added'],
+                'records_removed': stats['removed'],
+                'videos_unchanged': stats['unchanged'],
+                'final_total': final_total
             },
             'details': {
                 'media_directory': media_dir,
-                'scanned_directories': len(scanned_dirs),
+                'incremental': incremental,
+                'scanned_directories': stats['scanned_dirs'],
                 'file_operations': {
-                    'added': [v['filepath'] for v in video_files if v['filepath'] not in existing_filenames],
-                    'removed': [filepath for filepath in existing_filepaths.keys() if filepath not in file_system_files]
+                    'added': stats['added_files'],
+                    'removed': stats['removed_files']
                 }
             },
-            'summary': f'更新完成：扫描到{len(video_files)}个视频文件，新增{added_count}个文件，清理{removed_count}个不存在文件数据，最新总文件数：{Video.query.count()}'
+            'summary': f'更新完成：扫描{stats["scanned_dirs"]}个有变化的目录，找到{stats["files_found"]}个视频文件，新增{stats["added"]}个文件，清理{stats["removed"]}个不存在文件数据，最新总文件数：{final_total}'
         })
         
     except Exception as e:
@@ -956,11 +3400,73 @@ def admin_refresh_files():
         print(f"🔍 详细错误信息: {traceback.format_exc()}")
         return jsonify({'error': f'刷新文件列表失败: {str(e)}'}), 500
 
+# 管理员API - 后台任务进度查询
+@app.route('/api/admin/jobs', methods=['GET'])
+def admin_list_jobs():
+    """获取最近的后台任务列表"""
+    # 检查用户权限
+    user_id = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not user_id:
+        return jsonify({'error': '未授权'}), 401
+    
+    user = User.query.get(user_id)
+    if not user or not user.is_admin:
+        return jsonify({'error': '权限不足'}), 403
+    
+    resume_jobs()
+    jobs = Job.query.order_by(Job.id.desc()).limit(50).all()
+    return jsonify([job_to_dict(job) for job in jobs])
+
+@app.route('/api/admin/jobs/<int:job_id>', methods=['GET'])
+def admin_get_job(job_id):
+    """获取后台任务进度（包含最近的失败条目）"""
+    # 检查用户权限
+    user_id = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not user_id:
+        return jsonify({'error': '未授权'}), 401
+    
+    user = User.query.get(user_id)
+    if not user or not user.is_admin:
+        return jsonify({'error': '权限不足'}), 403
+    
+    # 执行进程已退出的任务在查询时被接管
+    resume_jobs()
+    job = Job.query.get_or_404(job_id)
+    return jsonify(job_to_dict(job, with_failures=True))
+
+@app.route('/api/admin/jobs/<int:job_id>', methods=['DELETE'])
+def admin_cancel_job(job_id):
+    """取消后台任务（执行线程在下一个断点停止）"""
+    # 检查用户权限
+    user_id = request.headers.get('Authorization', '').replace('Bearer ', '')
+    if not user_id:
+        return jsonify({'error': '未授权'}), 401
+    
+    user = User.query.get(user_id)
+    if not user or not user.is_admin:
+        return jsonify({'error': '权限不足'}), 403
+    
+    job = Job.query.get_or_404(job_id)
+    if job.status not in JOB_ACTIVE_STATUSES:
+        return jsonify({'error': '任务已结束，无法取消'}), 400
+    if job.kind not in JOB_CANCELLABLE_KINDS:
+        return jsonify({'error': '该类任务不支持中途取消'}), 400
+    
+    job.cancel_requested = True
+    db.session.commit()
+    return jsonify({'status': 'success', 'message': '已请求取消任务', 'job': job_to_dict(job)})
+
 # 应用启动时自动初始化数据库
 def initialize_database():
-    """在应用启动时初始化数据库"""
+    """在应用启动时初始化数据库（只建表和升级结构，媒体扫描在后台执行）"""
     with app.app_context():
         init_db()
+        # 继续执行上次进程退出时未完成的后台任务
+        resume_jobs()
+        start_job_supervisor()
+        if app.config['STARTUP_SCAN']:
+            schedule_startup_scan()
+        start_media_watcher()
 
 # 在应用启动时立即初始化数据库
 initialize_database()
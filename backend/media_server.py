@@ -0,0 +1,445 @@
+"""异步媒体服务
+
+一个进程内用asyncio同时处理大量播放连接：/api/videos/file/、/api/thumbnails/和已生成的HLS分片由事件循环直接发送，
+文件内容通过loop.sendfile写入连接（Linux上为os.sendfile零拷贝），支持Range、ETag、If-Range和条件请求；
+查找文件（stat、打包存储、数据库）在默认线程池中执行，不阻塞事件循环。
+其他请求交给线程池中的Flask应用处理，JSON API的行为与gunicorn下相同；响应体边生成边发送，
+没有Content-Length的流式响应使用分块传输编码。
+
+不使用Nginx转发视频（VIDEO_SERVING=x-accel）的部署可以用它代替gunicorn启动：
+
+    python media_server.py
+"""
+import asyncio
+import contextvars
+import io
+import itertools
+import mimetypes
+import os
+import re
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import unquote, unquote_to_bytes, urlsplit, parse_qs
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import (http_date, parse_accept_header, parse_date, parse_etags,
+                           parse_if_range_header, parse_range_header, quote_etag)
+from werkzeug.security import safe_join
+
+from app import (app, hls_segment_file, resolve_thumbnail_filename, select_thumbnail_variant, thumbnail_pack,
+                 THUMBNAIL_FORMATS, THUMBNAIL_IMMUTABLE_MAX_AGE)
+
+# 监听地址和端口、执行Flask请求的线程数、保持连接的空闲秒数、请求体最大字节数（默认使用Flask的MAX_CONTENT_LENGTH，未设置时为16MB）
+MEDIA_SERVER_HOST = os.environ.get('MEDIA_SERVER_HOST', '0.0.0.0')
+MEDIA_SERVER_PORT = int(os.environ.get('MEDIA_SERVER_PORT', os.environ.get('FLASK_PORT', '5003')))
+MEDIA_SERVER_API_THREADS = int(os.environ.get('MEDIA_SERVER_API_THREADS', '16'))
+MEDIA_SERVER_KEEPALIVE = float(os.environ.get('MEDIA_SERVER_KEEPALIVE', '75'))
+MEDIA_SERVER_MAX_BODY = int(os.environ.get('MEDIA_SERVER_MAX_BODY',
+                                           str(app.config.get('MAX_CONTENT_LENGTH') or 16 * 1024 * 1024)))
+
+# 请求头最大长度
+MAX_HEADER_SIZE = 64 * 1024
+
+# Flask响应体每次从线程池取回并写入连接的大致字节数
+STREAM_CHUNK_SIZE = 64 * 1024
+
+VIDEO_PREFIX = '/api/videos/file/'
+THUMBNAIL_PREFIX = '/api/thumbnails/'
+HLS_SEGMENT_PATH = re.compile(r'^/api/videos/(\d+)/hls/([^/]+)$')
+
+REASONS = {
+    100: 'Continue', 200: 'OK', 202: 'Accepted', 204: 'No Content', 206: 'Partial Content',
+    301: 'Moved Permanently', 302: 'Found', 304: 'Not Modified', 400: 'Bad Request',
+    401: 'Unauthorized', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+    409: 'Conflict', 411: 'Length Required', 413: 'Content Too Large', 415: 'Unsupported Media Type',
+    416: 'Range Not Satisfiable', 429: 'Too Many Requests', 431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error', 503: 'Service Unavailable'
+}
+
+class HTTPRequest:
+    """解析后的请求行和请求头（头名称为小写，重复的头以逗号合并）"""
+    
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = parts.query
+    
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+def parse_request_head(data):
+    """解析请求头部分，格式不正确时抛出ValueError"""
+    lines = data.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ')
+    if not version.startswith('HTTP/1.'):
+        raise ValueError(version)
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, value = line.split(':', 1)
+        name = name.strip().lower()
+        value = value.strip()
+        headers[name] = f'{headers[name]}, {value}' if name in headers else value
+    return HTTPRequest(method, target, version, headers)
+
+class MediaServer:
+    """媒体连接在事件循环中处理，Flask请求在线程池中执行"""
+    
+    def __init__(self, api_threads):
+        self._executor = ThreadPoolExecutor(max_workers=api_threads, thread_name_prefix='api')
+    
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), MEDIA_SERVER_KEEPALIVE)
+                except asyncio.LimitOverrunError:
+                    await self._send_error(writer, 431, keep_alive=False)
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                try:
+                    request = parse_request_head(head[:-4])
+                except ValueError:
+                    await self._send_error(writer, 400, keep_alive=False)
+                    break
+                
+                keep_alive = None
+                if (request.path.startswith(VIDEO_PREFIX) or request.path.startswith(THUMBNAIL_PREFIX)
+                        or HLS_SEGMENT_PATH.match(request.path)):
+                    keep_alive = await self._handle_media(request, writer)
+                if keep_alive is None:
+                    keep_alive = await self._handle_api(request, reader, writer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _write_head(self, writer, status, headers, keep_alive):
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}']
+        lines += [f'{name}: {value}' for name, value in headers]
+        lines.append(f'Date: {http_date()}')
+        lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+    
+    async def _send_error(self, writer, status, keep_alive=True, headers=(), message=None):
+        body = app.json.dumps({'error': message or REASONS[status]}).encode()
+        await self._write_head(writer, status, list(headers) + [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body)))
+        ], keep_alive)
+        writer.write(body)
+        await writer.drain()
+        return keep_alive
+    
+    # 媒体文件
+    
+    async def _handle_media(self, request, writer):
+        """发送视频、缩略图或已生成的HLS分片，返回连接是否保持；分片尚未生成时返回None，交给Flask等待转封装"""
+        hls_segment = HLS_SEGMENT_PATH.match(request.path)
+        if hls_segment and request.method not in ('GET', 'HEAD'):
+            return None
+        keep_alive = request.keep_alive
+        if request.headers.get('content-length', '0') != '0' or 'transfer-encoding' in request.headers:
+            # 媒体请求不应带请求体，无法确定请求边界时关闭连接
+            keep_alive = False
+        if request.method not in ('GET', 'HEAD'):
+            return await self._send_error(writer, 405, keep_alive, [('Allow', 'GET, HEAD')])
+        
+        # 查找文件会stat、读取打包存储或查询数据库，放到线程池中执行
+        loop = asyncio.get_running_loop()
+        if hls_segment:
+            source = await loop.run_in_executor(None, self._resolve_hls_segment,
+                                                int(hls_segment.group(1)), hls_segment.group(2))
+            if source is None:
+                return None
+        elif request.path.startswith(VIDEO_PREFIX):
+            source = await loop.run_in_executor(None, self._resolve_video,
+                                                unquote(request.path[len(VIDEO_PREFIX):]))
+            not_found = 'Video not found'
+        else:
+            source = await loop.run_in_executor(None, self._resolve_thumbnail, request,
+                                                unquote(request.path[len(THUMBNAIL_PREFIX):]))
+            not_found = 'Thumbnail not found'
+        if source is None:
+            return await self._send_error(writer, 404, keep_alive, message=not_found)
+        
+        content = source[0]
+        try:
+            return await self._send_media(request, writer, keep_alive, *source)
+        finally:
+            if hasattr(content, 'close'):
+                content.close()
+    
+    async def _send_media(self, request, writer, keep_alive, content, size, mimetype, etag, last_modified, headers):
+        headers += [('Content-Type', mimetype), ('Accept-Ranges', 'bytes'), ('ETag', quote_etag(etag))]
+        if last_modified is not None:
+            headers.append(('Last-Modified', http_date(last_modified)))
+        
+        if self._not_modified(request, etag, last_modified):
+            await self._write_head(writer, 304, headers, keep_alive)
+            return keep_alive
+        
+        offset, length, status = 0, size, 200
+        byte_range = self._requested_range(request, etag, last_modified, size)
+        if byte_range == 'unsatisfiable':
+            return await self._send_error(writer, 416, keep_alive, [('Content-Range', f'bytes */{size}')])
+        if byte_range is not None:
+            offset, end = byte_range
+            length, status = end - offset, 206
+            headers.append(('Content-Range', f'bytes {offset}-{end - 1}/{size}'))
+        headers.append(('Content-Length', str(length)))
+        
+        await self._write_head(writer, status, headers, keep_alive)
+        if request.method == 'HEAD' or length == 0:
+            return keep_alive
+        if hasattr(content, 'fileno'):
+            await asyncio.get_running_loop().sendfile(writer.transport, content, offset, length)
+        else:
+            writer.write(content[offset:offset + length])
+            await writer.drain()
+        return keep_alive
+    
+    @staticmethod
+    def _open_file(path):
+        """打开普通文件，返回(文件对象, stat结果)，文件不存在、不是普通文件或路径无效（如包含空字符）时返回None"""
+        try:
+            f = open(path, 'rb')
+        except (OSError, ValueError):
+            return None
+        stat_result = os.fstat(f.fileno())
+        if not stat.S_ISREG(stat_result.st_mode):
+            f.close()
+            return None
+        return f, stat_result
+    
+    def _resolve_video(self, filename):
+        """返回(已打开的文件, 大小, 类型, ETag, 修改时间, 响应头)，与get_video_file相同不允许越出媒体目录"""
+        video_path = safe_join(app.config['MEDIA_FOLDER'], filename)
+        opened = self._open_file(video_path) if video_path else None
+        if opened is None:
+            return None
+        f, stat_result = opened
+        mimetype = mimetypes.guess_type(video_path)[0] or 'application/octet-stream'
+        return (f, stat_result.st_size, mimetype, self._file_etag(stat_result),
+                self._mtime(stat_result), [('Cache-Control', 'no-cache')])
+    
+    def _resolve_hls_segment(self, video_id, segment):
+        """已生成的HLS分片，与get_hls_segment相同的检查；尚未生成时返回None"""
+        with app.app_context():
+            segment_path = hls_segment_file(video_id, segment)
+        opened = self._open_file(segment_path) if segment_path else None
+        if opened is None:
+            return None
+        f, stat_result = opened
+        return (f, stat_result.st_size, 'video/mp2t', self._file_etag(stat_result),
+                self._mtime(stat_result), [('Cache-Control', 'no-cache')])
+    
+    def _resolve_thumbnail(self, request, filename):
+        """与send_thumbnail使用同样的变体选择，打包存储中的缩略图直接发送内存映射切片"""
+        resolved = resolve_thumbnail_filename(filename)
+        if resolved is None:
+            return None
+        thumbnail_path, immutable = resolved
+        query = parse_qs(request.query)
+        try:
+            width = int(query['w'][0]) if 'w' in query else None
+        except ValueError:
+            width = None
+        accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+        path, fmt = select_thumbnail_variant(thumbnail_path, width, accept)
+        
+        headers = [('Vary', 'Accept')]
+        if immutable:
+            headers.append(('Cache-Control', f'public, max-age={THUMBNAIL_IMMUTABLE_MAX_AGE}, immutable'))
+        else:
+            headers.append(('Cache-Control', 'no-cache'))
+        mimetype = THUMBNAIL_FORMATS[fmt]['mimetype']
+        
+        packed = thumbnail_pack.get(os.path.basename(path)) if thumbnail_pack is not None else None
+        if packed is not None:
+            # 文件名包含内容哈希，作为强ETag
+            return packed, len(packed), mimetype, os.path.basename(path), None, headers
+        opened = self._open_file(path)
+        if opened is None:
+            return None
+        f, stat_result = opened
+        etag = os.path.basename(path) if immutable else self._file_etag(stat_result)
+        return f, stat_result.st_size, mimetype, etag, self._mtime(stat_result), headers
+    
+    @staticmethod
+    def _file_etag(stat_result):
+        return f'{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}'
+    
+    @staticmethod
+    def _mtime(stat_result):
+        return datetime.fromtimestamp(int(stat_result.st_mtime), timezone.utc)
+    
+    @staticmethod
+    def _not_modified(request, etag, last_modified):
+        if 'if-none-match' in request.headers:
+            return parse_etags(request.headers['if-none-match']).contains_weak(etag)
+        since = parse_date(request.headers.get('if-modified-since'))
+        return since is not None and last_modified is not None and last_modified <= since
+    
+    @staticmethod
+    def _requested_range(request, etag, last_modified, size):
+        """返回请求的(起始, 结束)字节区间，不需要部分响应时返回None，区间无法满足时返回'unsatisfiable'"""
+        if request.method != 'GET' or 'range' not in request.headers:
+            return None
+        if 'if-range' in request.headers:
+            # If-Range与当前版本不一致时忽略Range，发送完整内容
+            if_range = parse_if_range_header(request.headers['if-range'])
+            if if_range.etag is not None:
+                if if_range.etag != etag:
+                    return None
+            elif if_range.date is None or if_range.date != last_modified:
+                return None
+        byte_range = parse_range_header(request.headers['range'])
+        if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+            # 无法解析或多段区间时发送完整内容
+            return None
+        return byte_range.range_for_length(size) or 'unsatisfiable'
+    
+    # 其他请求交给Flask
+    
+    async def _handle_api(self, request, reader, writer):
+        keep_alive = request.keep_alive
+        if 'chunked' in request.headers.get('transfer-encoding', '').lower():
+            return await self._send_error(writer, 411, keep_alive=False)
+        try:
+            content_length = int(request.headers.get('content-length', '0'))
+        except ValueError:
+            return await self._send_error(writer, 400, keep_alive=False)
+        if content_length < 0:
+            return await self._send_error(writer, 400, keep_alive=False)
+        if content_length > MEDIA_SERVER_MAX_BODY:
+            # 不读取过大的请求体，回复后关闭连接
+            return await self._send_error(writer, 413, keep_alive=False)
+        if content_length and request.headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await writer.drain()
+        body = await reader.readexactly(content_length) if content_length else b''
+        
+        peer = writer.get_extra_info('peername') or ('', 0)
+        environ = self._wsgi_environ(request, body, peer)
+        # 流式响应的生成器（stream_with_context）在之后的线程中继续执行，所有调用共用同一个上下文
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        status, headers, result, content = await loop.run_in_executor(
+            self._executor, context.run, self._call_wsgi, environ)
+        
+        try:
+            code = int(status.split(' ', 1)[0])
+            names = {name.lower() for name, _ in headers}
+            headers = [(name, value) for name, value in headers
+                       if name.lower() not in ('connection', 'transfer-encoding', 'date')]
+            has_body = request.method != 'HEAD' and code not in (204, 304) and code >= 200
+            chunked = has_body and 'content-length' not in names
+            if chunked:
+                if request.version == 'HTTP/1.0':
+                    # HTTP/1.0客户端不支持分块传输，以关闭连接表示响应结束
+                    chunked = keep_alive = False
+                else:
+                    headers.append(('Transfer-Encoding', 'chunked'))
+            await self._write_head(writer, code, headers, keep_alive)
+            
+            while has_body:
+                chunks = await loop.run_in_executor(self._executor, context.run, self._next_chunks, content)
+                if not chunks:
+                    break
+                data = b''.join(chunks)
+                writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n' if chunked else data)
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+                await writer.drain()
+        except ConnectionError:
+            raise
+        except Exception as e:
+            # 响应头已经发出，只能关闭连接让客户端发现响应不完整
+            print(f"生成响应失败 {request.path}: {e}")
+            return False
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self._executor, context.run, result.close)
+        return keep_alive
+    
+    @staticmethod
+    def _wsgi_environ(request, body, peer):
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote_to_bytes(request.path).decode('latin-1'),
+            'QUERY_STRING': request.query,
+            'SERVER_NAME': MEDIA_SERVER_HOST,
+            'SERVER_PORT': str(MEDIA_SERVER_PORT),
+            'SERVER_PROTOCOL': request.version,
+            'REMOTE_ADDR': peer[0],
+            'REMOTE_PORT': str(peer[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+        for name, value in request.headers.items():
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[key] = value
+            else:
+                environ['HTTP_' + key] = value
+        return environ
+    
+    @staticmethod
+    def _call_wsgi(environ):
+        """在线程池中执行Flask应用，返回(状态, 响应头, WSGI返回值, 响应体迭代器)，响应体由调用方分批取出"""
+        response = []
+        written = []
+        
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return written.append
+        
+        result = app(environ, start_response)
+        return response[0], response[1], result, itertools.chain(written, result)
+    
+    @staticmethod
+    def _next_chunks(iterator):
+        """从响应体迭代器取出约STREAM_CHUNK_SIZE字节，已取完时返回空列表"""
+        chunks = []
+        size = 0
+        for chunk in iterator:
+            if chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_CHUNK_SIZE:
+                    break
+        return chunks
+
+async def serve(host=MEDIA_SERVER_HOST, port=MEDIA_SERVER_PORT):
+    media_server = MediaServer(MEDIA_SERVER_API_THREADS)
+    server = await asyncio.start_server(media_server.handle_connection, host, port,
+                                        limit=MAX_HEADER_SIZE, backlog=1024)
+    print(f"🚀 异步媒体服务已启动: http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    asyncio.run(serve())
@@ -0,0 +1,71 @@
+import threading
+import time
+import unittest
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+class MemoryBuffer(mocaca.InteractionBuffer):
+    """写入内存字典代替数据库"""
+    def __init__(self):
+        super().__init__(interval=60, size=1000)
+        self.stored = {}
+
+    def _write(self, batch):
+        for user_id, entries in batch.items():
+            for (kind, video_id), (present, _) in entries.items():
+                self.stored[(kind, user_id, video_id)] = present
+
+    def read_stored(self, kind, user_id, video_id):
+        return lambda: self.stored.get((kind, user_id, video_id), False)
+
+class InteractionBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buffer = MemoryBuffer()
+
+    def tearDown(self):
+        self.buffer.close()
+
+    def test_concurrent_adds_only_one_succeeds(self):
+        """并发的相同操作只有一个返回True，与直接写入时第二个请求返回400一致"""
+        results = []
+        barrier = threading.Barrier(16)
+        def slow_read():
+            time.sleep(0.01)
+            return False
+        def add():
+            barrier.wait()
+            results.append(self.buffer.set_if_changed('favorite', 1, 7, True, slow_read))
+        threads = [threading.Thread(target=add) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 1)
+
+    def test_rereads_after_flush_during_read(self):
+        """读取数据库期间另一个请求做了同一操作并已写入时，重新读取而不是按旧状态再次记录"""
+        reads = []
+        def read_during_other_request():
+            reads.append(self.buffer.stored.get(('favorite', 1, 7), False))
+            if len(reads) == 1:
+                # 本次读到的是旧状态，随后另一个请求收藏并写入完成
+                other_read = self.buffer.read_stored('favorite', 1, 7)
+                self.assertTrue(self.buffer.set_if_changed('favorite', 1, 7, True, other_read))
+                self.buffer.flush()
+            return reads[-1]
+        self.assertFalse(self.buffer.set_if_changed('favorite', 1, 7, True, read_during_other_request))
+        self.assertEqual(reads, [False, True])
+
+    def test_toggle_uses_pending_state(self):
+        """尚未写入的操作优先于数据库状态：取消刚做的收藏成功，重复取消返回False"""
+        read = self.buffer.read_stored('dislike', 2, 3)
+        self.assertTrue(self.buffer.set_if_changed('dislike', 2, 3, True, read))
+        self.assertTrue(self.buffer.set_if_changed('dislike', 2, 3, False, read))
+        self.assertFalse(self.buffer.set_if_changed('dislike', 2, 3, False, read))
+        self.buffer.flush()
+        self.assertEqual(self.buffer.stored, {('dislike', 2, 3): False})
+        self.assertIsNone(self.buffer.overlay('dislike', 2, 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+def fake_generate_thumbnail(video_path, output_path, time_position='00:00:01'):
+    """分两次写入，第二次写入前等待，模拟ffmpeg写文件的过程"""
+    content = f'thumbnail of {video_path} at {time_position}'.encode()
+    with open(output_path, 'wb') as f:
+        f.write(content[:8])
+        f.flush()
+        time.sleep(0.05)
+        f.write(content[8:])
+    return True
+
+class ThumbnailJobTest(unittest.TestCase):
+    def setUp(self):
+        self.context = mocaca.app.app_context()
+        self.context.push()
+        for model in (mocaca.JobFailure, mocaca.Job, mocaca.Dislike, mocaca.Favorite, mocaca.Video):
+            model.query.delete()
+        mocaca.db.session.commit()
+        self.media_folder = mocaca.app.config['MEDIA_FOLDER']
+        os.makedirs(os.path.join(self.media_folder, 'jobs'), exist_ok=True)
+        patcher = mock.patch.object(mocaca, 'ffprobe_video_metadata', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        mocaca.db.session.remove()
+        self.context.pop()
+
+    def add_videos(self, *names):
+        for name in names:
+            path = os.path.join(self.media_folder, 'jobs', name)
+            with open(path, 'wb') as f:
+                f.write(b'not a real video')
+            mocaca.db.session.add(mocaca.Video(filename=f'jobs/{name}', filepath=path))
+        mocaca.db.session.commit()
+
+    def run_job(self):
+        job = mocaca.Job(kind='thumbnails', status='running', owner=mocaca.JOB_OWNER,
+                         total=mocaca.Video.query.count())
+        mocaca.db.session.add(job)
+        mocaca.db.session.commit()
+        job_id = job.id
+        mocaca._run_job(job_id)
+        mocaca.db.session.remove()
+        return mocaca.db.session.get(mocaca.Job, job_id)
+
+    def test_storage_error_is_recorded_per_video(self):
+        """保存单个缩略图时的异常记为该视频的失败项，任务继续处理其他视频并正常完成"""
+        self.add_videos('ok.mp4', 'disk-full.mp4')
+        store_thumbnail = mocaca.store_thumbnail
+
+        def failing_store(staging_path):
+            if 'disk-full' in staging_path:
+                raise OSError(28, 'No space left on device')
+            return store_thumbnail(staging_path)
+
+        with mock.patch.object(mocaca, 'generate_thumbnail', fake_generate_thumbnail), \
+                mock.patch.object(mocaca, 'store_thumbnail', failing_store):
+            job = self.run_job()
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual((job.processed, job.succeeded, job.failed), (2, 1, 1))
+        failure = mocaca.JobFailure.query.filter_by(job_id=job.id).one()
+        self.assertEqual(failure.item, 'jobs/disk-full.mp4')
+        self.assertIn('No space left on device', failure.error)
+        ok = mocaca.Video.query.filter_by(filename='jobs/ok.mp4').one()
+        self.assertIsNotNone(ok.thumbnail_hash)
+
+    def test_concurrent_renders_use_separate_staging_files(self):
+        """同一视频同时生成（如批量任务和按需请求）时各自写入临时文件，存储的内容都是完整的"""
+        self.add_videos('same.mp4')
+        video = mocaca.Video.query.filter_by(filename='jobs/same.mp4').one()
+        thumbnail_path = mocaca._thumbnail_file_path(video)
+        results = {}
+
+        def render(marker):
+            results[marker] = mocaca._generate_video_thumbnail(video.id, video.filepath, thumbnail_path, marker)
+
+        with mock.patch.object(mocaca, 'generate_thumbnail', fake_generate_thumbnail):
+            threads = [threading.Thread(target=render, args=(marker,)) for marker in ('1.0', '2.0')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        for marker, (_, error, stored) in results.items():
+            self.assertIsNone(error)
+            content = f'thumbnail of {video.filepath} at {marker}'.encode()
+            self.assertEqual(stored[0], hashlib.sha256(content).hexdigest()[:32])
+            with open(stored[1], 'rb') as f:
+                self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(thumbnail_path))
+
+class CancelJobTest(unittest.TestCase):
+    def setUp(self):
+        self.context = mocaca.app.app_context()
+        self.context.push()
+        mocaca.Job.query.delete()
+        mocaca.db.session.commit()
+        self.client = mocaca.app.test_client()
+        self.admin_id = mocaca.User.query.filter_by(username='admin').one().id
+
+    def tearDown(self):
+        mocaca.Job.query.delete()
+        mocaca.db.session.commit()
+        mocaca.db.session.remove()
+        self.context.pop()
+
+    def cancel(self, kind):
+        # 由其他（存活的）进程执行，不会被本进程接管
+        job = mocaca.Job(kind=kind, status='running', owner=f'other-host:{os.getpid()}', heartbeat_at=mocaca.datetime.utcnow())
+        mocaca.db.session.add(job)
+        mocaca.db.session.commit()
+        response = self.client.delete(f'/api/admin/jobs/{job.id}', headers={'Authorization': f'Bearer {self.admin_id}'})
+        mocaca.db.session.refresh(job)
+        return response, job
+
+    def test_scan_job_cannot_be_cancelled(self):
+        """扫描任务不检查取消请求，取消时返回400且不记录取消请求"""
+        response, job = self.cancel('scan')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(job.cancel_requested)
+
+    def test_thumbnail_job_cancel_is_requested(self):
+        response, job = self.cancel('thumbnails')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(job.cancel_requested)
+
+if __name__ == '__main__':
+    unittest.main()
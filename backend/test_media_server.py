@@ -0,0 +1,186 @@
+import asyncio
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+import media_server
+
+VIDEO_DATA = bytes(range(256)) * 1000
+SEGMENT_DATA = b'G' * 188 * 10
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class MediaServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        media_folder = mocaca.app.config['MEDIA_FOLDER']
+        os.makedirs(os.path.join(media_folder, 'a b'), exist_ok=True)
+        with open(os.path.join(media_folder, 'a b', 'v.mp4'), 'wb') as f:
+            f.write(VIDEO_DATA)
+        with mocaca.app.app_context():
+            video = mocaca.Video(filename='a b/v.mp4', filepath=os.path.join(media_folder, 'a b', 'v.mp4'))
+            mocaca.db.session.add(video)
+            mocaca.db.session.merge(mocaca.ProbeCache(relpath='a b/v.mp4', size=len(VIDEO_DATA), mtime_ns=0,
+                                                      codec='h264', is_portrait=True))
+            mocaca.db.session.commit()
+            cls.video_id = video.id
+            cls.hls_dir = mocaca.hls_cache_dir(video, os.stat(video.filepath))
+        os.makedirs(cls.hls_dir, exist_ok=True)
+        with open(os.path.join(cls.hls_dir, 'seg00000.ts'), 'wb') as f:
+            f.write(SEGMENT_DATA)
+
+        cls.port = free_port()
+        threading.Thread(target=asyncio.run, args=(media_server.serve('127.0.0.1', cls.port),), daemon=True).start()
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', cls.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    def setUp(self):
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def request(self, path, headers=None, method='GET', body=None):
+        self.conn.request(method, path, body=body, headers=headers or {})
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    video_url = '/api/videos/file/a%20b/v.mp4'
+
+    def test_full_file(self):
+        """完整发送视频文件，带ETag、Last-Modified和Accept-Ranges"""
+        response, body = self.request(self.video_url)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, VIDEO_DATA)
+        self.assertEqual(response.getheader('Content-Type'), 'video/mp4')
+        self.assertEqual(response.getheader('Accept-Ranges'), 'bytes')
+        self.assertTrue(response.getheader('ETag'))
+        self.assertTrue(response.getheader('Last-Modified'))
+
+    def test_single_ranges(self):
+        """单个区间（起止、后缀、开放结尾）返回206和对应的Content-Range"""
+        size = len(VIDEO_DATA)
+        for header, start, end in (('bytes=100-199', 100, 200), ('bytes=-10', size - 10, size),
+                                   (f'bytes={size - 5}-', size - 5, size)):
+            response, body = self.request(self.video_url, {'Range': header})
+            self.assertEqual(response.status, 206, header)
+            self.assertEqual(response.getheader('Content-Range'), f'bytes {start}-{end - 1}/{size}')
+            self.assertEqual(body, VIDEO_DATA[start:end])
+
+    def test_unsatisfiable_range(self):
+        """超出文件大小的区间返回416和bytes */大小"""
+        response, _ = self.request(self.video_url, {'Range': f'bytes={len(VIDEO_DATA)}-'})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader('Content-Range'), f'bytes */{len(VIDEO_DATA)}')
+
+    def test_if_range(self):
+        """If-Range与当前ETag一致时返回部分内容，不一致时返回完整内容"""
+        etag = self.request(self.video_url, method='HEAD')[0].getheader('ETag')
+        response, body = self.request(self.video_url, {'Range': 'bytes=0-9', 'If-Range': etag})
+        self.assertEqual((response.status, body), (206, VIDEO_DATA[:10]))
+        response, body = self.request(self.video_url, {'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+        self.assertEqual((response.status, body), (200, VIDEO_DATA))
+
+    def test_conditional_requests(self):
+        """If-None-Match和If-Modified-Since命中时返回304且没有响应体"""
+        response, _ = self.request(self.video_url)
+        etag, last_modified = response.getheader('ETag'), response.getheader('Last-Modified')
+        response, body = self.request(self.video_url, {'If-None-Match': etag})
+        self.assertEqual((response.status, body), (304, b''))
+        response, body = self.request(self.video_url, {'If-Modified-Since': last_modified})
+        self.assertEqual((response.status, body), (304, b''))
+
+    def test_head(self):
+        """HEAD返回与GET相同的头，没有响应体"""
+        response, body = self.request(self.video_url, method='HEAD')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Length'), str(len(VIDEO_DATA)))
+        self.assertEqual(body, b'')
+
+    def test_keep_alive(self):
+        """同一连接上依次处理媒体请求和API请求"""
+        self.request(self.video_url, {'Range': 'bytes=0-0'})
+        sock = self.conn.sock
+        response, body = self.request(f'/api/videos/{self.video_id}')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(body)['id'], self.video_id)
+        self.request(self.video_url, method='HEAD')
+        self.assertIs(self.conn.sock, sock)
+
+    def test_invalid_paths(self):
+        """越出媒体目录和包含空字符的路径返回404，连接保持可用"""
+        for path in ('/api/videos/file/..%2Fbackend%2Fapp.py', '/api/videos/file/%2e%2e/instance/videos.db',
+                     '/api/videos/file/a%00b.mp4', '/api/thumbnails/a%00b.jpg', '/api/videos/file/missing.mp4'):
+            response, _ = self.request(path)
+            self.assertEqual(response.status, 404, path)
+        self.assertEqual(self.request(self.video_url, method='HEAD')[0].status, 200)
+
+    def test_method_not_allowed(self):
+        response, _ = self.request(self.video_url, method='POST', body=b'')
+        self.assertEqual(response.status, 405)
+
+    def test_request_body_limit(self):
+        """声明的请求体超过上限时返回413，不读取请求体"""
+        with mock.patch.object(media_server, 'MEDIA_SERVER_MAX_BODY', 16):
+            response, _ = self.request('/api/login', {'Content-Type': 'application/json'}, 'POST', b'{' + b' ' * 32 + b'}')
+        self.assertEqual(response.status, 413)
+
+    def test_generated_hls_segment_is_sent_directly(self):
+        """已生成的分片由媒体服务直接发送，支持Range"""
+        path = f'/api/videos/{self.video_id}/hls/seg00000.ts'
+        with mock.patch.object(mocaca, 'request_hls_package') as request_package:
+            response, body = self.request(path, {'Range': 'bytes=0-187'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Type'), 'video/mp2t')
+        self.assertEqual(body, SEGMENT_DATA[:188])
+        request_package.assert_not_called()
+
+    def test_missing_hls_segment_falls_back_to_flask(self):
+        """尚未生成的分片交给Flask，等待转封装生成后返回"""
+        def package(video_path, cache_dir):
+            with open(os.path.join(cache_dir, 'seg00001.ts'), 'wb') as f:
+                f.write(SEGMENT_DATA)
+            future = Future()
+            future.set_result(True)
+            return future
+
+        with mock.patch.object(mocaca, 'request_hls_package', side_effect=package) as request_package:
+            response, body = self.request(f'/api/videos/{self.video_id}/hls/seg00001.ts')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, SEGMENT_DATA)
+        request_package.assert_called_once()
+        os.remove(os.path.join(self.hls_dir, 'seg00001.ts'))
+
+    def test_streamed_api_response(self):
+        """没有Content-Length的流式响应使用分块传输编码，之后连接仍可使用"""
+        with mocaca.app.app_context():
+            user = mocaca.User(username='media-server-test', password='x')
+            mocaca.db.session.add(user)
+            mocaca.db.session.flush()
+            mocaca.db.session.add(mocaca.Dislike(user_id=user.id, video_id=self.video_id))
+            mocaca.db.session.commit()
+            user_id = user.id
+        response, body = self.request(f'/api/dislikes?user_id={user_id}')
+        self.assertEqual(response.status, 200)
+        if response.getheader('Content-Length') is None:
+            self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual([video['id'] for video in json.loads(body)], [self.video_id])
+        self.assertEqual(self.request(self.video_url, method='HEAD')[0].status, 200)
+
+if __name__ == '__main__':
+    unittest.main()
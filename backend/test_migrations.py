@@ -0,0 +1,62 @@
+import unittest
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+# 最早版本的数据库结构（没有thumbnail_hash列和后来添加的索引）
+LEGACY_SCHEMA = [
+    'CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(80) NOT NULL UNIQUE, '
+    'password VARCHAR(120) NOT NULL, is_admin BOOLEAN, created_at DATETIME)',
+    'CREATE TABLE video (id INTEGER PRIMARY KEY, filename VARCHAR(255) NOT NULL UNIQUE, '
+    'filepath VARCHAR(512) NOT NULL, next_id INTEGER REFERENCES video (id), '
+    'thumbnail_path VARCHAR(512), created_at DATETIME)',
+    "INSERT INTO video (id, filename, filepath, next_id) VALUES (1, 'a.mp4', '/media/a.mp4', 2), "
+    "(2, 'b.mp4', '/media/b.mp4', 1)",
+]
+
+class InitDbTest(unittest.TestCase):
+    def reset_database(self, statements=()):
+        with mocaca.app.app_context():
+            mocaca.db.session.remove()
+            mocaca.db.drop_all()
+            with mocaca.db.engine.connect() as conn:
+                for statement in statements:
+                    conn.exec_driver_sql(statement)
+                conn.exec_driver_sql('PRAGMA user_version = 0')
+                conn.commit()
+
+    def inspect(self):
+        with mocaca.app.app_context(), mocaca.db.engine.connect() as conn:
+            version = conn.exec_driver_sql('PRAGMA user_version').scalar()
+            columns = {row[1] for row in conn.exec_driver_sql('PRAGMA table_info(video)')}
+            indexes = {row[1] for row in conn.exec_driver_sql('PRAGMA index_list(favorite)')}
+            links = dict(conn.exec_driver_sql('SELECT id, next_id FROM video').all())
+        return version, columns, indexes, links
+
+    def tearDown(self):
+        # 恢复为最新结构，供其他测试使用
+        self.reset_database()
+        mocaca.init_db()
+
+    def test_existing_database_is_migrated(self):
+        """已有video表的数据库执行全部迁移，而不是直接记为最新版本"""
+        self.reset_database(LEGACY_SCHEMA)
+        mocaca.init_db()
+        version, columns, indexes, links = self.inspect()
+        self.assertEqual(version, mocaca.MIGRATIONS[-1][0])
+        self.assertIn('thumbnail_hash', columns)
+        self.assertIn('ix_favorite_user_created', indexes)
+        self.assertEqual(links, {1: 2, 2: None})
+
+    def test_empty_database_is_stamped(self):
+        """没有数据表的数据库按最新模型建表并直接记为最新版本，同时创建默认管理员"""
+        self.reset_database()
+        mocaca.init_db()
+        version, columns, _, _ = self.inspect()
+        self.assertEqual(version, mocaca.MIGRATIONS[-1][0])
+        self.assertIn('thumbnail_hash', columns)
+        with mocaca.app.app_context():
+            self.assertTrue(mocaca.User.query.filter_by(username='admin', is_admin=True).first())
+
+if __name__ == '__main__':
+    unittest.main()
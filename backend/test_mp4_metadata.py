@@ -0,0 +1,181 @@
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+# 变换矩阵（a、b、c、d为16.16定点数，w为2.30定点数）
+IDENTITY_MATRIX = (0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+ROTATE_90_MATRIX = (0, 0x10000, 0, -0x10000, 0, 0, 0, 0, 0x40000000)
+
+def box(box_type, *payloads):
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def large_box(box_type, payload):
+    """使用64位大小字段的盒子"""
+    return struct.pack('>I4sQ', 1, box_type, 16 + len(payload)) + payload
+
+def full_box(box_type, version, payload):
+    return box(box_type, bytes([version, 0, 0, 0]), payload)
+
+def mvhd(timescale, duration, version=0):
+    if version == 1:
+        return full_box(b'mvhd', 1, struct.pack('>QQIQ', 0, 0, timescale, duration) + bytes(80))
+    return full_box(b'mvhd', 0, struct.pack('>IIII', 0, 0, timescale, duration) + bytes(80))
+
+def tkhd(width, height, matrix=IDENTITY_MATRIX, version=0):
+    if version == 1:
+        times = struct.pack('>QQIIQ', 0, 0, 1, 0, 0)
+    else:
+        times = struct.pack('>IIIII', 0, 0, 1, 0, 0)
+    return full_box(b'tkhd', version, times + bytes(16) + struct.pack('>9i', *matrix)
+                    + struct.pack('>II', width << 16, height << 16))
+
+def mdhd(timescale, duration, version=0):
+    if version == 1:
+        return full_box(b'mdhd', 1, struct.pack('>QQIQ', 0, 0, timescale, duration) + bytes(4))
+    return full_box(b'mdhd', 0, struct.pack('>IIII', 0, 0, timescale, duration) + bytes(4))
+
+def hdlr(handler):
+    return full_box(b'hdlr', 0, bytes(4) + handler + bytes(12) + b'\x00')
+
+def stsd(fourcc, coded_width, coded_height):
+    entry = box(fourcc, bytes(6), struct.pack('>H', 1), bytes(16),
+                struct.pack('>HH', coded_width, coded_height), bytes(50))
+    return full_box(b'stsd', 0, struct.pack('>I', 1) + entry)
+
+def trak(handler=b'vide', width=1080, height=1920, matrix=IDENTITY_MATRIX, fourcc=b'avc1',
+         coded=(1080, 1920), timescale=600, duration=6000, version=0):
+    return box(b'trak',
+               tkhd(width, height, matrix, version),
+               box(b'mdia',
+                   mdhd(timescale, duration, version),
+                   hdlr(handler),
+                   box(b'minf', box(b'stbl', stsd(fourcc, *coded)))))
+
+def moov(*traks, timescale=1000, duration=10000, version=0):
+    return box(b'moov', mvhd(timescale, duration, version), *traks)
+
+FTYP = box(b'ftyp', b'isom', bytes(4), b'isomavc1')
+
+class ReadMp4MetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, *boxes, name='video.mp4'):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wb') as f:
+            f.write(b''.join(boxes))
+        return path
+
+    def test_version0_portrait(self):
+        """版本0的盒子：纵向视频的宽高、编码和轨道时长"""
+        path = self.write(FTYP, moov(trak()), box(b'mdat', bytes(64)))
+        self.assertEqual(mocaca.read_mp4_metadata(path), {
+            'width': 1080, 'height': 1920, 'rotation': 0, 'duration': 10.0, 'codec': 'h264'
+        })
+
+    def test_version1_boxes_with_rotation(self):
+        """版本1的tkhd/mdhd/mvhd（64位时间字段）和90度旋转矩阵"""
+        path = self.write(FTYP, moov(
+            trak(width=1920, height=1080, matrix=ROTATE_90_MATRIX, fourcc=b'hvc1', coded=(1920, 1080),
+                 timescale=90000, duration=90000 * 12, version=1),
+            timescale=1000, duration=12000, version=1))
+        self.assertEqual(mocaca.read_mp4_metadata(path), {
+            'width': 1920, 'height': 1080, 'rotation': 90, 'duration': 12.0, 'codec': 'hevc'
+        })
+
+    def test_moov_after_large_mdat(self):
+        """moov位于使用64位大小的mdat之后时跳过mdat定位moov"""
+        path = self.write(FTYP, large_box(b'mdat', bytes(4096)), moov(trak()))
+        self.assertEqual(mocaca.read_mp4_metadata(path)['height'], 1920)
+
+    def test_skips_audio_track(self):
+        """跳过音频轨道，使用第一个视频轨道"""
+        path = self.write(FTYP, moov(trak(handler=b'soun', width=0, height=0, fourcc=b'mp4a'),
+                                     trak(fourcc=b'av01')))
+        info = mocaca.read_mp4_metadata(path)
+        self.assertEqual(info['codec'], 'av1')
+        self.assertEqual((info['width'], info['height']), (1080, 1920))
+
+    def test_coded_size_fallback(self):
+        """tkhd中没有显示宽高时使用stsd中的编码宽高"""
+        path = self.write(FTYP, moov(trak(width=0, height=0, coded=(720, 1280))))
+        info = mocaca.read_mp4_metadata(path)
+        self.assertEqual((info['width'], info['height']), (720, 1280))
+
+    def test_movie_duration_fallback(self):
+        """轨道没有时长时使用mvhd中的影片时长"""
+        path = self.write(FTYP, moov(trak(duration=0), timescale=1000, duration=7500))
+        self.assertEqual(mocaca.read_mp4_metadata(path)['duration'], 7.5)
+
+    def test_unparseable_files(self):
+        """没有moov、没有视频轨道或文件截断时返回None"""
+        self.assertIsNone(mocaca.read_mp4_metadata(self.write(FTYP, box(b'mdat', bytes(16)))))
+        self.assertIsNone(mocaca.read_mp4_metadata(self.write(FTYP, moov(trak(handler=b'soun')))))
+        truncated = (FTYP + moov(trak()))[:-40]
+        self.assertIsNone(mocaca.read_mp4_metadata(self.write(truncated)))
+        self.assertIsNone(mocaca.read_mp4_metadata(self.write(b'not a video file')))
+
+class VideoProbeTest(unittest.TestCase):
+    """在探测缓存之前入库的视频（没有ProbeCache记录）按需探测"""
+
+    def setUp(self):
+        self.context = mocaca.app.app_context()
+        self.context.push()
+        for model in (mocaca.Dislike, mocaca.Favorite, mocaca.Video, mocaca.ProbeCache):
+            model.query.delete()
+        mocaca.db.session.commit()
+        mocaca._probe_failed.clear()
+        self.client = mocaca.app.test_client()
+
+    def tearDown(self):
+        mocaca.db.session.remove()
+        self.context.pop()
+
+    def add_video(self, name, *boxes):
+        path = os.path.join(mocaca.app.config['MEDIA_FOLDER'], name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b''.join(boxes))
+        video = mocaca.Video(filename=name, filepath=path)
+        mocaca.db.session.add(video)
+        mocaca.db.session.commit()
+        return video.id
+
+    def test_unprobed_video_gets_hls(self):
+        """没有探测记录的H.264视频在请求时探测并保存，之后提供hls_url"""
+        video_id = self.add_video('old/h264.mp4', FTYP, moov(trak()))
+        info = self.client.get(f'/api/videos/{video_id}').json
+        self.assertEqual(info['hls_url'], f'/api/videos/{video_id}/hls/index.m3u8')
+        probe = mocaca.ProbeCache.query.filter_by(relpath='old/h264.mp4').one()
+        self.assertEqual((probe.codec, probe.duration), ('h264', 10.0))
+
+    def test_unprobed_hevc_video_has_no_hls(self):
+        video_id = self.add_video('old/hevc.mp4', FTYP, moov(trak(fourcc=b'hvc1')))
+        self.assertIsNone(self.client.get(f'/api/videos/{video_id}').json['hls_url'])
+        self.assertEqual(self.client.get(f'/api/videos/{video_id}/hls/index.m3u8').status_code, 415)
+
+    def test_failed_probe_is_not_repeated(self):
+        """探测失败后文件不变时不再重复探测"""
+        video_id = self.add_video('old/broken.mp4', b'not a video file')
+        with mock.patch.object(mocaca, 'ffprobe_video_metadata', return_value=None) as ffprobe:
+            for _ in range(3):
+                self.assertIsNone(self.client.get(f'/api/videos/{video_id}').json['hls_url'])
+        self.assertEqual(ffprobe.call_count, 1)
+
+    def test_short_video_thumbnail_position(self):
+        """缩略图时间点使用按需探测得到的时长"""
+        video_id = self.add_video('old/short.mp4', FTYP, moov(trak(duration=600), timescale=1000, duration=1000))
+        video = mocaca.db.session.get(mocaca.Video, video_id)
+        self.assertEqual(mocaca.thumbnail_time_position(video), '0.500')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+class SeededPermutationTest(unittest.TestCase):
+    def test_bijection(self):
+        """每个位置的值互不相同且正好覆盖[0, size)"""
+        for size in (1, 2, 3, 5, 16, 17, 100, 1000, 4097):
+            for seed in (0, 42, 'abc'):
+                permutation = mocaca.SeededPermutation(size, seed)
+                self.assertEqual(sorted(permutation[i] for i in range(size)), list(range(size)), (size, seed))
+
+    def test_deterministic_per_seed(self):
+        """相同种子得到相同的排列，不同种子得到不同的排列"""
+        first = [mocaca.SeededPermutation(200, 7)[i] for i in range(200)]
+        again = [mocaca.SeededPermutation(200, 7)[i] for i in range(200)]
+        other = [mocaca.SeededPermutation(200, 8)[i] for i in range(200)]
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+        self.assertNotEqual(first, list(range(200)))
+
+class RandomFeedPageTest(unittest.TestCase):
+    VIDEO_COUNT = 30
+
+    def setUp(self):
+        self.context = mocaca.app.app_context()
+        self.context.push()
+        for model in (mocaca.Dislike, mocaca.Favorite, mocaca.Video):
+            model.query.delete()
+        user = mocaca.User.query.filter_by(username='feed-test').first()
+        if user is None:
+            user = mocaca.User(username='feed-test', password='x')
+            mocaca.db.session.add(user)
+        for i in range(self.VIDEO_COUNT):
+            mocaca.db.session.add(mocaca.Video(filename=f'feed/{i:03d}.mp4', filepath=f'/media/feed/{i:03d}.mp4'))
+        mocaca.bump_library_version()
+        mocaca.db.session.commit()
+        self.user_id = user.id
+        self.video_ids = [video.id for video in mocaca.Video.query.order_by(mocaca.Video.id)]
+
+    def tearDown(self):
+        mocaca.db.session.remove()
+        self.context.pop()
+
+    def dislike(self, video_ids):
+        for video_id in video_ids:
+            mocaca.db.session.add(mocaca.Dislike(user_id=self.user_id, video_id=video_id))
+        mocaca.bump_dislike_version(self.user_id)
+        mocaca.db.session.commit()
+
+    def all_pages(self, seed, per_page, user_id=None):
+        ids = []
+        page = 1
+        while True:
+            page_ids, total = mocaca.random_feed_page(seed, page, per_page, user_id)
+            if not page_ids:
+                return ids, total
+            self.assertLessEqual(len(page_ids), per_page)
+            ids.extend(page_ids)
+            page += 1
+
+    def test_pages_cover_library_once(self):
+        """按页取完后每个视频正好出现一次"""
+        ids, total = self.all_pages(seed=3, per_page=7)
+        self.assertEqual(total, self.VIDEO_COUNT)
+        self.assertEqual(sorted(ids), self.video_ids)
+
+    def test_excludes_disliked_videos(self):
+        """排除用户讨厌的视频后再排列，总数和每页数量稳定"""
+        disliked = self.video_ids[::4] + [self.video_ids[-1]]
+        self.dislike(disliked)
+        ids, total = self.all_pages(seed=3, per_page=7, user_id=self.user_id)
+        expected = sorted(set(self.video_ids) - set(disliked))
+        self.assertEqual(total, len(expected))
+        self.assertEqual(sorted(ids), expected)
+        # 未登录的请求不受影响
+        self.assertEqual(sorted(self.all_pages(seed=3, per_page=7)[0]), self.video_ids)
+
+    def test_new_dislike_invalidates_exclusion(self):
+        """新增讨厌后，缓存的排除集合随讨厌版本号失效"""
+        self.dislike(self.video_ids[:2])
+        self.all_pages(seed=9, per_page=10, user_id=self.user_id)
+        self.dislike(self.video_ids[2:3])
+        ids, total = self.all_pages(seed=9, per_page=10, user_id=self.user_id)
+        self.assertEqual(total, self.VIDEO_COUNT - 3)
+        self.assertEqual(sorted(ids), self.video_ids[3:])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import unittest
+from unittest import mock
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+def fake_generate_thumbnail(video_path, output_path, time_position='00:00:01'):
+    with open(output_path, 'wb') as f:
+        f.write(b'thumbnail of ' + video_path.encode())
+    return True
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        with mocaca.app.app_context():
+            for model in (mocaca.Dislike, mocaca.Favorite, mocaca.Video):
+                model.query.delete()
+            video = mocaca.Video(filename='cache/a.mp4', filepath='/media/cache/a.mp4')
+            mocaca.db.session.add(video)
+            mocaca.bump_library_version()
+            mocaca.db.session.commit()
+            self.video_id = video.id
+        self.client = mocaca.app.test_client()
+
+    def thumbnail_urls(self):
+        response = self.client.get('/api/videos')
+        self.assertEqual(response.status_code, 200)
+        return response, [item['thumbnail_url'] for item in response.json['items']]
+
+    def test_on_demand_thumbnail_invalidates_listing(self):
+        """按需生成缩略图（批量UPDATE写入）后，缓存的列表返回新的缩略图URL"""
+        before, urls = self.thumbnail_urls()
+        self.assertEqual(urls, [None])
+        with mock.patch.object(mocaca, 'generate_thumbnail', fake_generate_thumbnail):
+            store_path = mocaca._render_thumbnail_task(
+                self.video_id, '/media/cache/a.mp4',
+                os.path.join(mocaca.app.config['THUMBNAIL_FOLDER'], f'{self.video_id}_a.mp4.jpg'), '00:00:01')
+        self.assertIsNotNone(store_path)
+        after, urls = self.thumbnail_urls()
+        self.assertEqual(len(urls), 1)
+        self.assertIsNotNone(urls[0])
+        self.assertNotEqual(before.headers['ETag'], after.headers['ETag'])
+        # 旧ETag不再返回304
+        response = self.client.get('/api/videos', headers={'If-None-Match': before.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+
+    def test_orm_update_invalidates_listing(self):
+        """通过ORM修改缩略图时由after_update事件递增缩略图版本"""
+        _, urls = self.thumbnail_urls()
+        self.assertEqual(urls, [None])
+        with mocaca.app.app_context():
+            video = mocaca.db.session.get(mocaca.Video, self.video_id)
+            video.thumbnail_hash = '0' * 32
+            video.thumbnail_path = os.path.join(mocaca.app.config['THUMBNAIL_FOLDER'], 'x.jpg')
+            mocaca.db.session.commit()
+        _, urls = self.thumbnail_urls()
+        self.assertEqual(urls, [f"/api/thumbnails/{'0' * 32}.jpg"])
+
+    def test_unchanged_listing_returns_304(self):
+        """内容未变化时对If-None-Match返回304"""
+        response, _ = self.thumbnail_urls()
+        again = self.client.get('/api/videos', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+
+if __name__ == '__main__':
+    unittest.main()
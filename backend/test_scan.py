@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+# 与"a"同名前缀的兄弟目录：' '、'-'、'.'排在'/'之前，'0'紧跟在'/'之后，都不能被当作"a/"下的路径
+LIBRARY = ['r.mp4', 'a/x.mp4', 'a/sub/w.mp4', 'a b/y.mp4', 'a-/q.mp4', 'a.b/z.mp4', 'a0/v.mp4']
+
+class ScanMediaFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.media_folder = tempfile.mkdtemp(prefix='mocaca-scan-')
+        self.addCleanup(shutil.rmtree, self.media_folder, ignore_errors=True)
+        for patcher in (mock.patch.dict(mocaca.app.config, {'MEDIA_FOLDER': self.media_folder}),
+                        mock.patch.object(mocaca, 'ffprobe_video_metadata', return_value=None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.context = mocaca.app.app_context()
+        self.context.push()
+        for model in (mocaca.Dislike, mocaca.Favorite, mocaca.Video, mocaca.ProbeCache, mocaca.ScanDirectory):
+            model.query.delete()
+        mocaca.db.session.commit()
+        for rel_path in LIBRARY:
+            self.write(rel_path)
+
+    def tearDown(self):
+        mocaca.db.session.remove()
+        self.context.pop()
+
+    def write(self, rel_path):
+        path = os.path.join(self.media_folder, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'not a real video')
+
+    def scan(self, incremental=True):
+        stats = mocaca.scan_media_folder(incremental)
+        mocaca.db.session.remove()
+        return stats
+
+    def library(self):
+        return sorted(video.filename for video in mocaca.Video.query)
+
+    def test_initial_scan(self):
+        stats = self.scan()
+        self.assertEqual(stats['added'], len(LIBRARY))
+        self.assertEqual(self.library(), sorted(LIBRARY))
+
+    def test_deleted_directory_keeps_siblings(self):
+        """删除目录只清理该目录树下的记录，同名前缀的兄弟目录和它们的收藏不受影响"""
+        self.scan()
+        user = mocaca.User.query.filter_by(username='admin').one()
+        sibling_id = mocaca.Video.query.filter_by(filename='a b/y.mp4').one().id
+        mocaca.db.session.add(mocaca.Favorite(user_id=user.id, video_id=sibling_id))
+        mocaca.db.session.commit()
+
+        shutil.rmtree(os.path.join(self.media_folder, 'a'))
+        stats = self.scan()
+        self.assertEqual(sorted(stats['removed_files']), ['a/sub/w.mp4', 'a/x.mp4'])
+        self.assertEqual(self.library(), sorted(set(LIBRARY) - {'a/x.mp4', 'a/sub/w.mp4'}))
+        self.assertEqual(mocaca.Favorite.query.filter_by(video_id=sibling_id).count(), 1)
+
+    def test_deleted_subdirectory(self):
+        """删除子目录只清理子目录下的记录，上一级目录中的文件保留"""
+        self.scan()
+        shutil.rmtree(os.path.join(self.media_folder, 'a', 'sub'))
+        stats = self.scan()
+        self.assertEqual(stats['removed_files'], ['a/sub/w.mp4'])
+        self.assertEqual(stats['scanned_dirs'], 1)
+        self.assertIn('a/x.mp4', self.library())
+
+    def test_deleted_root_file(self):
+        """删除根目录下的文件只清理该文件，子目录中的记录不受影响"""
+        self.scan()
+        os.remove(os.path.join(self.media_folder, 'r.mp4'))
+        stats = self.scan()
+        self.assertEqual(stats['removed_files'], ['r.mp4'])
+        self.assertEqual(self.library(), sorted(set(LIBRARY) - {'r.mp4'}))
+
+    def test_unchanged_incremental_scan(self):
+        """没有变化时增量扫描不列出任何目录，也不增删记录"""
+        self.scan()
+        stats = self.scan()
+        self.assertEqual((stats['scanned_dirs'], stats['added'], stats['removed']), (0, 0, 0))
+        self.assertEqual(self.library(), sorted(LIBRARY))
+        # 全量扫描重新列出所有目录，结果相同
+        stats = self.scan(incremental=False)
+        self.assertEqual((stats['added'], stats['removed'], stats['unchanged']), (0, 0, len(LIBRARY)))
+
+    def test_new_file_in_nested_directory(self):
+        """只有新文件所在的目录被重新列出"""
+        self.scan()
+        self.write('a/sub/new.mp4')
+        stats = self.scan()
+        self.assertEqual((stats['scanned_dirs'], stats['added_files']), (1, ['a/sub/new.mp4']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+from unittest import mock
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+class RelinkSequenceTest(unittest.TestCase):
+    def setUp(self):
+        self.context = mocaca.app.app_context()
+        self.context.push()
+        for model in (mocaca.Dislike, mocaca.Favorite, mocaca.Video):
+            model.query.delete()
+        mocaca.db.session.commit()
+
+    def tearDown(self):
+        mocaca.db.session.remove()
+        self.context.pop()
+
+    def add(self, *names, ids=None):
+        for i, name in enumerate(names):
+            video = mocaca.Video(filename=name, filepath=f'/media/{name}')
+            if ids:
+                video.id = ids[i]
+            mocaca.db.session.add(video)
+        mocaca.db.session.commit()
+
+    def delete(self, *video_ids):
+        for video_id in video_ids:
+            mocaca.db.session.delete(mocaca.db.session.get(mocaca.Video, video_id))
+        mocaca.db.session.commit()
+
+    def links(self):
+        rows = mocaca.db.session.execute(mocaca.db.select(mocaca.Video.id, mocaca.Video.next_id).order_by(mocaca.Video.id))
+        return dict(rows.all())
+
+    def assertChain(self):
+        """每个视频的next_id指向ID更大的下一个视频，最后一个为空"""
+        links = self.links()
+        ids = sorted(links)
+        self.assertEqual(links, dict(zip(ids, ids[1:] + [None])))
+        return ids
+
+    def test_append(self):
+        """追加视频时前一个末尾视频指向新视频"""
+        self.add('a.mp4', 'b.mp4', 'c.mp4')
+        ids = self.assertChain()
+        self.add('d.mp4')
+        self.assertEqual(self.links()[ids[-1]], max(self.links()))
+        self.assertChain()
+
+    def test_insert_into_gap(self):
+        """在ID空隙中插入时前驱改为指向新视频，新视频指向原来的后继"""
+        self.add('a.mp4', 'b.mp4', 'e.mp4', ids=[1, 2, 5])
+        self.add('c.mp4', ids=[3])
+        self.assertEqual(self.links(), {1: 2, 2: 3, 3: 5, 5: None})
+
+    def test_delete_middle_first_and_last(self):
+        """删除中间、第一个和最后一个视频后序列保持连续"""
+        self.add(*[f'{i}.mp4' for i in range(6)])
+        ids = self.assertChain()
+        self.delete(ids[2], ids[3])
+        self.assertEqual(self.links()[ids[1]], ids[4])
+        self.delete(ids[0])
+        self.delete(ids[-1])
+        self.assertEqual(self.assertChain(), [ids[1], ids[4]])
+
+    def test_insert_and_delete_in_one_commit(self):
+        """同一事务中的新增和删除一起重新计算"""
+        self.add('a.mp4', 'b.mp4', 'c.mp4')
+        ids = self.assertChain()
+        mocaca.db.session.delete(mocaca.db.session.get(mocaca.Video, ids[1]))
+        mocaca.db.session.add(mocaca.Video(filename='d.mp4', filepath='/media/d.mp4'))
+        mocaca.db.session.commit()
+        self.assertChain()
+
+    def test_chunked_batches(self):
+        """改动数超过分块大小时分块查询和更新"""
+        with mock.patch.object(mocaca, 'SEQUENCE_CHUNK', 3):
+            self.add(*[f'{i}.mp4' for i in range(10)])
+            ids = self.assertChain()
+            self.delete(*ids[1:8:2])
+        self.assertChain()
+
+    def test_prev_wraps_to_last(self):
+        """第一个视频的前一个为最后一个视频（循环播放），最后一个视频没有下一个"""
+        self.add('a.mp4', 'b.mp4', 'c.mp4')
+        ids = self.assertChain()
+        client = mocaca.app.test_client()
+        self.assertEqual(client.get(f'/api/videos/prev/{ids[0]}').json['id'], ids[-1])
+        self.assertEqual(client.get(f'/api/videos/prev/{ids[1]}').json['id'], ids[0])
+        self.assertIsNone(client.get(f'/api/videos/{ids[-1]}').json['next_id'])
+        # 已删除的视频按ID范围查找前一个
+        self.delete(ids[1])
+        self.assertEqual(client.get(f'/api/videos/prev/{ids[1]}').json['id'], ids[0])
+
+if __name__ == '__main__':
+    unittest.main()
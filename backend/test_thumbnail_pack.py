@@ -0,0 +1,138 @@
+import os
+import tempfile
+import unittest
+
+import testenv  # noqa: F401（必须在import app之前）
+import app as mocaca
+
+def thumbnail(i, size=100):
+    return bytes([i % 256]) * size
+
+class ThumbnailPackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.folder = os.path.join(self.tmpdir.name, 'pack')
+
+    def open_pack(self, segment_size=1024):
+        pack = mocaca.ThumbnailPack(self.folder, segment_size)
+        # 每次读取都检查其他进程的改动
+        pack.REFRESH_INTERVAL = 0
+        return pack
+
+    def read(self, pack, key):
+        data = pack.get(key)
+        return None if data is None else bytes(data)
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.folder) if name.startswith('segment-'))
+
+    def test_put_and_get(self):
+        """写入后按文件名读取，重复写入同名文件时跳过，不存在的文件返回None"""
+        pack = self.open_pack()
+        pack.put_many([('a.jpg', b'first'), ('b.webp', b'second')])
+        pack.put_many([('a.jpg', b'ignored')])
+        self.assertEqual(self.read(pack, 'a.jpg'), b'first')
+        self.assertEqual(self.read(pack, 'b.webp'), b'second')
+        self.assertIsNone(pack.get('missing.jpg'))
+        self.assertTrue(pack.contains('a.jpg'))
+        # 重新打开后从索引文件恢复
+        self.assertEqual(self.read(self.open_pack(), 'a.jpg'), b'first')
+
+    def test_segments_roll_over(self):
+        """段超过大小上限后写入新段，所有段中的文件都可以读取"""
+        pack = self.open_pack(segment_size=250)
+        pack.put_many([(f'{i}.jpg', thumbnail(i)) for i in range(6)])
+        self.assertEqual(len(self.segment_files()), 6)
+        reopened = self.open_pack(segment_size=250)
+        for i in range(6):
+            self.assertEqual(self.read(reopened, f'{i}.jpg'), thumbnail(i))
+
+    def test_delete_writes_tombstone(self):
+        """删除追加墓碑记录，重新打开后仍为已删除；删除后可以再次写入"""
+        pack = self.open_pack()
+        pack.put_many([('a.jpg', b'a'), ('b.jpg', b'b')])
+        pack.delete(['a.jpg', 'missing.jpg'])
+        self.assertIsNone(pack.get('a.jpg'))
+        reopened = self.open_pack()
+        self.assertIsNone(reopened.get('a.jpg'))
+        self.assertEqual(self.read(reopened, 'b.jpg'), b'b')
+        reopened.put_many([('a.jpg', b'again')])
+        self.assertEqual(self.read(self.open_pack(), 'a.jpg'), b'again')
+
+    def test_compact(self):
+        """整理失效数据占比达到阈值的段：仍有效的文件移到新段，旧段文件被删除"""
+        pack = self.open_pack(segment_size=1000)
+        pack.put_many([(f'{i}.jpg', thumbnail(i)) for i in range(15)])
+        old_segments = self.segment_files()
+        pack.delete([f'{i}.jpg' for i in range(15) if i % 5])
+        self.assertEqual(pack.compact(1.0), 0)
+        reclaimed = pack.compact(0.3)
+        self.assertEqual(reclaimed, 12 * 100)
+        self.assertTrue(set(old_segments).isdisjoint(self.segment_files()))
+        for pack_to_read in (pack, self.open_pack(segment_size=1000)):
+            for i in range(15):
+                expected = thumbnail(i) if i % 5 == 0 else None
+                self.assertEqual(self.read(pack_to_read, f'{i}.jpg'), expected, i)
+        self.assertEqual(pack.compact(0.3), 0)
+
+    def test_sees_changes_from_other_process(self):
+        """另一个进程（另一个实例）写入、删除和整理后，读取方通过索引追加读取或MANIFEST变化重新加载"""
+        writer = self.open_pack()
+        writer.put_many([('a.jpg', b'a' * 100), ('b.jpg', b'b' * 100)])
+        reader = self.open_pack()
+        self.assertEqual(self.read(reader, 'a.jpg'), b'a' * 100)
+
+        # 同一段中追加的记录：只读取新的索引记录
+        writer.put_many([('c.jpg', b'c' * 100)])
+        self.assertEqual(self.read(reader, 'c.jpg'), b'c' * 100)
+        writer.delete(['b.jpg'])
+        self.assertIsNone(reader.get('b.jpg'))
+
+        # 整理删除了读取方已经映射的段，MANIFEST变化后读取方重新加载并改用新段
+        segments_before = self.segment_files()
+        writer.delete(['a.jpg'])
+        self.assertGreater(writer.compact(0.3), 0)
+        self.assertNotEqual(self.segment_files(), segments_before)
+        self.assertEqual(self.read(reader, 'c.jpg'), b'c' * 100)
+        self.assertIsNone(reader.get('a.jpg'))
+
+        # 读取方自己写入时先读取其他进程的改动，不会覆盖对方的记录
+        reader.put_many([('d.jpg', b'd')])
+        self.assertEqual(self.read(writer, 'd.jpg'), b'd')
+        self.assertEqual(self.read(self.open_pack(), 'c.jpg'), b'c' * 100)
+
+    def test_get_after_segment_compacted_away(self):
+        """读取方还在检查间隔内、索引指向已被其他进程整理删除的段时，重新加载后从新段读取"""
+        writer = self.open_pack()
+        writer.put_many([('a.jpg', b'a' * 100), ('b.jpg', b'b' * 100)])
+        reader = self.open_pack()
+        reader.REFRESH_INTERVAL = 3600
+        writer.delete(['a.jpg'])
+        self.assertGreater(writer.compact(0.3), 0)
+        stale_segment = reader._index['b.jpg'][0]
+        self.assertFalse(os.path.exists(writer._blob_path(stale_segment)))
+        self.assertEqual(self.read(reader, 'b.jpg'), b'b' * 100)
+        self.assertNotEqual(reader._index['b.jpg'][0], stale_segment)
+        self.assertEqual(reader._manifest['segments'], [reader._index['b.jpg'][0]])
+
+    def test_partial_index_record_is_read_later(self):
+        """其他进程写了一半的索引记录先忽略，写完后再读取"""
+        writer = self.open_pack()
+        writer.put_many([('a.jpg', b'a')])
+        reader = self.open_pack()
+        segment = reader._manifest['segments'][-1]
+        with open(writer._blob_path(segment), 'ab') as f:
+            offset = f.tell()
+            f.write(b'new')
+        record = mocaca.ThumbnailPack.RECORD.pack(1, len(b'n.jpg'), offset, 3) + b'n.jpg'
+        with open(writer._idx_path(segment), 'ab') as f:
+            f.write(record[:5])
+        self.assertIsNone(reader.get('n.jpg'))
+        with open(writer._idx_path(segment), 'ab') as f:
+            f.write(record[5:])
+        self.assertEqual(self.read(reader, 'n.jpg'), b'new')
+        self.assertEqual(self.read(reader, 'a.jpg'), b'a')
+
+if __name__ == '__main__':
+    unittest.main()
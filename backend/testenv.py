@@ -0,0 +1,15 @@
+"""测试环境：在导入app之前导入本模块，使用临时的数据库和目录，测试不会改动backend/instance下的数据库
+
+    import testenv  # noqa: F401（必须在import app之前）
+    import app as mocaca
+"""
+import os
+import tempfile
+
+TEST_ROOT = tempfile.mkdtemp(prefix='mocaca-test-')
+os.makedirs(os.path.join(TEST_ROOT, 'instance'), exist_ok=True)
+os.environ.setdefault('DATABASE_PATH', os.path.join(TEST_ROOT, 'instance', 'videos.db'))
+os.environ.setdefault('MEDIA_FOLDER', os.path.join(TEST_ROOT, 'media'))
+os.environ.setdefault('THUMBNAIL_FOLDER', os.path.join(TEST_ROOT, 'thumbnails'))
+os.environ.setdefault('STARTUP_SCAN', 'false')
+os.environ.setdefault('MEDIA_WATCH', 'off')